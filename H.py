@@ -11,8 +11,6 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 
-from torch.utils.tensorboard import SummaryWriter
-
 from tqdm import tqdm
 from fusion import ImageFusion
 import visformer_vis
@@ -21,7 +19,6 @@ from logger import loggers
 from utils import Cosine_classifier, count_95acc, count_kacc, transform_train_224_cifar, transform_val_224_cifar, \
     transform_val_224, transform_train_224,mean_confidence_interval
 import torchvision.transforms as transforms
-import clip
 from data.randaugment import RandAugmentMC
 from data.dataloader import EpisodeSampler, MultiTrans,TESTEpisodeSampler,view_EpisodeSampler,SharedClassSampler
 
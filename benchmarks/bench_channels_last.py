@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+import argparse
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import visformer
+from utils import amp_autocast
+
+
+def throughput(fn, image, n):
+    with torch.no_grad():
+        for _ in range(2):
+            fn(image)
+        if image.is_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(n):
+            fn(image)
+        if image.is_cuda:
+            torch.cuda.synchronize()
+    return n * image.shape[0] / (time.time() - start)
+
+
+def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    if args.image_size == 84:
+        model = visformer.visformer_tiny_84(prompt_stage=args.stage, prompt_mode=args.prompt_mode)
+    else:
+        model = visformer.visformer_tiny(prompt_stage=args.stage, prompt_mode=args.prompt_mode)
+    visformer.add_semantic_heads(model, 512)
+    model = model.to(device).eval()
+    text = torch.randn(args.batch_size, 512, device=device)
+
+    print(f'{args.device}, amp {args.amp}, batch {args.batch_size}, {args.image_size}px, images/s')
+    for memory_format in [torch.contiguous_format, torch.channels_last]:
+        model = model.to(memory_format=memory_format)
+        image = torch.randn(args.batch_size, 3, args.image_size, args.image_size, device=device)
+        image = image.contiguous(memory_format=memory_format)
+        with amp_autocast(args.amp, device):
+            query = throughput(lambda x: model(x), image, args.iters)
+            support = throughput(lambda x: model.forward_with_semantic_prompt_channel(x, text), image, args.iters)
+        name = 'channels_last' if memory_format == torch.channels_last else 'contiguous'
+        print(f'{name:>14}: query {query:8.1f}, prompted support {support:8.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--amp', type=str, default='off', choices=['off', 'bf16', 'fp16'])
+    parser.add_argument('--image_size', type=int, default=224, choices=[224, 84])
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--prompt_mode', type=str, default='spatial+channel', choices=['spatial', 'channel', 'spatial+channel'])
+    parser.add_argument('--stage', type=float, default=3.2, choices=[2, 2.1, 2.2, 2.3, 3, 3.1, 3.2, 3.3])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,60 @@
+import os
+import re
+import sys
+import argparse
+import subprocess
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = ['train_vit', 'train_vit_sp', 'train_vit_sp_CDAT', 'train_vit_sp_test', 'train_vit_sp_TSNE', 'train_vit_H',
+           'train_seman_l1_center', 'compute_center_vit1', 'quantize', 'export_onnx', 'eval_resolution',
+           'eval_early_exit', 'train_exit_heads', 'visformer_vis', 'clip']
+# "import time:       self [us] |  cumulative | imported package"
+LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def import_time(module):
+    """Run `python -X importtime -c "import module"` and return ({top-level package: self us}, total us)."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=ROOT,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'import {module} failed:\n{result.stderr.strip().splitlines()[-1]}')
+    per_package = defaultdict(int)
+    total = 0
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        per_package[name.split('.')[0]] += int(self_us)
+        # the outermost imports (one space of indent) add up to the whole startup
+        if len(indent) == 1:
+            total += int(cumulative_us)
+    return per_package, total
+
+
+def main(args):
+    for module in args.modules:
+        runs = []
+        for _ in range(args.repeat):
+            try:
+                runs.append(import_time(module))
+            except RuntimeError as e:
+                print(f'{module}: {e}')
+                break
+        if not runs:
+            continue
+        # the fastest run has the warmest file cache, the one that is comparable across modules
+        per_package, total = min(runs, key=lambda run: run[1])
+        print(f'{module}: {total / 1e3:.1f} ms')
+        for name, us in sorted(per_package.items(), key=lambda item: -item[1])[:args.top]:
+            print(f'    {name:<28}{us / 1e3:8.1f} ms  {100. * us / max(total, 1):5.1f}%')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modules', type=str, nargs='+', default=SCRIPTS, help='modules to import, from the repo root')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--top', type=int, default=10, help='packages listed per module')
+    args = parser.parse_args()
+    main(args)
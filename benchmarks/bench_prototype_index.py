@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from prototype_index import PrototypeIndex
+
+
+def timed(fn, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return out, time.time() - start
+
+
+def clustered(n, dim, generator, device, centers=256):
+    # prototypes of real classes are not uniform on the sphere, group them around a few hundred directions
+    center = F.normalize(torch.randn(centers, dim, generator=generator), dim=-1)
+    x = center[torch.randint(centers, (n,), generator=generator)] + 0.5 * torch.randn(n, dim, generator=generator) / dim ** 0.5
+    return F.normalize(x, dim=-1).to(device)
+
+
+def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    generator = torch.Generator().manual_seed(0)
+    print(f'{args.device}, dim {args.dim}, {args.queries} queries, top-{args.k}')
+    print('classes, index, build s, queries/s, recall@k vs exact fp32, MB')
+    for n in args.classes:
+        prototypes = clustered(n, args.dim, generator, device)
+        query = F.normalize(prototypes[torch.randint(n, (args.queries,), generator=generator).to(device)]
+                            + 0.3 * torch.randn(args.queries, args.dim, generator=generator).to(device) / args.dim ** 0.5, dim=-1)
+        exact = (query @ prototypes.t()).topk(args.k, dim=-1).indices
+        configs = [(storage, None) for storage in ['fp32', 'fp16', 'int8']]
+        n_lists = max(1, int(n ** 0.5))
+        configs += [('fp16', n_probe) for n_probe in args.n_probe if n_probe < n_lists]
+        for storage, n_probe in configs:
+            index = PrototypeIndex(args.dim, storage, args.block_size, device)
+
+            def build():
+                index.add(torch.arange(n), prototypes)
+                if n_probe is not None:
+                    index.train_ivf(n_lists)
+            _, build_time = timed(build, device)
+            index.search(query[:8], args.k, n_probe)
+            (_, ids), search_time = timed(lambda: index.search(query, args.k, n_probe), device)
+            recall = (ids.unsqueeze(-1) == exact.unsqueeze(1)).any(1).float().mean().item()
+            name = storage if n_probe is None else f'{storage} ivf{n_lists}/{n_probe}'
+            megabytes = index.data[:index.size].numel() * index.data.element_size() / 2 ** 20
+            print(f'{n}, {name}, {build_time:.2f}, {args.queries / search_time:.0f}, {recall:.4f}, {megabytes:.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--classes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--dim', type=int, default=384, help='visformer-t feature dim')
+    parser.add_argument('--queries', type=int, default=1024)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--block_size', type=int, default=8192)
+    parser.add_argument('--n_probe', type=int, nargs='+', default=[4, 16], help='ivf lists scanned per query')
+    parser.add_argument('--threads', type=int, default=0)
+    args = parser.parse_args()
+    main(args)
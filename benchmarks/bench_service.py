@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+import argparse
+import threading
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import visformer
+from bundle import InferenceBundle, load_bundle
+from service import FewShotService
+
+
+def random_bundle(args):
+    # random weights and a random class text table, enough to time the serving path
+    if args.image_size == 84:
+        model = visformer.visformer_tiny_84(prompt_stage=args.stage)
+    else:
+        model = visformer.visformer_tiny(prompt_stage=args.stage)
+    visformer.add_semantic_heads(model, 512)
+    model = model.to(args.device).eval().fuse_for_inference()
+    with torch.no_grad():
+        prompt1, prompt2 = model.project_semantic_prompt(torch.randn(args.classes, 512, device=args.device))
+    classes = [f'class{i}' for i in range(args.classes)]
+    return InferenceBundle(model, prompt1, prompt2, classes, {})
+
+
+def client(service, tasks, args, latencies, seed):
+    rng = np.random.RandomState(seed)
+    image = torch.randn(args.query_size, 3, args.image_size, args.image_size)
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        service.classify(tasks[rng.randint(len(tasks))], image)
+        latencies.append(time.perf_counter() - start)
+
+
+def run(bundle, args, max_batch):
+    service = FewShotService(bundle, max_batch=max_batch, max_wait_ms=args.max_wait_ms)
+    tasks = list(range(args.tasks))
+    classes = bundle.classes
+    for task in tasks:
+        names = [classes[(task * args.way + i) % len(classes)] for i in range(args.way)]
+        service.register(task, {name: torch.randn(args.shot, 3, args.image_size, args.image_size) for name in names})
+    latencies = []
+    with service:
+        client(service, tasks, argparse.Namespace(**dict(vars(args), requests=2)), [], 0)  # warm up
+        threads = [threading.Thread(target=client, args=(service, tasks, args, latencies, i)) for i in range(args.clients)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    print(f'max_batch {max_batch:4d}: {len(latencies) / elapsed:8.1f} requests/s, '
+          f'{len(latencies) * args.query_size / elapsed:8.1f} images/s, '
+          f'p50 {np.percentile(latencies, 50):7.1f}ms, p99 {np.percentile(latencies, 99):7.1f}ms')
+
+
+def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    bundle = load_bundle(args.bundle, args.device) if args.bundle else random_bundle(args)
+    print(f'{args.device}, {args.clients} clients x {args.requests} requests of {args.query_size} images, '
+          f'{args.tasks} tasks, max wait {args.max_wait_ms}ms')
+    for max_batch in args.max_batch:
+        run(bundle, args, max_batch)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bundle', type=str, default='', help='bundle.py export, random weights without it')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--image_size', type=int, default=224, choices=[224, 84])
+    parser.add_argument('--stage', type=float, default=3.2, choices=[2, 2.1, 2.2, 2.3, 3, 3.1, 3.2, 3.3])
+    parser.add_argument('--classes', type=int, default=20, help='classes of the random bundle')
+    parser.add_argument('--tasks', type=int, default=8)
+    parser.add_argument('--way', type=int, default=5)
+    parser.add_argument('--shot', type=int, default=5)
+    parser.add_argument('--clients', type=int, default=16, help='concurrent closed-loop clients')
+    parser.add_argument('--requests', type=int, default=20, help='requests per client')
+    parser.add_argument('--query_size', type=int, default=1, help='images per request')
+    parser.add_argument('--max_batch', type=int, nargs='+', default=[1, 16, 64], help='1 disables micro-batching')
+    parser.add_argument('--max_wait_ms', type=float, default=5.)
+    parser.add_argument('--threads', type=int, default=0)
+    args = parser.parse_args()
+    main(args)
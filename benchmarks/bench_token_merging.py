@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import visformer
+from utils import amp_autocast
+
+
+def throughput(fn, image, n):
+    with torch.no_grad():
+        for _ in range(2):
+            fn(image)
+        if image.is_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(n):
+            fn(image)
+        if image.is_cuda:
+            torch.cuda.synchronize()
+    return n * image.shape[0] / (time.time() - start)
+
+
+def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    if args.image_size == 84:
+        model = visformer.visformer_tiny_84(prompt_stage=args.stage, prompt_mode=args.prompt_mode)
+    else:
+        model = visformer.visformer_tiny(prompt_stage=args.stage, prompt_mode=args.prompt_mode)
+    visformer.add_semantic_heads(model, 512)
+    if args.init:
+        model.load_state_dict(torch.load(args.init, map_location='cpu')['state_dict'])
+    # only the last exit is compared, the exit heads themselves do not matter
+    visformer.add_exit_heads(model)
+    model = model.to(device).eval()
+    image = torch.randn(args.batch_size, 3, args.image_size, args.image_size, device=device)
+    text = torch.randn(args.batch_size, 512, device=device)
+
+    # cosine to the unmerged features tells how far each ratio moves the embedding
+    with torch.no_grad(), amp_autocast(args.amp, device):
+        reference = model(image)[1].float(), model.forward_with_semantic_prompt_channel(image, text)[1].float()
+    print(f'{args.device}, amp {args.amp}, batch {args.batch_size}, {args.image_size}px')
+    # split cosine: merging restarts at every split of a stage, forward splits stage3 at the prompt block while the
+    # last exit of forward_exits also splits at half of stage3, so the two drift apart as the ratio grows
+    print('stage2/3 ratio, query images/s, support images/s, query cosine, support cosine, split cosine')
+    for ratio in args.ratios:
+        model.set_token_merging((0., ratio, ratio))
+        with amp_autocast(args.amp, device):
+            query = throughput(lambda x: model(x), image, args.iters)
+            support = throughput(lambda x: model.forward_with_semantic_prompt_channel(x, text), image, args.iters)
+            with torch.no_grad():
+                query_cos = F.cosine_similarity(model(image)[1].float(), reference[0], dim=-1).mean().item()
+                support_cos = F.cosine_similarity(model.forward_with_semantic_prompt_channel(image, text)[1].float(),
+                                                  reference[1], dim=-1).mean().item()
+                split_cos = F.cosine_similarity(model.forward_exits(image)[-1].float(),
+                                                model(image)[1].reshape(len(image), -1).float(), dim=-1).mean().item()
+        print(f'{ratio:.2f}, {query:.1f}, {support:.1f}, {query_cos:.4f}, {support_cos:.4f}, {split_cos:.4f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--init', type=str, default='', help='meta-tuned checkpoint, random weights without it')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--amp', type=str, default='off', choices=['off', 'bf16', 'fp16'])
+    parser.add_argument('--image_size', type=int, default=224, choices=[224, 84])
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--ratios', type=float, nargs='+', default=[0., 0.1, 0.2, 0.3, 0.4])
+    parser.add_argument('--prompt_mode', type=str, default='spatial+channel', choices=['spatial', 'channel', 'spatial+channel'])
+    parser.add_argument('--stage', type=float, default=3.2, choices=[2, 2.1, 2.2, 2.3, 3, 3.1, 3.2, 3.3])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,174 @@
+import os
+import copy
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+
+from export_onnx import build_model, add_model_args
+
+# everything build_model needs, the rest of the training namespace is not kept
+MODEL_KEYS = ['model', 'num_classes', 'nlp_model', 'stage', 'prompt_mode', 'projector', 'avg']
+# the prompt heads run in fp32 (visformer.fp32_region) whatever dtype the rest of the student is loaded in
+FP32_MODULES = ['t2i', 't2i2', 'se_block']
+
+
+class InferenceBundle(object):
+    """A student restored from a bundle, with the class text table already projected to prompts.
+
+    Classes are addressed by their row in `classes`. No text encoder and no training arguments are needed.
+    """
+
+    def __init__(self, model, prompt1, prompt2, classes, config):
+        self.model = model
+        self.prompt1 = prompt1
+        self.prompt2 = prompt2
+        self.classes = classes
+        self.config = config
+        self.device = next(model.parameters()).device
+        self.dtype = next(model.parameters()).dtype
+
+    def transform(self):
+        # the test transform of the training scripts
+        from torchvision import transforms
+        preprocess = self.config['preprocess']
+        steps = [transforms.Resize(preprocess['resize']), transforms.CenterCrop(preprocess['crop']), transforms.ToTensor()]
+        if preprocess['mean'] is not None:
+            steps.append(transforms.Normalize(preprocess['mean'], preprocess['std']))
+        return transforms.Compose(steps)
+
+    def prompts(self, labels):
+        labels = labels.to(self.device)
+        prompt1 = self.prompt1[labels] if self.prompt1 is not None else None
+        prompt2 = self.prompt2[labels] if self.prompt2 is not None else None
+        return prompt1, prompt2
+
+    @torch.no_grad()
+    def query_features(self, images):
+        _, feature = self.model(images.to(self.device, self.dtype))
+        return feature.reshape(images.shape[0], -1).float()
+
+    @torch.no_grad()
+    def support_features(self, images, labels):
+        prompt1, prompt2 = self.prompts(labels)
+        _, feature = self.model.forward_with_projected_prompt(images.to(self.device, self.dtype), prompt1, prompt2)
+        return feature.reshape(images.shape[0], -1).float()
+
+    @torch.no_grad()
+    def classify(self, support, labels, query):
+        """Nearest prototype by cosine. Returns the class row (as in `labels`) of every query image."""
+        ways = labels.unique()
+        features = self.support_features(support, labels)
+        labels = labels.to(features.device)
+        prototypes = torch.stack([features[labels == c].mean(0) for c in ways.to(features.device)])
+        sim = F.normalize(self.query_features(query), dim=-1) @ F.normalize(prototypes, dim=-1).t()
+        return ways.to(sim.device)[sim.argmax(-1)]
+
+
+@torch.no_grad()
+def export_bundle(model, text, classes, config, path, fuse=True, half=False):
+    """Pack the student, the projected prompts of `text` [num_classes, text_dim] and config into one file.
+
+    config holds the MODEL_KEYS and 'preprocess' (resize, crop, mean, std). text is used as given, so it
+    should already be eqnorm scaled. With fuse the BatchNorms of a copy of model are folded first, with half
+    the floating point tensors are stored as fp16.
+    """
+    model = copy.deepcopy(model).eval()
+    prompt1, prompt2 = model.project_semantic_prompt(text.float())
+    if fuse:
+        model.fuse_for_inference()
+
+    def pack(x):
+        if x is None:
+            return None
+        x = x.detach().cpu()
+        return x.half() if half and x.is_floating_point() else x
+
+    bundle = {
+        'config': dict(config, fused=fuse),
+        'state_dict': {k: pack(v) for k, v in model.state_dict().items()},
+        'prompt1': pack(prompt1),
+        'prompt2': pack(prompt2),
+        'text': pack(text),
+        'classes': list(classes),
+    }
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    torch.save(bundle, tmp)
+    os.replace(tmp, path)
+    return bundle
+
+
+def load_bundle(path, device='cpu', dtype=torch.float32):
+    """Rebuild a ready-to-run InferenceBundle from an export_bundle file.
+
+    The student is cast to dtype except for the FP32_MODULES, the prompts are always kept in fp32.
+    """
+    bundle = torch.load(path, map_location='cpu', weights_only=True)
+    config = bundle['config']
+    model, _ = build_model(argparse.Namespace(init='', **{k: config[k] for k in MODEL_KEYS}))
+    if config['fused']:
+        # same module structure as at export, the random weights are overwritten below
+        model.fuse_for_inference()
+    model.load_state_dict(bundle['state_dict'])
+    model = model.to(device, dtype).eval()
+    for name in FP32_MODULES:
+        if hasattr(model, name):
+            getattr(model, name).float()
+
+    def unpack(x):
+        return x.to(device, torch.float32) if x is not None else None
+
+    return InferenceBundle(model, unpack(bundle['prompt1']), unpack(bundle['prompt2']), bundle['classes'], config)
+
+
+def main(args):
+    # the text encoder and the datasets are only needed here, never at load time
+    from data.dataset import DatasetWithTextLabel
+    from quantize import load_text_features
+
+    args.teacher_device = f'cuda:{args.gpu}' if args.gpu >= 0 and torch.cuda.is_available() else 'cpu'
+    train_dataset = DatasetWithTextLabel(args.dataset, None, split='train')
+    dataset = DatasetWithTextLabel(args.dataset, None, split=args.split) if args.split != 'train' else train_dataset
+    args.num_classes = len(train_dataset.dataset.classes)
+    _, text = load_text_features(train_dataset, dataset, args)
+    classes = [dataset.idx2text[idx] for idx in dataset.dataset.classes]
+
+    model, _ = build_model(args)
+    config = {k: getattr(args, k) for k in MODEL_KEYS}
+    config['preprocess'] = {'resize': int(args.image_size * 1.1), 'crop': args.image_size, 'mean': None, 'std': None}
+    export_bundle(model, text, classes, config, args.output, fuse=not args.no_fuse, half=args.half)
+    print(f'export {args.output}: {len(classes)} classes, {os.path.getsize(args.output) / 2 ** 20:.1f} MB')
+
+    if args.check:
+        # export_bundle fused a copy, model is still the unfused checkpoint
+        image = torch.randn(args.batch_size, 3, args.image_size, args.image_size)
+        labels = torch.arange(args.batch_size) % len(classes)
+        with torch.no_grad():
+            _, query = model(image)
+            _, support = model.forward_with_semantic_prompt_channel(image, text[labels])
+        query, support = query.reshape(len(image), -1), support.reshape(len(image), -1)
+        # fp16 convolutions need cuda on older torch versions
+        half_device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        for device, dtype in [('cpu', torch.float32), (half_device, torch.float16)]:
+            start = time.time()
+            bundle = load_bundle(args.output, device, dtype)
+            print(f'load_bundle {device} {dtype} {(time.time() - start) * 1000:.0f}ms')
+            query_diff = (query - bundle.query_features(image).cpu()).abs().max() / query.abs().max()
+            support_diff = (support - bundle.support_features(image, labels).cpu()).abs().max() / support.abs().max()
+            print(f'max relative diff to the checkpoint: query {query_diff:.2e}, support {support_diff:.2e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--init', type=str, required=True, help='meta-tuned checkpoint (train_vit_sp.py)')
+    parser.add_argument('--output', type=str, default='checkpoint/bundle/student.pth')
+    parser.add_argument('--no_fuse', action='store_true', help='keep the BatchNorms unfolded')
+    parser.add_argument('--half', action='store_true', help='store fp16 weights and prompts')
+    parser.add_argument('--check', action='store_true', help='reload the bundle in fp32 and fp16 and compare against the checkpoint')
+    parser.add_argument('--batch_size', type=int, default=10)
+    parser.add_argument('--gpu', type=int, default=0, help='device of the text encoder, -1 for cpu')
+    add_model_args(parser, text=True)
+    parser.add_argument('--image_size', type=int, default=224, choices=[224, 84])
+    args = parser.parse_args()
+    main(args)
@@ -1,5 +1,7 @@
 import hashlib
+import inspect
 import os
+import pickle
 import urllib
 import warnings
 from typing import Any, Union, List
@@ -9,7 +11,7 @@ from PIL import Image
 from torchvision.transforms import Compose, Resize, CenterCrop, ToTensor, Normalize
 from tqdm import tqdm
 
-from .model import build_model
+from .model import build_model, build_text_model
 from .simple_tokenizer import SimpleTokenizer as _Tokenizer
 
 try:
@@ -23,8 +25,18 @@ if torch.__version__.split(".") < ["1", "7", "1"]:
     warnings.warn("PyTorch version 1.7.1 or higher is recommended")
 
 
-__all__ = ["available_models", "load", "tokenize"]
-_tokenizer = _Tokenizer()
+__all__ = ["available_models", "load", "load_text_encoder", "tokenize"]
+# torch >= 2.1 can load_state_dict by assigning the (memory-mapped) tensors instead of copying them
+_ASSIGN = "assign" in inspect.signature(torch.nn.Module.load_state_dict).parameters
+_tokenizer = None
+
+
+def _get_tokenizer():
+    # the bpe vocab is only parsed on the first tokenize() call, importing clip stays cheap
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = _Tokenizer()
+    return _tokenizer
 
 _MODELS = {
     "RN50": "https://openaipublic.azureedge.net/clip/models/afeb0e10f9e5a86da6080e35cf09123aca3b358a0c3e3b6c78a7b63bc04b6762/RN50.pt",
@@ -112,30 +124,23 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
     preprocess : Callable[[PIL.Image], torch.Tensor]
         A torchvision transform that converts a PIL image into a tensor that the returned model can take as its input
     """
-    if name in _MODELS:
-        model_path = _download(_MODELS[name], download_root or os.path.expanduser("~/.cache/clip"))
-    elif os.path.isfile(name):
-        model_path = name
-    else:
-        raise RuntimeError(f"Model {name} not found; available models = {available_models()}")
-
-    try:
-        # loading JIT archive
-        model = torch.jit.load(model_path, map_location=device if jit else "cpu").eval()
-        state_dict = None
-    except RuntimeError:
-        # loading saved state dict
-        if jit:
-            warnings.warn(f"File {model_path} is not a JIT archive. Loading as a state dict instead")
-            jit = False
-        state_dict = torch.load(model_path, map_location="cpu")
+    model_path = _model_path(name, download_root)
 
     if not jit:
-        model = build_model(state_dict or model.state_dict()).to(device)
+        # cpu models end up in float32, keep a float32 copy of the weights so they are used without conversion
+        dtype = torch.float32 if str(device) == "cpu" else None
+        model = build_model(_load_state_dict(model_path, dtype, download_root), assign=_ASSIGN).to(device)
         if str(device) == "cpu":
             model.float()
         return model, _transform(model.visual.input_resolution)
 
+    try:
+        # loading JIT archive
+        model = torch.jit.load(model_path, map_location=device).eval()
+    except RuntimeError:
+        warnings.warn(f"File {model_path} is not a JIT archive. Loading as a state dict instead")
+        return load(model_path, device, jit=False, download_root=download_root)
+
     # patch the device names
     device_holder = torch.jit.trace(lambda: torch.ones([]).to(torch.device(device)), example_inputs=[])
     device_node = [n for n in device_holder.graph.findAllNodes("prim::Constant") if "Device" in repr(n)][-1]
@@ -189,6 +194,96 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
     return model, _transform(model.input_resolution.item())
 
 
+def _model_path(name: str, download_root: str = None):
+    if name in _MODELS:
+        return _download(_MODELS[name], download_root or os.path.expanduser("~/.cache/clip"))
+    elif os.path.isfile(name):
+        return name
+    else:
+        raise RuntimeError(f"Model {name} not found; available models = {available_models()}")
+
+
+def _read_checkpoint(model_path: str):
+    try:
+        # loading JIT archive
+        return torch.jit.load(model_path, map_location="cpu").state_dict()
+    except RuntimeError:
+        # loading saved state dict
+        return torch.load(model_path, map_location="cpu")
+
+
+def _converted_path(model_path: str, dtype: str, download_root: str = None):
+    root = os.path.join(download_root or os.path.expanduser("~/.cache/clip"), "converted")
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(root, f"{stem}-{dtype}.pt")
+
+
+def _load_state_dict(model_path: str, dtype: torch.dtype = None, download_root: str = None):
+    """The state_dict of a checkpoint, floating tensors cast to dtype or kept as stored when dtype is None.
+
+    The first call writes it to a flat converted-weights file (one per checkpoint and dtype); later calls
+    memory-map that file, so no JIT archive is parsed and no tensor is read before it is used. The file
+    remembers the path, size and mtime of the checkpoint and is rebuilt when they change.
+    """
+    stat = os.stat(model_path)
+    source = [os.path.abspath(model_path), stat.st_size, stat.st_mtime]
+    cache_file = _converted_path(model_path, str(dtype).replace("torch.", "") if dtype else "native", download_root)
+    if os.path.isfile(cache_file):
+        try:
+            try:
+                cached = torch.load(cache_file, map_location="cpu", mmap=True, weights_only=True)
+            except TypeError:
+                # torch < 2.1 has no mmap
+                cached = torch.load(cache_file, map_location="cpu")
+            if cached["source"] == source:
+                return cached["state_dict"]
+        except (RuntimeError, OSError, KeyError, EOFError, pickle.UnpicklingError):
+            pass
+
+    state_dict = _read_checkpoint(model_path)
+    if dtype is not None:
+        state_dict = {k: v.to(dtype) if v.is_floating_point() else v for k, v in state_dict.items()}
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        # write then rename, jobs started together may convert the same checkpoint
+        tmp = f"{cache_file}.{os.getpid()}.tmp"
+        torch.save({"source": source, "state_dict": {k: v.contiguous() for k, v in state_dict.items()}}, tmp)
+        os.replace(tmp, cache_file)
+    except OSError:
+        pass
+    return state_dict
+
+
+def load_text_encoder(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_available() else "cpu", context_length: int = None, download_root: str = None):
+    """Load only the text tower of a CLIP model
+
+    Parameters
+    ----------
+    name : str
+        A model name listed by `clip.available_models()`, or the path to a model checkpoint containing the state_dict
+
+    device : Union[str, torch.device]
+        The device to put the loaded model
+
+    context_length : int
+        Number of positions to keep, None or -1 keeps the full context of the checkpoint (77)
+
+    download_root: str
+        path to download the model files; by default, it uses "~/.cache/clip"
+
+    Returns
+    -------
+    model : torch.nn.Module
+        A CLIPTextEncoder with `encode_text`, the visual tower is never built
+    """
+    dtype = torch.float32 if str(device) == "cpu" else None
+    state_dict = _load_state_dict(_model_path(name, download_root), dtype, download_root)
+    model = build_text_model(state_dict, context_length, assign=_ASSIGN).to(device)
+    if str(device) == "cpu":
+        model.float()
+    return model
+
+
 def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: bool = False) -> torch.LongTensor:
     """
     Returns the tokenized representation of given input string(s)
@@ -211,9 +306,10 @@ def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: b
     if isinstance(texts, str):
         texts = [texts]
 
-    sot_token = _tokenizer.encoder["<|startoftext|>"]
-    eot_token = _tokenizer.encoder["<|endoftext|>"]
-    all_tokens = [[sot_token] + _tokenizer.encode(text) + [eot_token] for text in texts]
+    tokenizer = _get_tokenizer()
+    sot_token = tokenizer.encoder["<|startoftext|>"]
+    eot_token = tokenizer.encoder["<|endoftext|>"]
+    all_tokens = [[sot_token] + tokens + [eot_token] for tokens in tokenizer.encode_batch(texts)]
     result = torch.zeros(len(all_tokens), context_length, dtype=torch.long)
 
     for i, tokens in enumerate(all_tokens):
@@ -180,7 +180,9 @@ class ResidualAttentionBlock(nn.Module):
 
     def attention(self, x: torch.Tensor):
         self.attn_mask = self.attn_mask.to(dtype=x.dtype, device=x.device) if self.attn_mask is not None else None
-        return self.attn(x, x, x, need_weights=False, attn_mask=self.attn_mask)[0]
+        # sequences trimmed below the context length use the top-left block of the causal mask
+        attn_mask = self.attn_mask[:x.shape[0], :x.shape[0]] if self.attn_mask is not None else None
+        return self.attn(x, x, x, need_weights=False, attn_mask=attn_mask)[0]
 
     def forward(self, x: torch.Tensor):
         x = x + self.attention(self.ln_1(x))
@@ -368,6 +370,66 @@ class CLIP(nn.Module):
         return logits_per_image, logits_per_text
 
 
+class CLIPTextEncoder(nn.Module):
+    """The text tower of CLIP: token embedding, transformer, ln_final and text_projection, no visual model.
+
+    encode_text matches CLIP.encode_text on the first context_length tokens, and trims every batch to its
+    longest eot position since the causal mask keeps later (padding) tokens from reaching the eot feature.
+    """
+
+    def __init__(self,
+                 embed_dim: int,
+                 context_length: int,
+                 vocab_size: int,
+                 transformer_width: int,
+                 transformer_heads: int,
+                 transformer_layers: int
+                 ):
+        super().__init__()
+
+        self.context_length = context_length
+
+        self.transformer = Transformer(
+            width=transformer_width,
+            layers=transformer_layers,
+            heads=transformer_heads,
+            attn_mask=self.build_attention_mask()
+        )
+
+        self.vocab_size = vocab_size
+        self.token_embedding = nn.Embedding(vocab_size, transformer_width)
+        self.positional_embedding = nn.Parameter(torch.empty(self.context_length, transformer_width))
+        self.ln_final = LayerNorm(transformer_width)
+
+        self.text_projection = nn.Parameter(torch.empty(transformer_width, embed_dim))
+
+    build_attention_mask = CLIP.build_attention_mask
+
+    @property
+    def dtype(self):
+        return self.text_projection.dtype
+
+    def encode_text(self, text):
+        text = text[:, :self.context_length]
+        eot = text.argmax(dim=-1)
+        text = text[:, :int(eot.max()) + 1]
+        x = self.token_embedding(text).type(self.dtype)  # [batch_size, n_ctx, d_model]
+
+        x = x + self.positional_embedding[:text.shape[1]].type(self.dtype)
+        x = x.permute(1, 0, 2)  # NLD -> LND
+        x = self.transformer(x)
+        x = x.permute(1, 0, 2)  # LND -> NLD
+        x = self.ln_final(x).type(self.dtype)
+
+        # take features from the eot embedding (eot_token is the highest number in each sequence)
+        x = x[torch.arange(x.shape[0]), eot] @ self.text_projection
+
+        return x
+
+    def forward(self, text):
+        return self.encode_text(text)
+
+
 def convert_weights(model: nn.Module):
     """Convert applicable model parameters to fp16"""
 
@@ -392,7 +454,25 @@ def convert_weights(model: nn.Module):
     model.apply(_convert_weights_to_fp16)
 
 
-def build_model(state_dict: dict):
+def _assign_weights(model: nn.Module, state_dict: dict):
+    """load_state_dict by taking the tensors of state_dict as the parameters, model was built on the meta device.
+
+    A float32 state_dict is taken as is. Otherwise tensors are cast to the dtypes convert_weights gives (fp16
+    linear / attention weights, fp32 embeddings and LayerNorms), only the ones that differ are copied.
+    """
+    if any(v.is_floating_point() and v.dtype != torch.float32 for v in state_dict.values()):
+        convert_weights(model)
+        expected = model.state_dict()
+        state_dict = {k: v.to(expected[k].dtype) if k in expected and v.is_floating_point() else v
+                      for k, v in state_dict.items()}
+    model.load_state_dict(state_dict, assign=True)
+    # the causal mask is a plain attribute, not part of the state_dict
+    attn_mask = model.build_attention_mask()
+    for block in model.transformer.resblocks:
+        block.attn_mask = attn_mask
+
+
+def build_model(state_dict: dict, assign: bool = False):
     vit = "visual.proj" in state_dict
 
     if vit:
@@ -417,16 +497,61 @@ def build_model(state_dict: dict):
     transformer_heads = transformer_width // 64
     transformer_layers = len(set(k.split(".")[2] for k in state_dict if k.startswith(f"transformer.resblocks")))
 
+    for key in ["input_resolution", "context_length", "vocab_size"]:
+        if key in state_dict:
+            del state_dict[key]
+
+    if assign:
+        # no random init and no copy, the parameters are the (memory-mapped) tensors of state_dict
+        with torch.device("meta"):
+            model = CLIP(
+                embed_dim,
+                image_resolution, vision_layers, vision_width, vision_patch_size,
+                context_length, vocab_size, transformer_width, transformer_heads, transformer_layers
+            )
+        _assign_weights(model, state_dict)
+        return model.eval()
+
     model = CLIP(
         embed_dim,
         image_resolution, vision_layers, vision_width, vision_patch_size,
         context_length, vocab_size, transformer_width, transformer_heads, transformer_layers
     )
 
-    for key in ["input_resolution", "context_length", "vocab_size"]:
-        if key in state_dict:
-            del state_dict[key]
-
     convert_weights(model)
     model.load_state_dict(state_dict)
     return model.eval()
+
+
+def build_text_model(state_dict: dict, context_length: int = None, assign: bool = False):
+    """Build a CLIPTextEncoder from a full CLIP state_dict, keeping the first context_length positions."""
+    embed_dim = state_dict["text_projection"].shape[1]
+    vocab_size = state_dict["token_embedding.weight"].shape[0]
+    transformer_width = state_dict["ln_final.weight"].shape[0]
+    transformer_heads = transformer_width // 64
+    transformer_layers = len(set(k.split(".")[2] for k in state_dict if k.startswith(f"transformer.resblocks")))
+    full_length = state_dict["positional_embedding"].shape[0]
+    if context_length is None or context_length == -1:
+        context_length = full_length
+    if not 0 < context_length <= full_length:
+        raise ValueError(f"context_length must be in [1, {full_length}], got {context_length}")
+
+    text_state = {k: v for k, v in state_dict.items()
+                  if k.split(".")[0] in ["token_embedding", "positional_embedding", "transformer", "ln_final", "text_projection"]}
+    text_state["positional_embedding"] = text_state["positional_embedding"][:context_length]
+
+    if assign:
+        with torch.device("meta"):
+            model = CLIPTextEncoder(
+                embed_dim, context_length, vocab_size, transformer_width, transformer_heads, transformer_layers
+            )
+        _assign_weights(model, text_state)
+        return model.eval()
+
+    model = CLIPTextEncoder(
+        embed_dim, context_length, vocab_size, transformer_width, transformer_heads, transformer_layers
+    )
+
+    convert_weights(model)
+    model.load_state_dict(text_state)
+    return model.eval()
@@ -1,6 +1,7 @@
 import gzip
 import html
 import os
+import pickle
 from functools import lru_cache
 
 import ftfy
@@ -59,73 +60,118 @@ def whitespace_clean(text):
     return text
 
 
+def _vocab_cache_file(bpe_path):
+    # the parsed vocab is written next to the other clip downloads, the package dir may be read only
+    root = os.environ.get("CLIP_CACHE", os.path.expanduser("~/.cache/clip"))
+    return os.path.join(root, os.path.basename(bpe_path) + ".vocab.pkl")
+
+
+def load_vocab(bpe_path: str = default_bpe()):
+    """Return (merges, vocab) of the bpe file, parsed once and then read back from a pickle.
+
+    The pickle remembers the size and mtime of the source file and is rebuilt when they change.
+    """
+    stat = os.stat(bpe_path)
+    source = (os.path.abspath(bpe_path), stat.st_size, stat.st_mtime)
+    cache_file = _vocab_cache_file(bpe_path)
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file, "rb") as f:
+                cached = pickle.load(f)
+            if cached["source"] == source:
+                return cached["merges"], cached["vocab"]
+        except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+            pass
+
+    merges = gzip.open(bpe_path).read().decode("utf-8").split('\n')
+    merges = merges[1:49152-256-2+1]
+    merges = [tuple(merge.split()) for merge in merges]
+    vocab = list(bytes_to_unicode().values())
+    vocab = vocab + [v+'</w>' for v in vocab]
+    for merge in merges:
+        vocab.append(''.join(merge))
+    vocab.extend(['<|startoftext|>', '<|endoftext|>'])
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        # write then rename, several scripts may build the cache at the same time
+        tmp = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump({"source": source, "merges": merges, "vocab": vocab}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_file)
+    except OSError:
+        pass
+    return merges, vocab
+
+
 class SimpleTokenizer(object):
-    def __init__(self, bpe_path: str = default_bpe()):
+    def __init__(self, bpe_path: str = default_bpe(), cache_size: int = 100000):
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
-        merges = gzip.open(bpe_path).read().decode("utf-8").split('\n')
-        merges = merges[1:49152-256-2+1]
-        merges = [tuple(merge.split()) for merge in merges]
-        vocab = list(bytes_to_unicode().values())
-        vocab = vocab + [v+'</w>' for v in vocab]
-        for merge in merges:
-            vocab.append(''.join(merge))
-        vocab.extend(['<|startoftext|>', '<|endoftext|>'])
+        merges, vocab = load_vocab(bpe_path)
         self.encoder = dict(zip(vocab, range(len(vocab))))
         self.decoder = {v: k for k, v in self.encoder.items()}
         self.bpe_ranks = dict(zip(merges, range(len(merges))))
-        self.cache = {'<|startoftext|>': '<|startoftext|>', '<|endoftext|>': '<|endoftext|>'}
+        self.special = {'<|startoftext|>': '<|startoftext|>', '<|endoftext|>': '<|endoftext|>'}
+        # word -> bpe string, shared by every encode call and dropped once it holds cache_size words
+        self.cache_size = cache_size
+        self.cache = dict(self.special)
         self.pat = re.compile(r"""<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""", re.IGNORECASE)
 
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token[:-1]) + ( token[-1] + '</w>',)
-        pairs = get_pairs(word)
-
-        if not pairs:
-            return token+'</w>'
-
-        while True:
-            bigram = min(pairs, key = lambda pair: self.bpe_ranks.get(pair, float('inf')))
-            if bigram not in self.bpe_ranks:
+        cached = self.cache.get(token)
+        if cached is not None:
+            return cached
+        word = list(token[:-1]) + [token[-1] + '</w>']
+        ranks = self.bpe_ranks
+        inf = len(ranks)
+
+        # merge the lowest ranked adjacent pair until none is left, scanning the word in place
+        while len(word) > 1:
+            best, best_rank = None, inf
+            for pair in zip(word, word[1:]):
+                rank = ranks.get(pair, inf)
+                if rank < best_rank:
+                    best, best_rank = pair, rank
+            if best is None:
                 break
-            first, second = bigram
+            first, second = best
+            merged = first + second
             new_word = []
             i = 0
             while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word)-1 and word[i+1] == second:
-                    new_word.append(first+second)
+                if i < len(word)-1 and word[i] == first and word[i+1] == second:
+                    new_word.append(merged)
                     i += 2
                 else:
                     new_word.append(word[i])
                     i += 1
-            new_word = tuple(new_word)
             word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
         word = ' '.join(word)
+        if len(self.cache) >= self.cache_size:
+            self.cache = dict(self.special)
         self.cache[token] = word
         return word
 
-    def encode(self, text):
+    def encode(self, text, words=None):
+        # words: optional word -> token ids table filled and reused across calls (encode_batch)
         bpe_tokens = []
         text = whitespace_clean(basic_clean(text)).lower()
         for token in re.findall(self.pat, text):
-            token = ''.join(self.byte_encoder[b] for b in token.encode('utf-8'))
-            bpe_tokens.extend(self.encoder[bpe_token] for bpe_token in self.bpe(token).split(' '))
+            ids = words.get(token) if words is not None else None
+            if ids is None:
+                byte_token = ''.join(self.byte_encoder[b] for b in token.encode('utf-8'))
+                ids = [self.encoder[bpe_token] for bpe_token in self.bpe(byte_token).split(' ')]
+                if words is not None:
+                    words[token] = ids
+            bpe_tokens.extend(ids)
         return bpe_tokens
 
+    def encode_batch(self, texts):
+        """Token ids of every text, words repeated across the batch go through bpe() once."""
+        # unlike self.cache, the batch table is never dropped halfway through the batch
+        words = {}
+        return [self.encode(text, words) for text in texts]
+
     def decode(self, tokens):
         text = ''.join([self.decoder[token] for token in tokens])
         text = bytearray([self.byte_decoder[c] for c in text]).decode('utf-8', errors="replace").replace('</w>', ' ')
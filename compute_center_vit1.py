@@ -7,8 +7,9 @@ from tqdm import tqdm
 import torch.utils.data
 import os
 import visformer_vis
-import clip
+from text_cache import LazyTeacher, TextFeatureCache, TEXT_DIM
 from utils import cluster, transform_val_224_cifar, transform_val_224
+from microbatch import MicroBatcher
 from data.dataset import DatasetWithTextLabel, aug_DatasetWithTextLabel
 import torchvision.transforms as transforms
 def main():
@@ -20,12 +21,9 @@ def main():
     if not os.path.exists(dir_path):
         # 如果文件夹不存在，则创建它
         os.makedirs(dir_path)
-    teacher, _ = clip.load("ViT-B/32", device='cuda:1')
-    text_dim = 512
-    teacher.context_length = args.text_length
-    teacher.positional_embedding.data = teacher.positional_embedding.data[:args.text_length]
-    for layer in teacher.transformer.resblocks:
-        layer.attn_mask.data = layer.attn_mask.data[:args.text_length, :args.text_length]
+    teacher = LazyTeacher('clip', args.text_length, 'cuda:1')
+    text_dim = TEXT_DIM['clip']
+    text_cache = TextFeatureCache(args.text_cache)
 
 
 
@@ -35,10 +33,11 @@ def main():
                                     transforms.ToTensor(),
                                     norm])
     train_dataset = DatasetWithTextLabel(args.dataset, train_aug, split='train')
-    train_text = get_text_feature(teacher, train_dataset, args)
+    train_text = text_cache(get_text_feature, teacher, train_dataset, args)
     num_classes = len(train_dataset.dataset.classes)
     # 加载student模型
-    student = visformer_vis.visformer_tiny(num_classes=num_classes)
+    student = visformer_vis.visformer_tiny(num_classes=num_classes, prompt_stage=args.stage,
+                                           prompt_mode=args.prompt_mode, prompt_avg=args.avg)
     feature_dim = 384
     if 2 <= args.stage < 3:
         feature_dim = 192
@@ -74,7 +73,8 @@ def main():
     student.eval()
 
     data = {}
-    batch_size = 128
+    batch_size = args.batch_size
+    micro_batch = MicroBatcher(args.chunk_size, args.memory_budget)
     shuffle = True
     # train
     if args.dataset == 'miniImageNet':
@@ -109,7 +109,7 @@ def main():
 
         with torch.no_grad():
             # 假设 forward_with_semantic_prompt_channel 需要一个标签列表和对应的文本特征
-            _ , im_features = student.forward_with_semantic_prompt_channel(images, text_features, args)
+            _ , im_features = micro_batch(student.forward_with_semantic_prompt_channel, images, text_features, args)
 
         # 将特征存储到数据字典中
         for i, glabel in enumerate(glabels):
@@ -154,6 +154,7 @@ def get_text_feature(teacher, dataset, args):
     # 判断使用哪个模型
     if args.nlp_model == 'clip':
         # 若使用clip模型，则对文本进行tokenize，并转换为cuda设备
+        import clip
         text_token = clip.tokenize(text).cuda(args.gpu)
         # 判断文本长度是否为-1
         if args.text_length != -1:
@@ -201,6 +202,9 @@ if __name__ == '__main__':
     parser.add_argument('--weight_decay', type=float, default=5e-2)
     parser.add_argument('--encoder_lr', type=float, default=1e-6)
     parser.add_argument('--text_length', type=int, default=20)
+    parser.add_argument('--text_cache', type=str, default='text_cache', help='class text feature cache dir, empty to disable')
+    parser.add_argument('--templates', type=str, nargs='+', default=None,
+                        help="class text templates with {} for the name, averaged per class ('ensemble' for the built-in set), overrides --no_template")
     parser.add_argument('--resume', type=str, default='checkpoint/miniImageNet/visformer-t/test/checkpoint_epoch_003_better_exp1.pth')
     parser.add_argument('--train_episodes', type=int, default=-1)
     parser.add_argument('--episodes', type=int, default=200)
@@ -209,6 +213,9 @@ if __name__ == '__main__':
     parser.add_argument('--test', action='store_true')
     parser.add_argument('--test_freq', type=int, default=1)
     parser.add_argument('--save_freq', type=int, default=20)
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--chunk_size', type=int, default=0, help='micro-batch size of the forward, 0 to probe it on cuda')
+    parser.add_argument('--memory_budget', type=float, default=0, help='GB for the probed micro-batch, 0 for 80%% of free memory')
     args = parser.parse_args()
     print(vars(args))
     main()
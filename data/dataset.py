@@ -314,5 +314,35 @@ class aug_Dataset_view_WithTextLabel(object):
         return dataset
 
 
+import random
+import numpy as np
+import torch
 
 
+class SeededViews(object):
+    """(image, index, view) for `views` fixed augmentations of every image of an ImageFolder.
+
+    View v of image i is always the same crop / flip / jitter: the transform runs under a seed derived from
+    (i, v), and the global rng state is restored afterwards.
+    """
+
+    def __init__(self, dataset, views=1, seed=0):
+        self.dataset = dataset
+        self.views = views
+        self.seed = seed
+
+    def __getitem__(self, i):
+        index, view = divmod(i, self.views)
+        seed = self.seed * len(self) + i
+        state = random.getstate(), np.random.get_state()
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            random.seed(seed)
+            np.random.seed(seed % 2 ** 32)
+            image, _ = self.dataset[index]
+        random.setstate(state[0])
+        np.random.set_state(state[1])
+        return image, index, view
+
+    def __len__(self):
+        return len(self.dataset) * self.views
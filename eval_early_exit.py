@@ -0,0 +1,92 @@
+import time
+import argparse
+import torch
+import torch.utils.data
+import torch.nn.functional as F
+from torchvision import transforms
+
+import visformer
+from data.dataloader import TESTEpisodeSampler
+from data.dataset import DatasetWithTextLabel
+from export_onnx import build_model, add_model_args
+from quantize import load_text_features, split_episode
+from utils import mean_confidence_interval, amp_autocast
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def main(args):
+    # accuracy, average blocks and query latency of the early exit path for every --thresholds value
+    args.teacher_device = args.device
+    device = torch.device(args.device)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    test_aug = transforms.Compose([transforms.Resize(int(args.image_size * 1.1)),
+                                   transforms.CenterCrop(args.image_size),
+                                   transforms.ToTensor()
+                                   ])
+    train_dataset = DatasetWithTextLabel(args.dataset, test_aug, split='train')
+    test_dataset = DatasetWithTextLabel(args.dataset, test_aug, split=args.split)
+    test_sampler = TESTEpisodeSampler(test_dataset.dataset.targets, args.episodes, args.way, args.shot + 15)
+    test_loader = torch.utils.data.DataLoader(test_dataset, batch_sampler=test_sampler, num_workers=args.num_workers)
+    args.num_classes = len(train_dataset.dataset.classes)
+    _, test_text = load_text_features(train_dataset, test_dataset, args)
+    test_text = test_text.to(device)
+
+    student, _ = build_model(args)
+    visformer.add_exit_heads(student)
+    student.exit_heads.load_state_dict(torch.load(args.exits, map_location='cpu')['state_dict'])
+    student = student.to(device).eval()
+    total_blocks = sum(n for n, _, _ in student.exit_segments())
+    labels = torch.arange(args.way).unsqueeze(-1).repeat(1, 15).view(-1).to(device)
+
+    thresholds = [float('inf')] + args.thresholds
+    accs = {t: [] for t in thresholds}
+    blocks = {t: 0. for t in thresholds}
+    elapsed = {t: 0. for t in thresholds}
+    with torch.no_grad(), amp_autocast(args.amp, device):
+        for i, episode in enumerate(test_loader):
+            sup, que, glabels = split_episode(episode, args)
+            sup, que = sup.to(device), que.to(device)
+            _, sup_im_features = student.forward_with_semantic_prompt_channel(sup, test_text[glabels.to(device)])
+            prototypes = sup_im_features.float().view(args.way, args.shot, -1).mean(dim=1)
+
+            for threshold in thresholds:
+                synchronize(device)
+                start = time.time()
+                que_im_features, que_blocks = student.forward_early_exit(que, prototypes, threshold)
+                synchronize(device)
+                if i > 0:
+                    elapsed[threshold] += time.time() - start
+                sim = F.normalize(que_im_features, dim=-1) @ F.normalize(prototypes, dim=-1).t()
+                _, pred = sim.max(-1)
+                accs[threshold].append(labels.eq(pred).sum().float().item() / labels.shape[0])
+                blocks[threshold] += que_blocks.float().mean().item()
+
+    print(f'threshold, acc, ci95, blocks/query (of {total_blocks}), query ms/episode')
+    for threshold in thresholds:
+        m, h = mean_confidence_interval(accs[threshold])
+        ms = elapsed[threshold] / max(len(accs[threshold]) - 1, 1) * 1000
+        name = 'full' if threshold == float('inf') else f'{threshold:.3f}'
+        print(f'{name}, {m * 100:.2f}, {h * 100:.2f}, {blocks[threshold] / len(accs[threshold]):.2f}, {ms:.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--init', type=str, required=True, help='meta-tuned checkpoint (train_vit_sp.py)')
+    parser.add_argument('--exits', type=str, required=True, help='exit heads (train_exit_heads.py)')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0.3, 0.2, 0.1, 0.05])
+    parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--amp', type=str, default='off', choices=['off', 'bf16', 'fp16'])
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--num_workers', type=int, default=4)
+    add_model_args(parser, text=True)
+    parser.add_argument('--image_size', type=int, default=224, choices=[224, 84])
+    parser.add_argument('--way', type=int, default=5)
+    parser.add_argument('--shot', type=int, default=1)
+    parser.add_argument('--episodes', type=int, default=600)
+    args = parser.parse_args()
+    main(args)
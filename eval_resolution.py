@@ -0,0 +1,87 @@
+import time
+import argparse
+import torch
+import torch.utils.data
+import torch.nn.functional as F
+from torchvision import transforms
+
+from data.dataloader import TESTEpisodeSampler
+from data.dataset import DatasetWithTextLabel
+from export_onnx import build_model, add_model_args
+from quantize import load_text_features, split_episode
+from utils import mean_confidence_interval, amp_autocast
+
+
+def main(args):
+    # accuracy vs latency of one checkpoint evaluated at several input resolutions, pos_embed is resized
+    args.teacher_device = args.device
+    device = torch.device(args.device)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    train_dataset = DatasetWithTextLabel(args.dataset, None, split='train')
+    test_dataset = DatasetWithTextLabel(args.dataset, None, split=args.split)
+    args.num_classes = len(train_dataset.dataset.classes)
+    _, test_text = load_text_features(train_dataset, test_dataset, args)
+    test_text = test_text.to(device)
+    student, _ = build_model(args)
+    student.set_token_merging(args.merge_ratio)
+    student = student.to(device)
+
+    results = []
+    for resolution in args.resolutions:
+        test_aug = transforms.Compose([transforms.Resize(int(resolution * 1.1)),
+                                       transforms.CenterCrop(resolution),
+                                       transforms.ToTensor()
+                                       ])
+        test_dataset = DatasetWithTextLabel(args.dataset, test_aug, split=args.split)
+        # fix_seed: every resolution sees the same episodes
+        test_sampler = TESTEpisodeSampler(test_dataset.dataset.targets, args.episodes, args.way, args.shot + 15)
+        test_loader = torch.utils.data.DataLoader(test_dataset, batch_sampler=test_sampler, num_workers=args.num_workers)
+        labels = torch.arange(args.way).unsqueeze(-1).repeat(1, 15).view(-1).to(device)
+
+        accs, elapsed = [], 0.
+        with torch.no_grad(), amp_autocast(args.amp, device):
+            for i, episode in enumerate(test_loader):
+                sup, que, glabels = split_episode(episode, args)
+                sup, que = sup.to(device), que.to(device)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                start = time.time()
+                _, sup_im_features = student.forward_with_semantic_prompt_channel(sup, test_text[glabels.to(device)])
+                _, que_im_features = student(que)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                if i > 0:  # the first episode pays for the pos_embed resize and the kernel warm up
+                    elapsed += time.time() - start
+
+                sup_im_features = sup_im_features.view(args.way, args.shot, -1).mean(dim=1)
+                sim = F.normalize(que_im_features.float(), dim=-1) @ F.normalize(sup_im_features.float(), dim=-1).t()
+                _, pred = sim.max(-1)
+                accs.append(labels.eq(pred).sum().float().item() / labels.shape[0])
+
+        m, h = mean_confidence_interval(accs)
+        ms = elapsed / max(len(accs) - 1, 1) * 1000
+        results.append((resolution, m, h, ms))
+        print(f'{resolution}px: test acc {m * 100:.2f}+-{h * 100:.2f}, {ms:.1f}ms/episode')
+
+    print('resolution, acc, ci95, ms/episode')
+    for resolution, m, h, ms in results:
+        print(f'{resolution}, {m * 100:.2f}, {h * 100:.2f}, {ms:.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--init', type=str, required=True, help='meta-tuned checkpoint (train_vit_sp.py)')
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[224, 192, 160, 128])
+    parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--merge_ratio', type=float, nargs=3, default=[0., 0., 0.],
+                        help='token merging ratio per stage, e.g. 0 0.2 0.2')
+    parser.add_argument('--amp', type=str, default='off', choices=['off', 'bf16', 'fp16'])
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--num_workers', type=int, default=4)
+    add_model_args(parser, text=True)
+    parser.add_argument('--way', type=int, default=5)
+    parser.add_argument('--shot', type=int, default=1)
+    parser.add_argument('--episodes', type=int, default=600)
+    args = parser.parse_args()
+    main(args)
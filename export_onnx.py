@@ -0,0 +1,154 @@
+import os
+import time
+import inspect
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+
+import visformer
+from text_cache import TEXT_DIM
+
+
+class QueryEncoder(nn.Module):
+    # Visformer.forward, image -> feature
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image):
+        _, feature = self.model(image)
+        return feature.reshape(image.shape[0], -1)
+
+
+class SupportEncoder(nn.Module):
+    # forward_with_semantic_prompt_channel including t2i / t2i2 / se_block, (image, text feature) -> feature
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image, text):
+        prompt1, prompt2 = self.model.project_semantic_prompt(text)
+        _, feature = self.model.forward_with_projected_prompt(image, prompt1, prompt2)
+        return feature.reshape(image.shape[0], -1)
+
+
+class ORTEncoder(object):
+    """Runs an exported encoder with ONNX Runtime on CPU. Takes and returns numpy arrays (or cpu tensors)."""
+
+    def __init__(self, path, num_threads=0):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [x.name for x in self.session.get_inputs()]
+
+    def __call__(self, image, text=None):
+        inputs = [image] if text is None else [image, text]
+        feed = {}
+        for name, x in zip(self.input_names, inputs):
+            if isinstance(x, torch.Tensor):
+                x = x.detach().cpu().numpy()
+            feed[name] = np.ascontiguousarray(x, dtype=np.float32)
+        return self.session.run(None, feed)[0]
+
+
+def build_model(args, strict=True):
+    if args.model == 'visformer-t':
+        model = visformer.visformer_tiny(num_classes=args.num_classes, prompt_stage=args.stage,
+                                         prompt_mode=args.prompt_mode, prompt_avg=args.avg)
+    elif args.model == 'visformer-t-84':
+        model = visformer.visformer_tiny_84(num_classes=args.num_classes, prompt_stage=args.stage,
+                                            prompt_mode=args.prompt_mode, prompt_avg=args.avg)
+    else:
+        raise ValueError(f'unknown model: {args.model}')
+    text_dim = TEXT_DIM[args.nlp_model]
+    visformer.add_semantic_heads(model, text_dim, args.projector)
+    if args.init:
+        checkpoint = torch.load(args.init, map_location='cpu')
+        model.load_state_dict(checkpoint['state_dict'], strict=strict)
+    return model.eval(), text_dim
+
+
+def add_model_args(parser, text=False):
+    # the arguments build_model reads, with text also those of the class text features (quantize.load_text_features)
+    parser.add_argument('--model', type=str, default='visformer-t', choices=['visformer-t', 'visformer-t-84'])
+    parser.add_argument('--nlp_model', type=str, default='clip', choices=['clip', 'glove', 'mpnet'])
+    parser.add_argument('--prompt_mode', type=str, default='spatial+channel', choices=['spatial', 'channel', 'spatial+channel'])
+    parser.add_argument('--stage', type=float, default=3.2, choices=[2, 2.1, 2.2, 2.3, 3, 3.1, 3.2, 3.3])
+    parser.add_argument('--projector', type=str, default='linear', choices=['linear', 'mlp', 'mlp3'])
+    parser.add_argument('--avg', type=str, default='all', choices=['all', 'patch', 'head'])
+    if text:
+        parser.add_argument('--dataset', type=str, default='miniImageNet', choices=['miniImageNet', 'tieredImageNet', 'CIFAR-FS', 'FC100'])
+        parser.add_argument('--split', type=str, default='test', choices=['train', 'val', 'test'],
+                            help='classes of the test episodes (bundle.py: whose prompts are packed)')
+        parser.add_argument('--no_template', action='store_true')
+        parser.add_argument('--eqnorm', action='store_true', default=True)
+        parser.add_argument('--text_length', type=int, default=20)
+        parser.add_argument('--text_cache', type=str, default='text_cache', help='class text feature cache dir, empty to disable')
+        parser.add_argument('--templates', type=str, nargs='+', default=None,
+                            help="class text templates with {} for the name, averaged per class ('ensemble' for the built-in set), overrides --no_template")
+
+
+def export(module, inputs, input_names, path, opset):
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False  # dynamic_axes below are for the torchscript exporter
+    dynamic_axes = {name: {0: 'batch'} for name in input_names + ['feature']}
+    torch.onnx.export(module, inputs, path, input_names=input_names, output_names=['feature'],
+                      dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True, **kwargs)
+    print(f'export {path}')
+
+
+def latency(fn, n=10):
+    fn()
+    start = time.time()
+    for _ in range(n):
+        fn()
+    return (time.time() - start) / n * 1000
+
+
+def main(args):
+    torch.set_num_threads(args.threads if args.threads > 0 else torch.get_num_threads())
+    model, text_dim = build_model(args)
+    os.makedirs(args.output_dir, exist_ok=True)
+    query_path = os.path.join(args.output_dir, 'query_encoder.onnx')
+    support_path = os.path.join(args.output_dir, 'support_encoder.onnx')
+
+    # any batch size > 1 works for tracing, the batch axis is dynamic
+    image = torch.randn(2, 3, args.image_size, args.image_size)
+    text = torch.randn(2, text_dim)
+    query_encoder, support_encoder = QueryEncoder(model).eval(), SupportEncoder(model).eval()
+    with torch.no_grad():
+        export(query_encoder, (image,), ['image'], query_path, args.opset)
+        export(support_encoder, (image, text), ['image', 'text'], support_path, args.opset)
+
+    if args.check:
+        ort_query, ort_support = ORTEncoder(query_path, args.threads), ORTEncoder(support_path, args.threads)
+        image = torch.randn(args.batch_size, 3, args.image_size, args.image_size)
+        text = torch.randn(args.batch_size, text_dim)
+        with torch.no_grad():
+            query, support = query_encoder(image).numpy(), support_encoder(image, text).numpy()
+            query_diff = np.abs(query - ort_query(image)).max() / np.abs(query).max()
+            support_diff = np.abs(support - ort_support(image, text)).max() / np.abs(support).max()
+            print(f'max relative diff to torch: query {query_diff:.2e}, support {support_diff:.2e}')
+            print(f'batch {args.batch_size} query latency: torch {latency(lambda: query_encoder(image)):.1f}ms, '
+                  f'onnxruntime {latency(lambda: ort_query(image)):.1f}ms')
+            print(f'batch {args.batch_size} support latency: torch {latency(lambda: support_encoder(image, text)):.1f}ms, '
+                  f'onnxruntime {latency(lambda: ort_support(image, text)):.1f}ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--init', type=str, default='', help='meta-tuned checkpoint (train_vit_sp.py)')
+    parser.add_argument('--output_dir', type=str, default='onnx')
+    parser.add_argument('--num_classes', type=int, default=64)
+    parser.add_argument('--image_size', type=int, default=224, choices=[224, 84])
+    add_model_args(parser)
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--check', action='store_true', help='compare onnxruntime against torch and time both on cpu')
+    parser.add_argument('--batch_size', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=0)
+    args = parser.parse_args()
+    main(args)
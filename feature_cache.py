@@ -0,0 +1,125 @@
+import hashlib
+import os
+
+import torch
+import torch.utils.data
+
+from data.dataset import SeededViews
+from utils import amp_autocast
+
+
+def checkpoint_fingerprint(model):
+    # sha1 over the whole state_dict, so cached features are tied to the exact weights they came from
+    return state_fingerprint(model.state_dict())
+
+
+def state_fingerprint(state):
+    sha = hashlib.sha1()
+    for name, tensor in sorted(state.items()):
+        sha.update(name.encode('utf-8'))
+        sha.update(str(tuple(tensor.shape)).encode('utf-8'))
+        tensor = tensor.detach().cpu().contiguous().reshape(-1)
+        if tensor.numel() > 0:
+            sha.update(tensor.view(torch.uint8).numpy().tobytes())
+    return sha.hexdigest()
+
+
+class SupportFeatureCache(object):
+    """Support embeddings of the prompted forward.
+
+    A support feature only depends on (image, class text, weights, prompt config), so it is keyed by
+    (image index, class index, checkpoint fingerprint, text table fingerprint, prompt config, dataset, image size).
+    The text fingerprint covers everything that shapes the class text (nlp_model, templates, text_length, eqnorm).
+    Only valid for a deterministic test transform and a fixed episode sampler. With `path` the cache is kept on
+    disk and reused across runs.
+    """
+
+    def __init__(self, fingerprint, args, path='', text=None):
+        self.fingerprint = fingerprint
+        self.text_fingerprint = state_fingerprint({'text': text}) if text is not None else None
+        self.prompt_mode = args.prompt_mode
+        self.stage = args.stage
+        self.avg = args.avg
+        self.data = (args.dataset, args.split, args.image_size)
+        self.path = path
+        self.features = {}
+        self.updated = False
+        if path and os.path.isfile(path):
+            self.features = torch.load(path)
+
+    def keys(self, image_idx, class_idx):
+        return [(int(i), int(c), self.fingerprint, self.text_fingerprint, self.prompt_mode, self.stage, self.avg, self.data)
+                for i, c in zip(image_idx.tolist(), class_idx.tolist())]
+
+    def __call__(self, encode, image_idx, class_idx, device):
+        """Return the support features, calling encode(miss) only for the rows that are not cached.
+
+        encode takes a LongTensor of row positions and returns their features.
+        """
+        keys = self.keys(image_idx, class_idx)
+        miss = [i for i, key in enumerate(keys) if key not in self.features]
+        if len(miss) > 0:
+            features = encode(torch.tensor(miss, dtype=torch.long, device=device))
+            features = features.view(len(miss), -1).float().cpu()
+            for i, feature in zip(miss, features):
+                self.features[keys[i]] = feature
+            self.updated = True
+        return torch.stack([self.features[key] for key in keys]).to(device)
+
+    def save(self):
+        if self.path and self.updated:
+            dir_path = os.path.dirname(self.path)
+            if dir_path:
+                os.makedirs(dir_path, exist_ok=True)
+            torch.save(self.features, self.path)
+            self.updated = False
+
+
+class PrefixActivationCache(object):
+    """prefix_features of every training image under a frozen prefix, computed once up front.
+
+    One row per (image index, view): with views > 0 the training transform is drawn with `views` fixed seeds per
+    image (data.dataset.SeededViews), with views == 0 there is a single row per image from a deterministic transform.
+    Rows are kept as float16 on cpu. With `path` they are saved to disk and reused while the prefix weights,
+    prompt stage, image size and views match.
+    """
+
+    def __init__(self, model, dataset, views=0, path='', batch_size=128, num_workers=8, amp='off'):
+        self.views = max(views, 1)
+        self.key = (state_fingerprint(model.prefix_state_dict()), model.prompt_stage, model.prompt_block,
+                    tuple(dataset[0][0].shape), views)
+        if path and os.path.isfile(path):
+            cached = torch.load(path)
+            if cached['key'] == self.key:
+                self.activations = cached['activations']
+                return
+        self.activations = self.build(model, dataset, batch_size, num_workers, amp)
+        if path:
+            dir_path = os.path.dirname(path)
+            if dir_path:
+                os.makedirs(dir_path, exist_ok=True)
+            torch.save({'key': self.key, 'activations': self.activations}, path)
+
+    def build(self, model, dataset, batch_size, num_workers, amp):
+        # eval mode: the frozen prefix uses its BatchNorm running stats, the same as at test time
+        device = next(model.parameters()).device
+        loader = torch.utils.data.DataLoader(SeededViews(dataset, self.views), batch_size=batch_size,
+                                             num_workers=num_workers)
+        activations = None
+        training = model.training
+        model.eval()
+        with torch.no_grad(), amp_autocast(amp, device):
+            for image, index, view in loader:
+                x = model.prefix_features(image.to(device)).half().cpu()
+                if activations is None:
+                    activations = x.new_empty(len(dataset) * self.views, *x.shape[1:])
+                activations[index * self.views + view] = x
+        model.train(training)
+        return activations
+
+    def __call__(self, image_idx, view_idx, device):
+        rows = image_idx.cpu() * self.views + view_idx.cpu()
+        return self.activations[rows].to(device, non_blocking=True).float()
+
+    def random_views(self, image_idx):
+        return torch.randint(self.views, image_idx.shape)
@@ -0,0 +1,133 @@
+import math
+import argparse
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from export_onnx import build_model, add_model_args
+
+
+class LoRAConv2d(nn.Conv2d):
+    """1x1 conv with a low rank update, W + alpha / rank * up @ down.
+
+    The base weight keeps its name in the state_dict, so pre-trained checkpoints load as before and only the
+    lora_down / lora_up tensors are new. lora_up starts at zero, the wrapped conv is unchanged until trained.
+    """
+
+    def __init__(self, in_channels, out_channels, rank=8, alpha=16, bias=False):
+        super().__init__(in_channels, out_channels, 1, stride=1, padding=0, bias=bias)
+        self.rank = rank
+        self.scaling = alpha / rank
+        self.lora_down = nn.Parameter(torch.empty(rank, in_channels))
+        self.lora_up = nn.Parameter(torch.zeros(out_channels, rank))
+        nn.init.kaiming_uniform_(self.lora_down, a=math.sqrt(5))
+
+    @classmethod
+    def from_conv(cls, conv, rank, alpha):
+        lora = cls(conv.in_channels, conv.out_channels, rank, alpha, bias=conv.bias is not None)
+        lora = lora.to(conv.weight.device)
+        lora.weight = conv.weight
+        lora.bias = conv.bias
+        return lora
+
+    def forward(self, x):
+        out = super().forward(x)
+        down = self.lora_down.to(x.dtype).view(self.rank, -1, 1, 1)
+        up = self.lora_up.to(x.dtype).view(-1, self.rank, 1, 1)
+        return out + F.conv2d(F.conv2d(x, down), up) * self.scaling
+
+    @torch.no_grad()
+    def merged(self):
+        conv = nn.Conv2d(self.in_channels, self.out_channels, 1, stride=1, padding=0, bias=self.bias is not None)
+        conv = conv.to(self.weight.device)
+        update = (self.lora_up @ self.lora_down) * self.scaling
+        conv.weight.copy_(self.weight + update.view_as(self.weight))
+        if self.bias is not None:
+            conv.bias.copy_(self.bias)
+        return conv
+
+
+def prompted_blocks(model):
+    # the blocks from the prompt insertion point (--stage) on, the ones that see the prompt
+    if model.prompt_stage == 2:
+        return list(model.stage2[model.prompt_block:]) + list(model.stage3)
+    return list(model.stage3[model.prompt_block:])
+
+
+def add_lora(model, rank=8, alpha=16):
+    """Wrap the 1x1 qkv / proj / mlp convs of the prompted blocks with LoRAConv2d, in place.
+
+    Everything except the adapters and the prompt heads (t2i, t2i2, se_block) is frozen.
+    """
+    for block in prompted_blocks(model):
+        modules = [block.mlp]
+        if not block.attn_disabled:
+            modules.append(block.attn)
+        for module in modules:
+            for name in ['qkv', 'proj', 'conv1', 'conv3']:
+                conv = getattr(module, name, None)
+                if type(conv) is nn.Conv2d and conv.kernel_size == (1, 1):
+                    setattr(module, name, LoRAConv2d.from_conv(conv, rank, alpha))
+    for name, param in model.named_parameters():
+        param.requires_grad_(is_lora_key(name))
+    return model
+
+
+def is_lora_key(name):
+    return 'lora_' in name or name.startswith(('t2i.', 't2i2.', 'se_block.'))
+
+
+def lora_parameters(model):
+    return [param for name, param in model.named_parameters() if 'lora_' in name]
+
+
+def lora_state_dict(model):
+    # adapters plus the prompt heads, a few MB instead of the whole network
+    return {k: v for k, v in model.state_dict().items() if is_lora_key(k)}
+
+
+def load_lora_state_dict(model, state_dict):
+    _, unexpected = model.load_state_dict(state_dict, strict=False)
+    if unexpected:
+        raise KeyError(f'unexpected keys in the lora checkpoint: {unexpected}')
+    return model
+
+
+def merge_lora(model):
+    # fold every adapter into its conv for inference, the model is a plain Visformer again
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, LoRAConv2d):
+                setattr(module, name, child.merged())
+    return model
+
+
+def main(args):
+    # base checkpoint + tiny lora checkpoint -> full merged checkpoint for export_onnx.py / quantize.py
+    lora = torch.load(args.lora, map_location='cpu')
+    model, text_dim = build_model(args, strict=False)
+    add_lora(model, lora['lora_rank'], lora['lora_alpha'])
+    load_lora_state_dict(model, lora['state_dict'])
+
+    x = torch.randn(2, 3, args.image_size, args.image_size)
+    text = torch.randn(2, text_dim)
+    model.eval()
+    with torch.no_grad():
+        before = model.forward_with_semantic_prompt_channel(x, text)[1]
+        merge_lora(model)
+        after = model.forward_with_semantic_prompt_channel(x, text)[1]
+    print(f'max relative diff after merging: {((before - after).abs().max() / before.abs().max()).item():.2e}')
+    torch.save({'state_dict': model.state_dict()}, args.output)
+    print(f'save {args.output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--init', type=str, required=True, help='checkpoint the adapters were trained on')
+    parser.add_argument('--lora', type=str, required=True, help='lora checkpoint (train_vit_sp.py --lora_rank)')
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--num_classes', type=int, default=64)
+    parser.add_argument('--image_size', type=int, default=224, choices=[224, 84])
+    add_model_args(parser)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,90 @@
+import torch
+
+
+def split_batch(inputs, start, end, batch_size):
+    # tensors with the batch dim are sliced, everything else (None, args, ...) is passed through
+    return [x[start:end] if isinstance(x, torch.Tensor) and x.dim() > 0 and x.shape[0] == batch_size else x
+            for x in inputs]
+
+
+def concat_outputs(outputs, sizes):
+    first = outputs[0]
+    if isinstance(first, (tuple, list)):
+        return type(first)(concat_outputs([out[i] for out in outputs], sizes) for i in range(len(first)))
+    if not isinstance(first, torch.Tensor):
+        return first
+    parts = []
+    for out, n in zip(outputs, sizes):
+        # Visformer returns x.squeeze(), which also drops the batch dim of a one sample chunk
+        if n == 1 and (out.dim() == 0 or out.shape[0] != 1):
+            out = out.unsqueeze(0)
+        parts.append(out)
+    return torch.cat(parts, dim=0)
+
+
+class MicroBatcher(object):
+    """Runs a forward in micro-batches and concatenates the outputs along the batch dim.
+
+    chunk_size > 0 fixes the micro-batch size. With chunk_size 0 the size is probed on cuda for each
+    (forward, sample shape): the peak memory of a 1 and a 2 sample forward gives the bytes per sample, and the
+    chunk is memory_budget (GB) / bytes per sample, or 80% of the free device memory without a budget.
+    An out of memory error halves the chunk and retries. On cpu without chunk_size the batch runs in one piece.
+
+    Meant for eval / no_grad forwards: BatchNorm in train mode would see per chunk statistics.
+    """
+
+    def __init__(self, chunk_size=0, memory_budget=0.):
+        self.chunk_size = chunk_size
+        self.memory_budget = memory_budget
+        self.chunks = {}
+
+    def key(self, fn, inputs):
+        shapes = tuple(tuple(x.shape[1:]) for x in inputs if isinstance(x, torch.Tensor))
+        return getattr(fn, '__qualname__', type(fn).__name__), shapes
+
+    def probe(self, fn, inputs, batch_size, device, **kwargs):
+        peaks = []
+        for n in [1, 2]:
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            base = torch.cuda.memory_allocated(device)
+            fn(*split_batch(inputs, 0, n, batch_size), **kwargs)
+            torch.cuda.synchronize(device)
+            peaks.append(torch.cuda.max_memory_allocated(device) - base)
+        per_sample = max(peaks[1] - peaks[0], 1)
+        if self.memory_budget > 0:
+            budget = self.memory_budget * 2 ** 30
+        else:
+            free, _ = torch.cuda.mem_get_info(device)
+            budget = 0.8 * free
+        return max(int((budget - peaks[0] + per_sample) // per_sample), 1)
+
+    def __call__(self, fn, *inputs, **kwargs):
+        batch_size = next(x.shape[0] for x in inputs if isinstance(x, torch.Tensor))
+        device = next(x.device for x in inputs if isinstance(x, torch.Tensor))
+        key = self.key(fn, inputs)
+        if key in self.chunks:
+            chunk = self.chunks[key]
+        elif self.chunk_size > 0:
+            chunk = self.chunk_size
+        elif device.type == 'cuda' and batch_size > 2:
+            chunk = self.chunks[key] = self.probe(fn, inputs, batch_size, device, **kwargs)
+        else:
+            chunk = batch_size
+
+        while True:
+            try:
+                outputs, sizes = [], []
+                for start in range(0, batch_size, chunk):
+                    end = min(start + chunk, batch_size)
+                    outputs.append(fn(*split_batch(inputs, start, end, batch_size), **kwargs))
+                    sizes.append(end - start)
+                if len(outputs) == 1:
+                    return outputs[0]
+                return concat_outputs(outputs, sizes)
+            except torch.cuda.OutOfMemoryError:
+                if chunk == 1:
+                    raise
+                outputs = None
+                torch.cuda.empty_cache()
+                chunk = self.chunks[key] = max(chunk // 2, 1)
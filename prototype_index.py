@@ -0,0 +1,193 @@
+import torch
+import torch.nn.functional as F
+
+
+class PrototypeIndex(object):
+    """Cosine top-k search over many class prototypes, the many-way counterpart of utils.Cosine_classifier.
+
+    Prototypes are stored L2-normalized in one growing matrix, as fp32, fp16 or int8 (symmetric, one scale per
+    row). search scores the queries against block_size rows at a time and keeps a running top-k, so memory
+    does not grow with the number of classes. After train_ivf the rows are also partitioned into k-means
+    lists and a search only scores the n_probe lists closest to each query. add replaces an existing id,
+    remove leaves a hole that is compacted once half the rows are holes.
+    """
+
+    def __init__(self, dim, storage='fp16', block_size=8192, device='cpu'):
+        if storage not in ('fp32', 'fp16', 'int8'):
+            raise ValueError(f'unknown storage: {storage}')
+        self.dim = dim
+        self.storage = storage
+        self.block_size = block_size
+        self.device = torch.device(device)
+        dtype = {'fp32': torch.float32, 'fp16': torch.float16, 'int8': torch.int8}[storage]
+        self.data = torch.zeros(0, dim, dtype=dtype, device=self.device)
+        self.scale = torch.zeros(0, device=self.device)
+        self.ids = torch.zeros(0, dtype=torch.long, device=self.device)
+        self.alive = torch.zeros(0, dtype=torch.bool, device=self.device)
+        self.size = 0
+        self.slots = {}
+        # ivf
+        self.centroids = None
+        self.assign = torch.zeros(0, dtype=torch.long, device=self.device)
+        self.lists = None
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, id):
+        return int(id) in self.slots
+
+    def encode(self, x):
+        x = F.normalize(x.float(), dim=-1)
+        if self.storage == 'int8':
+            scale = x.abs().amax(-1).clamp_min(1e-12) / 127.
+            return torch.round(x / scale.unsqueeze(-1)).clamp(-127, 127).to(torch.int8), scale
+        return x.to(self.data.dtype), torch.ones(x.shape[0], device=x.device)
+
+    def decode(self, start, end):
+        rows = self.data[start:end].float()
+        return rows * self.scale[start:end].unsqueeze(-1) if self.storage == 'int8' else rows
+
+    def reserve(self, capacity):
+        if capacity <= self.data.shape[0]:
+            return
+        capacity = max(capacity, 2 * self.data.shape[0], 1024)
+
+        def grow(x):
+            y = x.new_zeros(capacity, *x.shape[1:])
+            y[:self.size] = x[:self.size]
+            return y
+
+        self.data, self.scale, self.ids, self.alive, self.assign = map(grow, [self.data, self.scale, self.ids,
+                                                                              self.alive, self.assign])
+
+    @torch.no_grad()
+    def add(self, ids, vectors):
+        """Insert (or replace) prototypes, ids is a list / LongTensor of n class ids, vectors is [n, dim]."""
+        ids = torch.as_tensor(ids, dtype=torch.long).view(-1).tolist()
+        if len(set(ids)) != len(ids):
+            raise ValueError('duplicate ids in one add')
+        self.remove([id for id in ids if id in self.slots])
+        data, scale = self.encode(vectors.to(self.device))
+        start, end = self.size, self.size + len(ids)
+        self.reserve(end)
+        self.data[start:end] = data
+        self.scale[start:end] = scale
+        self.ids[start:end] = torch.tensor(ids, dtype=torch.long, device=self.device)
+        self.alive[start:end] = True
+        if self.centroids is not None:
+            self.assign[start:end] = (self.decode(start, end) @ self.centroids.t()).argmax(-1)
+        self.size = end
+        self.slots.update({id: start + i for i, id in enumerate(ids)})
+        self.lists = None
+
+    @torch.no_grad()
+    def remove(self, ids):
+        ids = torch.as_tensor(ids, dtype=torch.long).view(-1).tolist()
+        if not ids:
+            return
+        slots = [self.slots.pop(id) for id in ids]
+        self.alive[torch.tensor(slots, dtype=torch.long, device=self.device)] = False
+        self.lists = None
+        if self.size - len(self.slots) > self.size // 2:
+            self.compact()
+
+    def compact(self):
+        keep = self.alive[:self.size].nonzero().view(-1)
+        for name in ['data', 'scale', 'ids', 'alive', 'assign']:
+            x = getattr(self, name)
+            x[:keep.shape[0]] = x[keep].clone()
+        self.alive[keep.shape[0]:] = False
+        self.size = keep.shape[0]
+        self.slots = {id: i for i, id in enumerate(self.ids[:self.size].tolist())}
+        self.lists = None
+
+    @torch.no_grad()
+    def train_ivf(self, n_lists, n_iter=10, seed=0):
+        """Partition the current prototypes into n_lists lists with spherical k-means."""
+        self.compact()
+        if self.size < n_lists:
+            raise ValueError(f'{self.size} prototypes cannot fill {n_lists} lists')
+        generator = torch.Generator().manual_seed(seed)
+        x = self.decode(0, self.size)
+        centroids = x[torch.randperm(self.size, generator=generator)[:n_lists].to(self.device)]
+        for _ in range(n_iter):
+            assign = self.nearest_centroid(x, centroids)
+            sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+            counts = torch.bincount(assign, minlength=n_lists)
+            # an empty list keeps its old centroid
+            centroids = torch.where((counts > 0).unsqueeze(-1), F.normalize(sums, dim=-1), centroids)
+        self.centroids = centroids
+        self.assign[:self.size] = self.nearest_centroid(x, centroids)
+        self.lists = None
+
+    def nearest_centroid(self, x, centroids):
+        return torch.cat([(x[i:i + self.block_size] @ centroids.t()).argmax(-1)
+                          for i in range(0, x.shape[0], self.block_size)])
+
+    def inverted_lists(self):
+        # alive slots grouped by list, rebuilt after any change
+        if self.lists is None:
+            slots = self.alive[:self.size].nonzero().view(-1)
+            assign = self.assign[slots]
+            order = torch.argsort(assign)
+            counts = torch.bincount(assign, minlength=self.centroids.shape[0])
+            offsets = torch.cat([counts.new_zeros(1), counts.cumsum(0)]).tolist()
+            self.lists = slots[order], offsets
+        return self.lists
+
+    def score(self, query, slots=None, start=0, end=0):
+        # query [q, dim] normalized fp32 -> cosine against the given slots (or the row range start:end)
+        if slots is None:
+            rows, scale = self.data[start:end], self.scale[start:end]
+        else:
+            rows, scale = self.data[slots], self.scale[slots]
+        if self.storage == 'fp16' and query.is_cuda:
+            return (query.half() @ rows.t()).float()
+        scores = query @ rows.float().t()
+        return scores * scale if self.storage == 'int8' else scores
+
+    @staticmethod
+    def merge(best_scores, best_slots, scores, slots, k):
+        top = min(k, scores.shape[1])
+        scores, index = scores.topk(top, dim=-1)
+        scores = torch.cat([best_scores, scores], dim=-1)
+        slots = torch.cat([best_slots, slots[index]], dim=-1)
+        best_scores, index = scores.topk(k, dim=-1)
+        return best_scores, slots.gather(-1, index)
+
+    @torch.no_grad()
+    def search(self, query, k=1, n_probe=None):
+        """Top-k prototypes of every query [q, dim] by cosine.
+
+        Returns (scores [q, k], ids [q, k]), padded with -inf / -1 when fewer than k prototypes are found.
+        n_probe only applies after train_ivf, None scores every prototype.
+        """
+        query = F.normalize(query.to(self.device).float(), dim=-1)
+        best_scores = query.new_full((query.shape[0], k), float('-inf'))
+        best_slots = torch.full((query.shape[0], k), -1, dtype=torch.long, device=self.device)
+        if self.centroids is None or n_probe is None:
+            for start in range(0, self.size, self.block_size):
+                end = min(start + self.block_size, self.size)
+                scores = self.score(query, start=start, end=end)
+                scores = scores.masked_fill(~self.alive[start:end], float('-inf'))
+                slots = torch.arange(start, end, device=self.device)
+                best_scores, best_slots = self.merge(best_scores, best_slots, scores, slots, k)
+        else:
+            order, offsets = self.inverted_lists()
+            probe = (query @ self.centroids.t()).topk(min(n_probe, self.centroids.shape[0]), dim=-1).indices
+            for l in probe.unique().tolist():
+                members = order[offsets[l]:offsets[l + 1]]
+                if members.shape[0] == 0:
+                    continue
+                # every query that probes list l is scored against its members in one matmul
+                rows = (probe == l).any(-1).nonzero().view(-1)
+                scores_l, slots_l = best_scores[rows], best_slots[rows]
+                for start in range(0, members.shape[0], self.block_size):
+                    slots = members[start:start + self.block_size]
+                    scores = self.score(query[rows], slots=slots)
+                    scores_l, slots_l = self.merge(scores_l, slots_l, scores, slots, k)
+                best_scores[rows], best_slots[rows] = scores_l, slots_l
+        ids = torch.where(best_slots >= 0, self.ids[best_slots.clamp_min(0)], best_slots)
+        ids = ids.masked_fill(best_scores == float('-inf'), -1)
+        return best_scores, ids
@@ -0,0 +1,203 @@
+import os
+import copy
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.utils.data
+import torch.nn.functional as F
+from torchvision import transforms
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert, quantize_dynamic
+
+from data.dataloader import TESTEpisodeSampler
+from data.dataset import DatasetWithTextLabel
+from export_onnx import build_model, add_model_args
+from utils import mean_confidence_interval
+from text_cache import LazyTeacher, TextFeatureCache
+
+
+class QuantConv(nn.Module):
+    # int8 island around a 1x1 conv: the activation is quantized on entry and dequantized on exit
+    def __init__(self, conv):
+        super().__init__()
+        self.quant = QuantStub()
+        self.conv = conv
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def quantized_engine():
+    engines = torch.backends.quantized.supported_engines
+    for engine in ['x86', 'fbgemm', 'qnnpack']:
+        if engine in engines:
+            return engine
+    raise RuntimeError('no quantized engine available')
+
+
+def wrap_pointwise_convs(model, qconfig):
+    # qkv, proj, mlp.conv1 and mlp.conv3 carry nearly all the flops of visformer
+    for block in list(model.stage1) + list(model.stage2) + list(model.stage3):
+        modules = [block.mlp]
+        if not block.attn_disabled:
+            modules.append(block.attn)
+        for module in modules:
+            for name in ['qkv', 'proj', 'conv1', 'conv3']:
+                conv = getattr(module, name, None)
+                if isinstance(conv, nn.Conv2d) and conv.kernel_size == (1, 1):
+                    wrapped = QuantConv(conv)
+                    wrapped.qconfig = qconfig
+                    setattr(module, name, wrapped)
+    return model
+
+
+def quantize_student(model, calibrate=None, engine=None):
+    """int8 copy of an fp32 student: fused BN, static int8 1x1 convs and dynamic int8 Linear heads.
+
+    calibrate(model) runs a few episodes through the prepared model to collect activation ranges.
+    Without it the structure is only built (for loading a saved quantized state_dict).
+    """
+    engine = engine or quantized_engine()
+    torch.backends.quantized.engine = engine
+    model = copy.deepcopy(model).eval().fuse_for_inference()
+    wrap_pointwise_convs(model, get_default_qconfig(engine))
+    prepare(model, inplace=True)
+    if calibrate is not None:
+        with torch.no_grad():
+            calibrate(model)
+    convert(model, inplace=True)
+    # t2i / t2i2 / se_block / head
+    return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def get_text_feature(teacher, dataset, args):
+    class_idx = dataset.dataset.classes
+    idx2text = dataset.idx2text
+
+    if args.no_template:
+        text = [idx2text[idx] for idx in class_idx]
+    else:
+        text = ['A photo of ' + idx2text[idx] for idx in class_idx]
+
+    teacher.eval()
+    if args.nlp_model == 'clip':
+        import clip
+        text_token = clip.tokenize(text).to(args.teacher_device)
+        if args.text_length != -1:
+            text_token = text_token[:, :args.text_length]
+        with torch.no_grad():
+            text_feature = teacher.encode_text(text_token)
+            text_feature = text_feature.float()
+    else:
+        with torch.no_grad():
+            text_feature = teacher.encode(text)
+            text_feature = torch.tensor(text_feature)
+
+    return text_feature.cpu()
+
+
+def load_text_features(train_dataset, test_dataset, args):
+    # the teacher is only loaded when a class list is missing from the text cache
+    teacher = LazyTeacher(args.nlp_model, args.text_length, args.teacher_device)
+    text_cache = TextFeatureCache(args.text_cache)
+    train_text = text_cache(get_text_feature, teacher, train_dataset, args, device='cpu')
+    test_text = text_cache(get_text_feature, teacher, test_dataset, args, device='cpu')
+    if args.eqnorm:
+        if args.nlp_model in ['mpnet', 'glove']:
+            # the bert features have been normalized to unit length. use the avg norm of clip text features
+            avg_length = 9.
+        else:
+            avg_length = (train_text ** 2).sum(-1).sqrt().mean().item()
+        train_text = F.normalize(train_text, dim=-1) * avg_length
+        test_text = F.normalize(test_text, dim=-1) * avg_length
+    return train_text, test_text
+
+
+def split_episode(episode, args):
+    image = episode[0].view(args.way, args.shot + 15, *episode[0].shape[1:])
+    sup, que = image[:, :args.shot].contiguous(), image[:, args.shot:].contiguous()
+    sup, que = sup.view(-1, *sup.shape[2:]), que.view(-1, *que.shape[2:])
+    glabels = episode[1].view(args.way, args.shot + 15)[:, :args.shot].contiguous().view(-1)
+    return sup, que, glabels
+
+
+def episode_accuracy(student, text, sup, que, glabels, args):
+    labels = torch.arange(args.way).unsqueeze(-1).repeat(1, 15).view(-1)
+    _, sup_im_features = student.forward_with_semantic_prompt_channel(sup, text[glabels])
+    _, que_im_features = student(que)
+    sup_im_features = sup_im_features.view(args.way, args.shot, -1).mean(dim=1)
+    sim = F.normalize(que_im_features, dim=-1) @ F.normalize(sup_im_features, dim=-1).t()
+    _, pred = sim.max(-1)
+    return labels.eq(pred).sum().float().item() / labels.shape[0]
+
+
+def main(args):
+    args.teacher_device = f'cuda:{args.gpu}' if args.gpu >= 0 and torch.cuda.is_available() else 'cpu'
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    test_aug = transforms.Compose([transforms.Resize(int(args.image_size * 1.1)),
+                                   transforms.CenterCrop(args.image_size),
+                                   transforms.ToTensor()
+                                   ])
+    train_dataset = DatasetWithTextLabel(args.dataset, test_aug, split='train')
+    test_dataset = DatasetWithTextLabel(args.dataset, test_aug, split=args.split)
+    calib_sampler = TESTEpisodeSampler(train_dataset.dataset.targets, args.calib_episodes, args.way, args.shot + 15)
+    calib_loader = torch.utils.data.DataLoader(train_dataset, batch_sampler=calib_sampler, num_workers=args.num_workers)
+    test_sampler = TESTEpisodeSampler(test_dataset.dataset.targets, args.episodes, args.way, args.shot + 15)
+    test_loader = torch.utils.data.DataLoader(test_dataset, batch_sampler=test_sampler, num_workers=args.num_workers)
+    args.num_classes = len(train_dataset.dataset.classes)
+
+    train_text, test_text = load_text_features(train_dataset, test_dataset, args)
+    student, _ = build_model(args)
+
+    def calibrate(model):
+        # base-class episodes through both the query and the prompted support path
+        for episode in calib_loader:
+            sup, que, glabels = split_episode(episode, args)
+            model.forward_with_semantic_prompt_channel(sup, train_text[glabels])
+            model(que)
+
+    qstudent = quantize_student(student, calibrate)
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    torch.save({'state_dict': qstudent.state_dict(), 'engine': torch.backends.quantized.engine}, args.output)
+    print(f'save {args.output}')
+
+    # both students see the same fixed test episodes
+    fp32_accs, int8_accs = [], []
+    fp32_time, int8_time = 0., 0.
+    with torch.no_grad():
+        for episode in test_loader:
+            sup, que, glabels = split_episode(episode, args)
+            start = time.time()
+            fp32_accs.append(episode_accuracy(student, test_text, sup, que, glabels, args))
+            fp32_time += time.time() - start
+            start = time.time()
+            int8_accs.append(episode_accuracy(qstudent, test_text, sup, que, glabels, args))
+            int8_time += time.time() - start
+
+    m, h = mean_confidence_interval(fp32_accs)
+    print(f'fp32 test acc: {m * 100:.2f}+-{h * 100:.2f}, {fp32_time / len(fp32_accs) * 1000:.1f}ms/episode')
+    m, h = mean_confidence_interval(int8_accs)
+    print(f'int8 test acc: {m * 100:.2f}+-{h * 100:.2f}, {int8_time / len(int8_accs) * 1000:.1f}ms/episode')
+    diff = np.array(int8_accs) - np.array(fp32_accs)
+    print(f'int8 - fp32 per episode: mean {diff.mean() * 100:.2f}, worst {diff.min() * 100:.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--init', type=str, required=True, help='meta-tuned fp32 checkpoint (train_vit_sp.py)')
+    parser.add_argument('--output', type=str, default='checkpoint/int8/student_int8.pth')
+    parser.add_argument('--gpu', type=int, default=0, help='device of the text encoder, -1 for cpu')
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--num_workers', type=int, default=4)
+    add_model_args(parser, text=True)
+    parser.add_argument('--image_size', type=int, default=224, choices=[224, 84])
+    parser.add_argument('--way', type=int, default=5)
+    parser.add_argument('--shot', type=int, default=1)
+    parser.add_argument('--calib_episodes', type=int, default=20)
+    parser.add_argument('--episodes', type=int, default=600)
+    args = parser.parse_args()
+    main(args)
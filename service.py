@@ -0,0 +1,185 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+import torch
+import torch.nn.functional as F
+
+
+class Task(object):
+    # running prototype sums of one registered support set, rows follow `names`
+    def __init__(self):
+        self.names = []
+        self.sums = None
+        self.counts = None
+        self.normalized = None
+
+    def add(self, name, features):
+        if self.sums is None:
+            self.sums = features.new_zeros(0, features.shape[1])
+            self.counts = features.new_zeros(0)
+        if name not in self.names:
+            self.names.append(name)
+            self.sums = torch.cat([self.sums, self.sums.new_zeros(1, self.sums.shape[1])])
+            self.counts = torch.cat([self.counts, self.counts.new_zeros(1)])
+        row = self.names.index(name)
+        self.sums[row] += features.sum(0)
+        self.counts[row] += features.shape[0]
+        self.normalized = None
+
+    def prototypes(self):
+        # the mean of every shot seen so far, normalized once per update
+        if self.normalized is None:
+            self.normalized = F.normalize(self.sums / self.counts.unsqueeze(-1), dim=-1)
+        return self.normalized
+
+
+class FewShotService(object):
+    """In-process few-shot classification on top of an InferenceBundle (bundle.py).
+
+    register / add_shots encode support images with their class prompt (forward_with_semantic_prompt_channel)
+    and keep per-task running means, so shots can be added without re-encoding the old ones. submit queues
+    query images; a worker thread micro-batches the queued requests of all tasks into one query forward,
+    waiting at most max_wait_ms after the oldest request, and resolves each request with the nearest
+    prototype (cosine) of its task.
+    """
+
+    def __init__(self, bundle, max_batch=64, max_wait_ms=5.):
+        self.bundle = bundle
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.
+        self.rows = {name: i for i, name in enumerate(bundle.classes)}
+        self.crop = bundle.config.get('preprocess', {}).get('crop')
+        self.tasks = {}
+        self.requests = queue.Queue()
+        # the support encoder (caller threads) and the query batches (worker) share the model
+        self.model_lock = threading.Lock()
+        # guards tasks, and running against submit so that nothing is queued after stop drained the queue
+        self.task_lock = threading.Lock()
+        self.worker = None
+        self.running = False
+
+    def start(self):
+        if self.worker is None:
+            with self.task_lock:
+                self.running = True
+            self.worker = threading.Thread(target=self.serve, daemon=True)
+            self.worker.start()
+        return self
+
+    def stop(self):
+        """Stop the worker, requests it has not picked up yet fail with RuntimeError."""
+        if self.worker is not None:
+            with self.task_lock:
+                self.running = False
+            self.requests.put(None)
+            self.worker.join()
+            self.worker = None
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                request[2].set_exception(RuntimeError('the service was stopped'))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def register(self, task_id, support):
+        """Register a task from {class name: images [n, 3, H, W]}, replacing any task with the same id."""
+        task = Task()
+        for name, images in support.items():
+            task.add(name, self.encode_support(name, images))
+        with self.task_lock:
+            self.tasks[task_id] = task
+
+    def add_shots(self, task_id, name, images):
+        # a new name adds a way to the task
+        features = self.encode_support(name, images)
+        with self.task_lock:
+            self.tasks[task_id].add(name, features)
+
+    def encode_support(self, name, images):
+        if name not in self.rows:
+            raise KeyError(f'class {name!r} has no prompt in the bundle')
+        labels = torch.full((images.shape[0],), self.rows[name], dtype=torch.long)
+        with self.model_lock:
+            return self.bundle.support_features(images, labels)
+
+    def submit(self, task_id, images):
+        """Queue query images [n, 3, H, W] of task_id, the Future resolves to their class names."""
+        # requests are concatenated into one batch, a wrong shape is rejected here rather than in the worker
+        if images.dim() != 4 or images.shape[1] != 3 or images.shape[0] == 0:
+            raise ValueError(f'query images must be [n, 3, H, W], got {list(images.shape)}')
+        if self.crop is not None and tuple(images.shape[2:]) != (self.crop, self.crop):
+            raise ValueError(f'query images must be {self.crop}x{self.crop}, got {list(images.shape[2:])}')
+        future = Future()
+        with self.task_lock:
+            if not self.running:
+                raise RuntimeError('the service is not running, call start() first')
+            if task_id not in self.tasks:
+                raise KeyError(f'unknown task {task_id!r}')
+            self.requests.put((task_id, images, future, time.monotonic()))
+        return future
+
+    def classify(self, task_id, images, timeout=None):
+        return self.submit(task_id, images).result(timeout)
+
+    def next_batch(self):
+        first = self.requests.get()
+        if first is None:
+            self.running = False
+            return []
+        batch, size = [first], first[1].shape[0]
+        deadline = first[3] + self.max_wait
+        while size < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self.running = False
+                break
+            batch.append(request)
+            size += request[1].shape[0]
+        return batch
+
+    def serve(self):
+        while self.running:
+            batch = self.next_batch()
+            if batch:
+                self.run(batch)
+
+    def run(self, batch):
+        try:
+            self.run_batch(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][2].set_exception(e)
+                return
+            # one bad request must not fail the others, the unresolved ones are retried one by one
+            for request in batch:
+                if not request[2].done():
+                    self.run([request])
+
+    def run_batch(self, batch):
+        with self.model_lock:
+            features = self.bundle.query_features(torch.cat([request[1] for request in batch]))
+        features = F.normalize(features, dim=-1)
+        start = 0
+        for task_id, images, future, _ in batch:
+            query = features[start:start + images.shape[0]]
+            start += images.shape[0]
+            with self.task_lock:
+                task = self.tasks[task_id]
+                names, prototypes = list(task.names), task.prototypes()
+            pred = (query @ prototypes.t()).argmax(-1).tolist()
+            future.set_result([names[i] for i in pred])
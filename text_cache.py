@@ -0,0 +1,186 @@
+import hashlib
+import os
+
+import torch
+import torch.nn.functional as F
+
+
+TEXT_DIM = {'clip': 512, 'mpnet': 768, 'glove': 300}
+
+# --templates ensemble: the repo's single template plus the 7 templates selected for CLIP's ImageNet ensemble
+ENSEMBLE_TEMPLATES = [
+    'A photo of {}',
+    'itap of a {}.',
+    'a bad photo of the {}.',
+    'a origami {}.',
+    'a photo of the large {}.',
+    'a {} in a video game.',
+    'art of the {}.',
+    'a photo of the small {}.',
+]
+
+
+def load_teacher(nlp_model, text_length, device):
+    if nlp_model == 'clip':
+        import clip
+        # only the text tower, built at the max text length
+        teacher = clip.load_text_encoder("ViT-B/32", device=device, context_length=text_length)
+    elif nlp_model in ['mpnet', 'glove']:
+        from sentence_transformers import SentenceTransformer
+        name = 'all-mpnet-base-v2' if nlp_model == 'mpnet' else 'average_word_embeddings_glove.6B.300d'
+        teacher = SentenceTransformer(name, device=device)
+    else:
+        raise ValueError(f'unknown nlp_model: {nlp_model}')
+    return teacher
+
+
+class LazyTeacher(object):
+    """Stands in for the text teacher (clip ViT-B/32, mpnet or glove) and loads it on first use.
+
+    Attribute access (eval, encode_text, encode, ...) is forwarded to the loaded model, so it drops into the
+    get_text_feature functions unchanged. With every class list in the TextFeatureCache it is never loaded.
+    """
+
+    def __init__(self, nlp_model, text_length, device):
+        self.nlp_model = nlp_model
+        self.text_length = text_length
+        self.device = device
+        self.model = None
+
+    def load(self):
+        if self.model is None:
+            print(f'load the {self.nlp_model} text teacher on {self.device}')
+            self.model = load_teacher(self.nlp_model, self.text_length, self.device)
+        return self.model
+
+    def __getattr__(self, name):
+        # only reached for names that are not set in __init__
+        if name.startswith('__') or 'model' not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+
+def class_texts(dataset, args):
+    # the sentences get_text_feature encodes for the classes of dataset
+    idx2text = dataset.idx2text
+    if args.no_template:
+        return [idx2text[idx] for idx in dataset.dataset.classes]
+    return ['A photo of ' + idx2text[idx] for idx in dataset.dataset.classes]
+
+
+def resolve_templates(args):
+    """The --templates list, 'ensemble' expands to ENSEMBLE_TEMPLATES. None when unset."""
+    templates = getattr(args, 'templates', None)
+    if not templates:
+        return None
+    resolved = []
+    for template in templates:
+        if template == 'ensemble':
+            resolved.extend(ENSEMBLE_TEMPLATES)
+        elif '{}' in template:
+            resolved.append(template)
+        else:
+            raise ValueError(f"template {template!r} has no '{{}}' placeholder for the class name")
+    return resolved
+
+
+class TextFeatureCache(object):
+    """On-disk store of class text features, one file per (nlp_model, template, text_length, class list).
+
+    get_text_feature only depends on the teacher and the sentences it encodes, so a hit is loaded from `path`
+    without touching the teacher; a miss calls encode(teacher, dataset, args) and writes the result. An empty
+    path disables the cache.
+    """
+
+    def __init__(self, path='text_cache'):
+        self.path = path
+
+    def key(self, texts, args, tag=None):
+        # text_length only truncates the clip tokens, mpnet and glove share one entry
+        text_length = args.text_length if args.nlp_model == 'clip' else -1
+        template = tag or ('raw' if args.no_template else 'template')
+        sha = hashlib.sha1('\n'.join(texts).encode('utf-8')).hexdigest()[:16]
+        return f'{args.nlp_model}_{template}_{text_length}_{sha}'
+
+    def __call__(self, encode, teacher, dataset, args, device=None):
+        templates = resolve_templates(args)
+        if templates:
+            return self.ensemble(teacher, dataset, args, templates, device or teacher.device)
+        texts = class_texts(dataset, args)
+        return self.lookup(texts, args, lambda: encode(teacher, dataset, args), device or teacher.device)
+
+    def ensemble(self, teacher, dataset, args, templates, device):
+        """[num_classes, dim] class features averaged over templates, replaces encode when --templates is set.
+
+        All class x template prompts are encoded in one batched pass. With eqnorm the unit-length features are
+        averaged and rescaled to the mean norm of the raw features, so eqnorm sees the scale of a single
+        template; without it the raw features are averaged. Only the averaged table is cached.
+        """
+        names = [dataset.idx2text[idx] for idx in dataset.dataset.classes]
+        prompts = [template.format(name) for name in names for template in templates]
+
+        def encode():
+            features, _ = encode_prompt_grid(teacher, names, templates, args)
+            if not args.eqnorm:
+                return features.mean(1)
+            norm = features.norm(dim=-1).mean()
+            return F.normalize(F.normalize(features, dim=-1).mean(1), dim=-1) * norm
+
+        tag = 'ensemble_eqnorm' if args.eqnorm else 'ensemble'
+        return self.lookup(prompts, args, encode, device, tag=tag)
+
+    def lookup(self, texts, args, encode, device, tag=None):
+        """Cached features of `texts` on `device`, encode() is only called on a miss."""
+        if not self.path:
+            return encode().to(device)
+        file = os.path.join(self.path, self.key(texts, args, tag) + '.pth')
+        if os.path.isfile(file):
+            cached = torch.load(file, map_location='cpu')
+            if cached['texts'] == texts:
+                return cached['feature'].to(device)
+        feature = encode()
+        os.makedirs(self.path, exist_ok=True)
+        # write then rename, jobs started together may fill the same entry
+        tmp = f'{file}.{os.getpid()}.tmp'
+        torch.save({'texts': texts, 'feature': feature.detach().float().cpu()}, tmp)
+        os.replace(tmp, file)
+        # the same device as a hit, whatever device the teacher encoded on
+        return feature.to(device)
+
+
+def encode_prompts(teacher, prompts, args, batch_size=256):
+    """Text features [len(prompts), dim] of a flat prompt list, encoded batch_size prompts per teacher call."""
+    teacher.eval()
+    features = []
+    with torch.no_grad():
+        if args.nlp_model == 'clip':
+            import clip
+            tokens = clip.tokenize(prompts)
+            if args.text_length != -1:
+                tokens = tokens[:, :args.text_length]
+            for start in range(0, len(prompts), batch_size):
+                batch = tokens[start:start + batch_size].to(teacher.device)
+                features.append(teacher.encode_text(batch).float())
+        else:
+            feature = teacher.encode(prompts, batch_size=batch_size)
+            features.append(torch.tensor(feature).to(teacher.device))
+    return torch.cat(features)
+
+
+def encode_prompt_grid(teacher, names, templates, args, text_cache=None, batch_size=256):
+    """Encode every (name, template) pair, templates[v].format(names[c]), in large batches.
+
+    Returns the features as [len(names), len(templates), dim] and a {name: row} map. With a TextFeatureCache
+    the whole grid is one cache entry.
+    """
+    prompts = [template.format(name) for name in names for template in templates]
+
+    def encode():
+        return encode_prompts(teacher, prompts, args, batch_size)
+
+    if text_cache is None:
+        features = encode()
+    else:
+        features = text_cache.lookup(prompts, args, encode, teacher.device, tag='grid')
+    features = features.view(len(names), len(templates), -1)
+    return features, {name: i for i, name in enumerate(names)}
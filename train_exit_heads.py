@@ -0,0 +1,82 @@
+import os
+import argparse
+import torch
+import torch.utils.data
+import torch.nn.functional as F
+from torchvision import transforms
+
+import visformer
+from data.dataset import DatasetWithTextLabel
+from export_onnx import build_model, add_model_args
+from utils import amp_autocast, amp_grad_scaler
+
+
+def main(args):
+    # the backbone is frozen, the exit heads learn to reproduce its final query embedding (cosine distillation)
+    device = torch.device(args.device)
+    aug = transforms.Compose([transforms.Resize(int(args.image_size * 1.1)),
+                              transforms.RandomCrop(args.image_size),
+                              transforms.RandomHorizontalFlip(),
+                              transforms.ToTensor()
+                              ])
+    train_dataset = DatasetWithTextLabel(args.dataset, aug, split='train')
+    train_loader = torch.utils.data.DataLoader(train_dataset.dataset, batch_size=args.batch_size, shuffle=True,
+                                               num_workers=args.num_workers, drop_last=True)
+    args.num_classes = len(train_dataset.dataset.classes)
+
+    student, _ = build_model(args)
+    visformer.add_exit_heads(student)
+    student = student.to(device).eval()
+    student.exit_heads.train()
+    optim = torch.optim.AdamW(student.exit_heads.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optim, args.epochs * len(train_loader))
+    scaler = amp_grad_scaler(args.amp)
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    for epoch in range(args.epochs):
+        losses = [0., 0.]
+        for idx, (image, _) in enumerate(train_loader):
+            image = image.to(device)
+            with amp_autocast(args.amp, device):
+                maps = []
+                with torch.no_grad():
+                    x = image
+                    for _, run, embed in student.exit_segments():
+                        x = run(x)
+                        maps.append(x)
+                    target = embed(x).float()
+                loss = 0.
+                for i, head in enumerate(student.exit_heads):
+                    exit_loss = 1 - F.cosine_similarity(head(maps[i]).float(), target, dim=-1).mean()
+                    losses[i] += exit_loss.item()
+                    loss = loss + exit_loss
+            optim.zero_grad()
+            scaler.scale(loss).backward()
+            scaler.step(optim)
+            scaler.update()
+            scheduler.step()
+
+            if idx % args.print_step == 0 or idx == len(train_loader) - 1:
+                print(f'Train epoch: {epoch}, step: {idx:3d}, '
+                      f'cosine loss: stage2 exit {losses[0] / (idx + 1):.4f}, stage3 exit {losses[1] / (idx + 1):.4f}')
+        torch.save({'epoch': epoch + 1, 'state_dict': student.exit_heads.state_dict()}, args.output)
+        print(f'save {args.output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--init', type=str, required=True, help='meta-tuned checkpoint (train_vit_sp.py)')
+    parser.add_argument('--output', type=str, default='checkpoint/exits/exit_heads.pth')
+    parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--amp', type=str, default='off', choices=['off', 'bf16', 'fp16'])
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--dataset', type=str, default='miniImageNet', choices=['miniImageNet', 'tieredImageNet', 'CIFAR-FS', 'FC100'])
+    parser.add_argument('--image_size', type=int, default=224, choices=[224, 84])
+    add_model_args(parser)
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--weight_decay', type=float, default=5e-2)
+    parser.add_argument('--print_step', type=int, default=100)
+    args = parser.parse_args()
+    main(args)
@@ -6,13 +6,12 @@ import torch
 import torch.utils.data
 import torch.nn.functional as F
 from torchvision import transforms
-from torch.utils.tensorboard import SummaryWriter
 
 import visformer_vis
 from data.dataloader import EpisodeSampler, RepeatSampler
 from data.dataset import DatasetWithTextLabel
 from data.randaugment import RandAugmentMC
-from utils import mean_confidence_interval
+from utils import mean_confidence_interval, amp_autocast, amp_grad_scaler
 from data.dataset import DatasetWithTextLabel, aug_DatasetWithTextLabel
 from data.dataloader import EpisodeSampler, MultiTrans,TESTEpisodeSampler
 # 定义主函数，参数为args
@@ -23,7 +22,9 @@ def main(args):
     args.checkpoint_dir = 'checkpoint/'+args.dataset+'/'+args.model+'/'+args.exp + '/'
     os.makedirs(args.tensorboard_dir, exist_ok=True)
     os.makedirs(args.checkpoint_dir, exist_ok=True)
+    from torch.utils.tensorboard import SummaryWriter
     args.logger = SummaryWriter(args.tensorboard_dir)
+    args.scaler = amp_grad_scaler(args.amp)
 
     # prepare training and testing dataloader
     # 准备训练和测试dataloader
@@ -159,10 +160,11 @@ def train(student, train_loader, optim, scheduler, epoch, args):
         image = episode[0].cuda(args.gpu)  # way * (shot+15)
         labels = episode[1].cuda(args.gpu)
 
-        # 计算学生模型的输出和特征
-        logit, features = student(image)
-        # 计算损失
-        loss = F.cross_entropy(logit, labels)
+        with amp_autocast(args.amp, image.device):
+            # 计算学生模型的输出和特征
+            logit, features = student(image)
+            # 计算损失
+            loss = F.cross_entropy(logit, labels)
         # 累加损失
         losses += loss.item()
         # 计算预测结果
@@ -172,10 +174,11 @@ def train(student, train_loader, optim, scheduler, epoch, args):
 
         # 梯度归零
         optim.zero_grad()
-        # 反向传播
-        loss.backward()
+        # 反向传播, fp16时对loss进行缩放
+        args.scaler.scale(loss).backward()
         # 更新参数
-        optim.step()
+        args.scaler.step(optim)
+        args.scaler.update()
 
         # 每print_step个batch打印一次训练信息
         if idx % args.print_step == 0 or idx == len(train_loader) - 1:
@@ -199,7 +202,7 @@ def test(student, test_loader, epoch, args):
     # 初始化一个空列表，用于存放每次测试的准确率
     accs = []
     # 使用torch.no_grad()禁止梯度计算
-    with torch.no_grad():
+    with torch.no_grad(), amp_autocast(args.amp, f'cuda:{args.gpu}'):
         # 遍历测试数据集
         for episode in test_loader:
             # 将图像数据和标签数据放入cuda中
@@ -257,6 +260,7 @@ if __name__ == '__main__':
     parser.add_argument('--shot', type=int, default=1)
     parser.add_argument('--epochs', type=int, default=800)
     parser.add_argument('--episodes', type=int, default=600)
+    parser.add_argument('--amp', type=str, default='off', choices=['off', 'bf16', 'fp16'])
     parser.add_argument('--print_step', type=int, default=100)
     parser.add_argument('--test', action='store_true')
     parser.add_argument('--test_freq', type=int, default=1)
@@ -11,7 +11,6 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 
-from torch.utils.tensorboard import SummaryWriter
 
 from tqdm import tqdm
 from fusion import ImageFusion
@@ -19,9 +18,9 @@ import visformer_vis
 from torchvision.datasets import ImageFolder
 from logger import loggers
 from utils import Cosine_classifier, count_95acc, count_kacc, transform_train_224_cifar, transform_val_224_cifar, \
-    transform_val_224, transform_train_224,mean_confidence_interval
+    transform_val_224, transform_train_224,mean_confidence_interval, LR_accuracy, amp_autocast, amp_grad_scaler
 import torchvision.transforms as transforms
-import clip
+from text_cache import LazyTeacher, TextFeatureCache, TEXT_DIM
 from data.randaugment import RandAugmentMC
 from data.dataloader import EpisodeSampler, MultiTrans,TESTEpisodeSampler,view_EpisodeSampler,SharedClassSampler
 
@@ -66,6 +65,9 @@ if __name__ == '__main__':
     parser.add_argument('--encoder_lr', type=float, default=1e-6)
     parser.add_argument('--resume', type=str, default='checkpoint/miniImageNet/visformer-t/test/checkpoint_epoch_003_better_exp1.pth')
     parser.add_argument('--text_length', type=int, default=20)
+    parser.add_argument('--text_cache', type=str, default='text_cache', help='class text feature cache dir, empty to disable')
+    parser.add_argument('--templates', type=str, nargs='+', default=None,
+                        help="class text templates with {} for the name, averaged per class ('ensemble' for the built-in set), overrides --no_template")
     parser.add_argument('--train_way', type=int, default=5)
     parser.add_argument('--way', type=int, default=5)
     parser.add_argument('--shot', type=int, default=1)
@@ -74,6 +76,7 @@ if __name__ == '__main__':
     parser.add_argument('--train_episodes', type=int, default=-1)
     parser.add_argument('--episodes', type=int, default=200)
     parser.add_argument('--test_classifier', type=str, default='prototype', choices=['prototype', 'fc'])
+    parser.add_argument('--amp', type=str, default='off', choices=['off', 'bf16', 'fp16'])
     parser.add_argument('--print_step', type=int, default=100)
     parser.add_argument('--test', action='store_true')
     parser.add_argument('--test_freq', type=int, default=1)
@@ -96,7 +99,9 @@ if __name__ == '__main__':
     args.checkpoint_dir = 'checkpoint/' + args.dataset + '/' + args.model + '/' + args.exp + '/'
     os.makedirs(args.tensorboard_dir, exist_ok=True)
     os.makedirs(args.checkpoint_dir, exist_ok=True)
+    from torch.utils.tensorboard import SummaryWriter
     args.logger = SummaryWriter(args.tensorboard_dir)
+    args.scaler = amp_grad_scaler(args.amp)
 
     # prepare training and testing dataloader
     # 准备训练和测试数据加载器
@@ -178,19 +183,17 @@ if __name__ == '__main__':
 
 #加载模型
 
-    teacher, _ = clip.load("ViT-B/32", device=f'cuda:{args.gpu}')
-    text_dim = 512
-    teacher.context_length = args.text_length
-    teacher.positional_embedding.data = teacher.positional_embedding.data[:args.text_length]
-    for layer in teacher.transformer.resblocks:
-        layer.attn_mask.data = layer.attn_mask.data[:args.text_length, :args.text_length]
+    teacher = LazyTeacher('clip', args.text_length, f'cuda:{args.gpu}')
+    text_dim = TEXT_DIM['clip']
+    text_cache = TextFeatureCache(args.text_cache)
 
     def test(text, student,H,test_loader,aug_test_loader, epoch,args):
         student.eval()
         H.eval()
         accs = []
+        fc_episodes = []
         # 使用torch.no_grad()函数，不计算梯度
-        with torch.no_grad():
+        with torch.no_grad(), amp_autocast(args.amp, f'cuda:{args.gpu}'):
             for episode,aug_episode in zip(test_loader,aug_test_loader):
                 
                 if args.aug_support == 1:
@@ -222,7 +225,7 @@ if __name__ == '__main__':
                     text_features = text[glabels]
                     text_features = text_features.view(-1, 512)
                     if args.prompt_mode == 'spatial':
-                        text_features = student.t2i(text_features)
+                        text_features = student.project_spatial_prompt(text_features)
                         _, sup_im_features = student.forward_with_semantic_prompt(sup, text_features, args)
                     else:
                         _, sup_im_features = student.forward_with_semantic_prompt_channel(sup, text_features, args)
@@ -244,22 +247,12 @@ if __name__ == '__main__':
                         sim = F.normalize(que_im_features, dim=-1) @ F.normalize(sup_im_features, dim=-1).t()
                         _, pred = sim.max(-1)
                     elif args.test_classifier == 'fc':
-                        x_train = F.normalize(sup_im_features, dim=-1).cpu().numpy()
-                        y_train = torch.arange(args.way).unsqueeze(-1).repeat(1, args.shot).view(-1).numpy()
-                        # x_test = F.normalize(que_im_features, dim=-1).cpu().numpy()
-                        x_test = que_im_features.cpu().numpy()
-                        # 使用sklearn的LogisticRegression模型进行分类
-                        from sklearn.linear_model import LogisticRegression
-                        clf = LogisticRegression(penalty='l2',
-                                                random_state=0,
-                                                C=1,
-                                                solver='lbfgs',
-                                                max_iter=1000,
-                                                multi_class='multinomial')
-                        clf.fit(x_train, y_train)
-                        # 预测测试图像特征的类别
-                        pred = clf.predict(x_test)
-                        pred = torch.tensor(pred).cuda(args.gpu)
+                        x_train = F.normalize(sup_im_features, dim=-1)
+                        y_train = torch.arange(args.way).unsqueeze(-1).repeat(1, args.shot).view(-1).cuda(args.gpu)
+                        x_test = que_im_features
+                        # the logistic regression is fitted for all episodes at once after the loop
+                        fc_episodes.append((x_train, y_train, x_test, labels))
+                        continue
 
                 elif args.aug_support > 1:
                     image = torch.cat(episode[0]).cuda(args.gpu) 
@@ -287,7 +280,7 @@ if __name__ == '__main__':
                     sup, que = sup.view(-1, *sup.shape[2:]), que.view(-1, *que.shape[2:])
 
                     if args.prompt_mode == 'spatial':
-                        text_features = student.t2i(text_features)
+                        text_features = student.project_spatial_prompt(text_features)
                         _, sup_im_features = student.forward_with_semantic_prompt(sup, text_features, args)
                     else:
                         _, sup_im_features = student.forward_with_semantic_prompt_channel(sup, text_features, args)
@@ -300,30 +293,20 @@ if __name__ == '__main__':
                         _, pred = sim.max(-1)
                     elif args.test_classifier == 'fc':
                         # 计算支持集图像特征的归一化
-                        x_train = F.normalize(sup_im_features, dim=-1).cpu().numpy()
-                        # 计算支持集图像特征的标签
-                        y_train = torch.arange(args.way).unsqueeze(0).unsqueeze(-1).repeat(args.aug_support, 1, args.shot).view(-1).numpy()
-                        # 计算Query图像特征的归一化
-                        x_test = F.normalize(que_im_features, dim=-1).cpu().numpy()
-                        # 使用逻辑回归模型进行分类
-                        from sklearn.linear_model import LogisticRegression
-                        clf = LogisticRegression(penalty='l2',
-                                                random_state=0,
-                                                C=1.0,
-                                                solver='lbfgs',
-                                                max_iter=1000,
-                                                multi_class='multinomial')
-                        clf.fit(x_train, y_train)
-                        # 预测Query图像特征的标签
-                        pred = clf.predict(x_test)
-                        # 将预测结果转换为tensor
-                        pred = torch.tensor(pred).cuda(args.gpu)
+                        x_train = F.normalize(sup_im_features, dim=-1)
+                        y_train = torch.arange(args.way).unsqueeze(0).unsqueeze(-1).repeat(args.aug_support, 1, args.shot).view(-1).cuda(args.gpu)
+                        x_test = F.normalize(que_im_features, dim=-1)
+                        # the logistic regression is fitted for all episodes at once after the loop
+                        fc_episodes.append((x_train, y_train, x_test, labels))
+                        continue
 
                 # 计算准确率
                 acc = labels.eq(pred).sum().float().item() / labels.shape[0]
                 # 将准确率添加到accs列表中
                 accs.append(acc)
 
+        if len(fc_episodes) > 0:
+            accs += LR_accuracy(fc_episodes)
         # 计算准确率的均值和置信区间
         m, h = mean_confidence_interval(accs)
         print(f'[Test epoch: {epoch}] [test acc: {m * 100:.2f} +- {h * 100:.2f}]')
@@ -355,6 +338,7 @@ if __name__ == '__main__':
         # 判断使用哪个模型
         if args.nlp_model == 'clip':
             # 若使用clip模型，则对文本进行tokenize，并转换为cuda设备
+            import clip
             text_token = clip.tokenize(text).cuda(args.gpu)
             # 判断文本长度是否为-1
             if args.text_length != -1:
@@ -378,8 +362,8 @@ if __name__ == '__main__':
                                     transforms.ToTensor(),
                                     norm])
 
-    train_text = get_text_feature(teacher, train_dataset, args)
-    test_text = get_text_feature(teacher, test_dataset, args)
+    train_text = text_cache(get_text_feature, teacher, train_dataset, args)
+    test_text = text_cache(get_text_feature, teacher, test_dataset, args)
     
     # 如果使用eqnorm，则对文本特征进行归一化
     if args.eqnorm:
@@ -399,7 +383,8 @@ if __name__ == '__main__':
 
     num_classes = len(train_dataset.dataset.classes)
     # 加载student模型
-    student = visformer_vis.visformer_tiny(num_classes=num_classes)
+    student = visformer_vis.visformer_tiny(num_classes=num_classes, prompt_stage=args.stage,
+                                           prompt_mode=args.prompt_mode, prompt_avg=args.avg)
     feature_dim = 384
     if 2 <= args.stage < 3:
         feature_dim = 192
@@ -512,33 +497,35 @@ if __name__ == '__main__':
             protos = torch.tensor(np.array([proto_center[idx_to_class[l.item()]] for l in GLABELS])).cuda(args.gpu)
             text_features = train_text[glabels]
 
-            if args.prompt_mode == 'spatial':
-                text_features = student.t2i(text_features)
+            with amp_autocast(args.amp, image.device):
+                if args.prompt_mode == 'spatial':
+                    text_features = student.project_spatial_prompt(text_features)
                 
-                _, im_features = student.forward_with_semantic_prompt(image, text_features, args)
-            else:
-                _, im_features = student.forward_with_semantic_prompt_channel(image, text_features, args)
-
-            im_features = im_features.view(args.train_way, args.shot+args.aug_shot, -1)#文本加图像  5，6 ，feature
-
-            optimizer.zero_grad()  
-            # 初始化总损失变量，用于计算平均损失
-            total_loss = 0
-
-            # 循环遍历批次中的每个元素
-            for i in range(args.train_way):
-                im_feature=im_features[i,:]
-                proto=protos[i:]
-                fusion = H(im_feature)
-                # 计算损失
-                recon_loss = F.l1_loss(fusion, proto)
-                # 累加损失
-                total_loss += recon_loss
-                # 反向传播
-            total_loss = total_loss/5
-            total_loss.backward()
-
-            optimizer.step()
+                    _, im_features = student.forward_with_semantic_prompt(image, text_features, args)
+                else:
+                    _, im_features = student.forward_with_semantic_prompt_channel(image, text_features, args)
+
+                im_features = im_features.view(args.train_way, args.shot+args.aug_shot, -1)#文本加图像  5，6 ，feature
+
+                optimizer.zero_grad()  
+                # 初始化总损失变量，用于计算平均损失
+                total_loss = 0
+
+                # 循环遍历批次中的每个元素
+                for i in range(args.train_way):
+                    im_feature=im_features[i,:]
+                    proto=protos[i:]
+                    fusion = H(im_feature)
+                    # 计算损失
+                    recon_loss = F.l1_loss(fusion, proto)
+                    # 累加损失
+                    total_loss += recon_loss
+                    # 反向传播
+                total_loss = total_loss/5
+            args.scaler.scale(total_loss).backward()
+
+            args.scaler.step(optimizer)
+            args.scaler.update()
 
             # 计算并记录平均损失
             avg_loss = total_loss.item() / args.train_way
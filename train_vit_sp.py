@@ -6,16 +6,17 @@ import torch
 import torch.utils.data
 import torch.nn.functional as F
 from torchvision import transforms
-from torch.utils.tensorboard import SummaryWriter
 
-import clip
-from sentence_transformers import SentenceTransformer
 os.environ['TOKENIZERS_PARALLELISM'] = 'true'
 import visformer_vis
 from data.dataloader import TESTEpisodeSampler, MultiTrans
 from data.dataset import DatasetWithTextLabel
+from text_cache import LazyTeacher, TextFeatureCache, TEXT_DIM
 from data.randaugment import RandAugmentMC
-from utils import mean_confidence_interval
+from utils import mean_confidence_interval, LR_accuracy, amp_autocast, amp_grad_scaler
+from microbatch import MicroBatcher
+from feature_cache import SupportFeatureCache, PrefixActivationCache, checkpoint_fingerprint
+from lora import add_lora, lora_parameters, lora_state_dict, load_lora_state_dict
 
 
 def main(args):
@@ -24,7 +25,10 @@ def main(args):
     args.checkpoint_dir = 'checkpoint/' + args.dataset + '/' + args.model + '/' + args.exp + '/'
     os.makedirs(args.tensorboard_dir, exist_ok=True)
     os.makedirs(args.checkpoint_dir, exist_ok=True)
+    from torch.utils.tensorboard import SummaryWriter
     args.logger = SummaryWriter(args.tensorboard_dir)
+    args.scaler = amp_grad_scaler(args.amp)
+    args.micro_batch = MicroBatcher(args.chunk_size, args.memory_budget)
 
     # prepare training and testing dataloader
     norm = transforms.Normalize(np.array([x / 255.0 for x in [125.3, 123.0, 113.9]]),
@@ -75,25 +79,11 @@ def main(args):
     episode_sampler = TESTEpisodeSampler(test_dataset.dataset.targets, args.episodes, args.way, args.shot + 15)
     test_loader = torch.utils.data.DataLoader(test_dataset, batch_sampler=episode_sampler, num_workers=6)
 
-    if args.nlp_model == 'clip':
-        teacher, _ = clip.load("ViT-B/32", device='cuda:' + str(args.gpu))
-        text_dim = 512
-        # set the max text length
-        if args.text_length != -1:
-            teacher.context_length = args.text_length
-            teacher.positional_embedding.data = teacher.positional_embedding.data[:args.text_length]
-            for layer in teacher.transformer.resblocks:
-                layer.attn_mask.data = layer.attn_mask.data[:args.text_length, :args.text_length]
-    elif args.nlp_model == 'mpnet':
-        teacher = SentenceTransformer('all-mpnet-base-v2', device=f'cuda:{args.gpu}')
-        text_dim = 768
-    elif args.nlp_model == 'glove':
-        teacher = SentenceTransformer('average_word_embeddings_glove.6B.300d', device=f'cuda:{args.gpu}')
-        text_dim = 300
-    else:
-        raise ValueError(f'unknown nlp_model: {args.nlp_model}')
-    train_text = get_text_feature(teacher, train_dataset, args)
-    test_text = get_text_feature(teacher, test_dataset, args)
+    teacher = LazyTeacher(args.nlp_model, args.text_length, 'cuda:' + str(args.gpu))
+    text_dim = TEXT_DIM[args.nlp_model]
+    text_cache = TextFeatureCache(args.text_cache)
+    train_text = text_cache(get_text_feature, teacher, train_dataset, args)
+    test_text = text_cache(get_text_feature, teacher, test_dataset, args)
     if args.eqnorm:
         if args.nlp_model in ['mpnet', 'glove']:
             # the bert features have been normalized to unit length. use the avg norm of clip text features
@@ -104,9 +94,13 @@ def main(args):
         test_text = F.normalize(test_text, dim=-1) * avg_length
 
     if args.model == 'visformer-t':
-        student = visformer_vis.visformer_tiny(num_classes=num_classes)
+        student = visformer_vis.visformer_tiny(num_classes=num_classes, prompt_stage=args.stage,
+                                               prompt_mode=args.prompt_mode, prompt_avg=args.avg,
+                                               grad_ckpt=args.grad_ckpt)
     elif args.model == 'visformer-t-84':
-        student = visformer_vis.visformer_tiny_84(num_classes=num_classes)
+        student = visformer_vis.visformer_tiny_84(num_classes=num_classes, prompt_stage=args.stage,
+                                                  prompt_mode=args.prompt_mode, prompt_avg=args.avg,
+                                                  grad_ckpt=args.grad_ckpt)
     else:
         raise ValueError(f'unknown model: {args.model}')
 
@@ -133,23 +127,33 @@ def main(args):
                                                torch.nn.Linear(feature_dim, feature_dim),
                                                torch.nn.Sigmoid(),)
 
+    if args.lora_rank > 0:
+        # pre-trained weights keep their names under the adapters, the init checkpoint below loads as usual
+        add_lora(student, args.lora_rank, args.lora_alpha)
+
     student = student.cuda(args.gpu)
+    if args.channels_last:
+        student = student.to(memory_format=torch.channels_last)
+    if args.frozen_prefix:
+        student.freeze_prefix()
 
     optim_params_id = [id(param) for param in student.t2i.parameters()]
     if 'channel' in args.prompt_mode:
         optim_params_id += [id(param) for param in student.t2i2.parameters()]  # se_block is not included. use smaller lr for se_block
         # optim_params_id += [id(param) for param in student.se_block.parameters()]
+    if args.lora_rank > 0:
+        optim_params_id += [id(param) for param in lora_parameters(student)]
     optim_params = [param for param in student.parameters() if id(param) in optim_params_id]
-    other_params = [param for param in student.parameters() if id(param) not in optim_params_id]
+    other_params = [param for param in student.parameters() if id(param) not in optim_params_id and param.requires_grad]
     if args.optim == 'sgd':
-        optim = torch.optim.SGD(student.parameters(), lr=args.lr, momentum=0.9)
+        optim = torch.optim.SGD([param for param in student.parameters() if param.requires_grad], lr=args.lr, momentum=0.9)
     elif args.optim == 'adamw':
         optim = torch.optim.AdamW([{'params': optim_params, 'lr': args.lr, 'weight_decay': args.weight_decay},
                                    {'params': other_params, 'lr': args.encoder_lr}], weight_decay=5e-2)
     else:
         raise ValueError(f'unknown optim: {args.optim}')
 
-    if args.resume:
+    if args.resume and args.lora_rank == 0:
         args.init = args.resume
     if args.init:
         checkpoint = torch.load(args.init, map_location=f'cuda:{args.gpu}')
@@ -160,18 +164,40 @@ def main(args):
     start_epoch = 0
     if args.resume:
         checkpoint = torch.load(args.resume, map_location=f'cuda:{args.gpu}')
-        student.load_state_dict(checkpoint['state_dict'])
+        if args.lora_rank > 0:
+            load_lora_state_dict(student, checkpoint['state_dict'])
+        else:
+            student.load_state_dict(checkpoint['state_dict'])
         optim.load_state_dict(checkpoint['optimizer'])
         start_epoch = checkpoint['epoch']
         print(f'load checkpoint at epoch {start_epoch}')
 
+    if args.compile:
+        student.compile_forwards()
+
     if args.test:
         test(test_text, student, test_loader, 0, args)
         return
 
+    prefix_cache = None
+    if args.frozen_prefix:
+        # the prefix never changes, so its activations are computed once for every (image, view)
+        prefix_aug = train_aug
+        if args.prefix_views == 0:
+            prefix_aug = transforms.Compose([transforms.Resize(args.image_size),
+                                             transforms.CenterCrop(args.image_size),
+                                             transforms.ToTensor(),
+                                             norm])
+        prefix_dataset = DatasetWithTextLabel(args.dataset, prefix_aug, split='train').dataset
+        prefix_cache = PrefixActivationCache(student, prefix_dataset, args.prefix_views, args.prefix_cache, amp=args.amp)
+        targets = torch.tensor(prefix_dataset.targets)
+
     best_acc = 0.
     for epoch in range(start_epoch, args.epochs):
-        train(train_text, student, train_loader, optim, epoch, args)
+        if prefix_cache is None:
+            train(train_text, student, train_loader, optim, epoch, args)
+        else:
+            train_frozen_prefix(train_text, student, prefix_cache, targets, train_loader, optim, epoch, args)
 
         if (epoch + 1) % args.test_freq == 0:
             acc = test(test_text, student, test_loader, epoch, args)
@@ -181,6 +207,10 @@ def main(args):
             'state_dict': student.state_dict(),
             'optimizer': optim.state_dict(),
         }
+        if args.lora_rank > 0:
+            # adapters and prompt heads only, lora.py merges them into the --init checkpoint
+            checkpoint.update({'state_dict': lora_state_dict(student),
+                               'lora_rank': args.lora_rank, 'lora_alpha': args.lora_alpha})
         torch.save(checkpoint, args.checkpoint_dir + f'checkpoint_epoch_latest.pth')
         if (epoch + 1) % args.save_freq == 0:
             torch.save(checkpoint, args.checkpoint_dir + f'checkpoint_epoch_{epoch + 1:03d}.pth')
@@ -200,6 +230,7 @@ def get_text_feature(teacher, dataset, args):
 
     teacher.eval()
     if args.nlp_model == 'clip':
+        import clip
         text_token = clip.tokenize(text).cuda(args.gpu)
         if args.text_length != -1:
             text_token = text_token[:, :args.text_length]
@@ -230,25 +261,72 @@ def train(text, student, train_loader, optim, epoch, args):
         glabels = glabels.view(args.train_way, args.shot+15)[:, :args.shot]
         glabels = glabels.contiguous().view(-1)
         text_features = text[glabels]
-        if args.prompt_mode == 'spatial':
-            text_features = student.t2i(text_features)
-            _, sup_im_features = student.forward_with_semantic_prompt(sup, text_features, args)
-        else:
-            _, sup_im_features = student.forward_with_semantic_prompt_channel(sup, text_features, args)
+        with amp_autocast(args.amp, image.device):
+            if args.prompt_mode == 'spatial':
+                text_features = student.project_spatial_prompt(text_features)
+                _, sup_im_features = student.forward_with_semantic_prompt(sup, text_features, args)
+            else:
+                _, sup_im_features = student.forward_with_semantic_prompt_channel(sup, text_features, args)
+
+            sup_im_features = sup_im_features.view(args.train_way, args.shot, -1).mean(dim=1)
+
+            _, que_im_features = student(que)
+
+            sim = F.normalize(que_im_features, dim=-1) @ F.normalize(sup_im_features, dim=-1).t()
+            loss = F.cross_entropy(sim / args.t, labels)
+        losses += loss.item()
+        _, pred = sim.max(-1)
+        accs += labels.eq(pred).sum().float().item() / labels.shape[0]
+
+        optim.zero_grad()
+        args.scaler.scale(loss).backward()
+        args.scaler.step(optim)
+        args.scaler.update()
+
+        if idx % args.print_step == 0 or idx == len(train_loader) - 1:
+            print_string = f'Train epoch: {epoch}, step: {idx:3d}, loss: {losses / (idx + 1):.4f}, acc: {accs * 100 / (idx + 1):.2f}'
+            print(print_string)
+    args.logger.add_scalar('train/loss', losses / len(train_loader), epoch)
+    args.logger.add_scalar('train/acc', accs / len(train_loader), epoch)
+
+
+def train_frozen_prefix(text, student, prefix_cache, targets, train_loader, optim, epoch, args):
+    # the episodes and loss of train(), but the images are replaced by their cached prefix activations
+    student.train()
+    losses = 0.
+    accs = 0.
+    for idx, batch in enumerate(train_loader.batch_sampler):
+        x = prefix_cache(batch, prefix_cache.random_views(batch), f'cuda:{args.gpu}')  # way * (shot+15)
+        glabels = targets[batch].cuda(args.gpu)
+        labels = torch.arange(args.train_way).unsqueeze(-1).repeat(1, 15).view(-1).cuda(args.gpu)
+
+        x = x.view(args.train_way, args.shot+15, *x.shape[1:])
+        sup, que = x[:, :args.shot].contiguous(), x[:, args.shot:].contiguous()
+        sup, que = sup.view(-1, *sup.shape[2:]), que.view(-1, *que.shape[2:])
+        if args.channels_last:
+            sup, que = sup.contiguous(memory_format=torch.channels_last), que.contiguous(memory_format=torch.channels_last)
+
+        glabels = glabels.view(args.train_way, args.shot+15)[:, :args.shot]
+        glabels = glabels.contiguous().view(-1)
+        text_features = text[glabels]
+        with amp_autocast(args.amp, x.device):
+            prompt1, prompt2 = student.project_semantic_prompt(text_features)
+            _, sup_im_features = student.prompted_head(student.suffix_features(sup, prompt1, prompt2))
 
-        sup_im_features = sup_im_features.view(args.train_way, args.shot, -1).mean(dim=1)
+            sup_im_features = sup_im_features.view(args.train_way, args.shot, -1).mean(dim=1)
 
-        _, que_im_features = student(que)
+            _, que_im_features = student.prompted_head(student.suffix_features(que), spatial=False)
 
-        sim = F.normalize(que_im_features, dim=-1) @ F.normalize(sup_im_features, dim=-1).t()
-        loss = F.cross_entropy(sim / args.t, labels)
+            sim = F.normalize(que_im_features, dim=-1) @ F.normalize(sup_im_features, dim=-1).t()
+            loss = F.cross_entropy(sim / args.t, labels)
         losses += loss.item()
         _, pred = sim.max(-1)
         accs += labels.eq(pred).sum().float().item() / labels.shape[0]
 
         optim.zero_grad()
-        loss.backward()
-        optim.step()
+        args.scaler.scale(loss).backward()
+        args.scaler.step(optim)
+        args.scaler.update()
 
         if idx % args.print_step == 0 or idx == len(train_loader) - 1:
             print_string = f'Train epoch: {epoch}, step: {idx:3d}, loss: {losses / (idx + 1):.4f}, acc: {accs * 100 / (idx + 1):.2f}'
@@ -257,11 +335,32 @@ def train(text, student, train_loader, optim, epoch, args):
     args.logger.add_scalar('train/acc', accs / len(train_loader), epoch)
 
 
+def project_text_table(student, text, args):
+    # project the whole class text table once per evaluation; support samples just index into it
+    if args.prompt_mode == 'spatial':
+        return student.project_spatial_prompt(text)
+    return student.project_semantic_prompt(text, args)
+
+
+def encode_support(student, sup, glabels, prompts, args):
+    if args.prompt_mode == 'spatial':
+        _, sup_im_features = args.micro_batch(student.forward_with_semantic_prompt, sup, prompts[glabels], args)
+    else:
+        prompt1, prompt2 = [None if prompt is None else prompt[glabels] for prompt in prompts]
+        _, sup_im_features = args.micro_batch(student.forward_with_projected_prompt, sup, prompt1, prompt2, args)
+    return sup_im_features
+
+
 def test(text, student, test_loader, epoch, args):
     student.eval()
     accs = []
-    with torch.no_grad():
-        for episode in test_loader:
+    fc_episodes = []
+    support_cache = None
+    if args.support_cache and args.aug_support == 1 and test_loader.batch_sampler.fix_seed:
+        support_cache = SupportFeatureCache(checkpoint_fingerprint(student), args, args.support_cache, text)
+    with torch.no_grad(), amp_autocast(args.amp, f'cuda:{args.gpu}'):
+        prompts = project_text_table(student, text, args)
+        for i, episode in enumerate(test_loader):
             if args.aug_support == 1:
                 # use prototype classifier
                 image = episode[0].cuda(args.gpu)  # way * (shot+15)
@@ -276,33 +375,25 @@ def test(text, student, test_loader, epoch, args):
 
                 glabels = glabels.view(args.way, args.shot + 15)[:, :args.shot]
                 glabels = glabels.contiguous().view(-1)
-                text_features = text[glabels]
-                if args.prompt_mode == 'spatial':
-                    text_features = student.t2i(text_features)
-                    _, sup_im_features = student.forward_with_semantic_prompt(sup, text_features, args)
+                if support_cache is None:
+                    sup_im_features = encode_support(student, sup, glabels, prompts, args)
                 else:
-                    _, sup_im_features = student.forward_with_semantic_prompt_channel(sup, text_features, args)
-                _, que_im_features = student(que)
+                    sup_idx = test_loader.batch_sampler.cached_batches[i].view(args.way, args.shot + 15)[:, :args.shot]
+                    sup_im_features = support_cache(lambda miss: encode_support(student, sup[miss], glabels[miss], prompts, args),
+                                                    sup_idx.reshape(-1), glabels, sup.device)
+                _, que_im_features = args.micro_batch(student, que)
 
                 if args.test_classifier == 'prototype':
                     sup_im_features = sup_im_features.view(args.way, args.shot, -1).mean(dim=1)
                     sim = F.normalize(que_im_features, dim=-1) @ F.normalize(sup_im_features, dim=-1).t()
                     _, pred = sim.max(-1)
                 elif args.test_classifier == 'fc':
-                    x_train = F.normalize(sup_im_features, dim=-1).cpu().numpy()
-                    y_train = torch.arange(args.way).unsqueeze(-1).repeat(1, args.shot).view(-1).numpy()
-                    # x_test = F.normalize(que_im_features, dim=-1).cpu().numpy()
-                    x_test = que_im_features.cpu().numpy()
-                    from sklearn.linear_model import LogisticRegression
-                    clf = LogisticRegression(penalty='l2',
-                                             random_state=0,
-                                             C=1,
-                                             solver='lbfgs',
-                                             max_iter=1000,
-                                             multi_class='multinomial')
-                    clf.fit(x_train, y_train)
-                    pred = clf.predict(x_test)
-                    pred = torch.tensor(pred).cuda(args.gpu)
+                    x_train = F.normalize(sup_im_features, dim=-1)
+                    y_train = torch.arange(args.way).unsqueeze(-1).repeat(1, args.shot).view(-1).cuda(args.gpu)
+                    x_test = que_im_features
+                    # the logistic regression is fitted for all episodes at once after the loop
+                    fc_episodes.append((x_train, y_train, x_test, labels))
+                    continue
 
             elif args.aug_support > 1:
                 # use logistic regression classifier
@@ -317,40 +408,30 @@ def test(text, student, test_loader, epoch, args):
 
                 glabels = glabels.view(args.way, args.shot + 15)[:, :args.shot]
                 glabels = glabels.unsqueeze(0).repeat(args.aug_support, 1, 1).contiguous().view(-1)
-                text_features = text[glabels]
+                sup_im_features = encode_support(student, sup, glabels, prompts, args)
 
-                # text_features = student.t2i(text_features)
-                # _, sup_im_features = student.forward_with_semantic_prompt(sup, text_features, args)
-                if args.prompt_mode == 'spatial':
-                    text_features = student.t2i(text_features)
-                    _, sup_im_features = student.forward_with_semantic_prompt(sup, text_features, args)
-                else:
-                    _, sup_im_features = student.forward_with_semantic_prompt_channel(sup, text_features, args)
-
-                _, que_im_features = student(que)
+                _, que_im_features = args.micro_batch(student, que)
 
                 if args.test_classifier == 'prototype':
                     sup_im_features = sup_im_features.view(args.aug_support, args.way, args.shot, -1).mean(dim=0).mean(dim=1)
                     sim = F.normalize(que_im_features, dim=-1) @ F.normalize(sup_im_features, dim=-1).t()
                     _, pred = sim.max(-1)
                 elif args.test_classifier == 'fc':
-                    x_train = F.normalize(sup_im_features, dim=-1).cpu().numpy()
-                    y_train = torch.arange(args.way).unsqueeze(0).unsqueeze(-1).repeat(args.aug_support, 1, args.shot).view(-1).numpy()
-                    x_test = F.normalize(que_im_features, dim=-1).cpu().numpy()
-                    from sklearn.linear_model import LogisticRegression
-                    clf = LogisticRegression(penalty='l2',
-                                             random_state=0,
-                                             C=1.0,
-                                             solver='lbfgs',
-                                             max_iter=1000,
-                                             multi_class='multinomial')
-                    clf.fit(x_train, y_train)
-                    pred = clf.predict(x_test)
-                    pred = torch.tensor(pred).cuda(args.gpu)
+                    x_train = F.normalize(sup_im_features, dim=-1)
+                    y_train = torch.arange(args.way).unsqueeze(0).unsqueeze(-1).repeat(args.aug_support, 1, args.shot).view(-1).cuda(args.gpu)
+                    x_test = F.normalize(que_im_features, dim=-1)
+                    # the logistic regression is fitted for all episodes at once after the loop
+                    fc_episodes.append((x_train, y_train, x_test, labels))
+                    continue
 
             acc = labels.eq(pred).sum().float().item() / labels.shape[0]
             accs.append(acc)
 
+    if support_cache is not None:
+        support_cache.save()
+
+    if len(fc_episodes) > 0:
+        accs += LR_accuracy(fc_episodes)
     m, h = mean_confidence_interval(accs)
     print(f'Test epoch: {epoch}, test acc: {m * 100:.2f}+-{h * 100:.2f}')
     args.logger.add_scalar('test/acc', m * 100, epoch)
@@ -385,6 +466,9 @@ if __name__ == '__main__':
     parser.add_argument('--init', type=str, default='checkpoint/miniImageNet/visformer-t/pre-train/checkpoint_epoch_800.pth')
     parser.add_argument('--resume', type=str, default='')
     parser.add_argument('--text_length', type=int, default=20)
+    parser.add_argument('--text_cache', type=str, default='text_cache', help='class text feature cache dir, empty to disable')
+    parser.add_argument('--templates', type=str, nargs='+', default=None,
+                        help="class text templates with {} for the name, averaged per class ('ensemble' for the built-in set), overrides --no_template")
     parser.add_argument('--train_way', type=int, default=-1)
     parser.add_argument('--way', type=int, default=5)
     parser.add_argument('--shot', type=int, default=1)
@@ -392,6 +476,22 @@ if __name__ == '__main__':
     parser.add_argument('--train_episodes', type=int, default=-1)
     parser.add_argument('--episodes', type=int, default=600)
     parser.add_argument('--test_classifier', type=str, default='prototype', choices=['prototype', 'fc'])
+    parser.add_argument('--amp', type=str, default='off', choices=['off', 'bf16', 'fp16'])
+    parser.add_argument('--channels_last', action='store_true')
+    parser.add_argument('--compile', action='store_true', help='torch.compile the query and prompted forwards')
+    parser.add_argument('--grad_ckpt', type=str, default='000',
+                        help='activation checkpointing per stage, e.g. 011 recomputes stage 2 and 3 in backward')
+    parser.add_argument('--chunk_size', type=int, default=0, help='micro-batch size of eval forwards, 0 to probe it on cuda')
+    parser.add_argument('--memory_budget', type=float, default=0, help='GB for the probed micro-batch, 0 for 80%% of free memory')
+    parser.add_argument('--frozen_prefix', action='store_true',
+                        help='freeze the encoder below --stage and train on cached prefix activations')
+    parser.add_argument('--prefix_views', type=int, default=0,
+                        help='fixed augmentations cached per image in --frozen_prefix, 0 for no augmentation')
+    parser.add_argument('--prefix_cache', type=str, default='', help='file keeping the prefix activations across runs')
+    parser.add_argument('--lora_rank', type=int, default=0,
+                        help='train low rank adapters on the prompted blocks instead of the whole encoder, 0 to disable')
+    parser.add_argument('--lora_alpha', type=float, default=16)
+    parser.add_argument('--support_cache', type=str, default='', help='file caching prompted support features across evaluations')
     parser.add_argument('--print_step', type=int, default=100)
     parser.add_argument('--test', action='store_true')
     parser.add_argument('--test_freq', type=int, default=1)
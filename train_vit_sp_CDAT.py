@@ -6,25 +6,26 @@ import torch
 import torch.utils.data
 import torch.nn.functional as F
 from torchvision import transforms
-import wandb
 
-import clip
-from sentence_transformers import SentenceTransformer
 os.environ['TOKENIZERS_PARALLELISM'] = 'true'
 import visformer_vis
 from data.dataloader import EpisodeSampler, MultiTrans,TESTEpisodeSampler
 from data.dataset import DatasetWithTextLabel, aug_DatasetWithTextLabel
+from text_cache import LazyTeacher, TextFeatureCache, TEXT_DIM, encode_prompt_grid
 from data.randaugment import RandAugmentMC
-from utils import mean_confidence_interval
-import matplotlib.pyplot as plt
+from utils import mean_confidence_interval, LR_accuracy, amp_autocast, amp_grad_scaler
+from microbatch import MicroBatcher
 import torchvision.transforms as transforms
 
 
 
 # 定义主函数，参数为args
 def main(args):
+    import wandb
     # 初始化wandb
     wandb.init(project="your-project-name", name=args.exp)
+    args.scaler = amp_grad_scaler(args.amp)
+    args.micro_batch = MicroBatcher(args.chunk_size, args.memory_budget)
 
     # 检查点目录和wandb目录
     args.checkpoint_dir = 'checkpoint/' + args.dataset + '/' + args.model + '/' + args.exp + '/'
@@ -96,32 +97,13 @@ def main(args):
     episode_sampler = TESTEpisodeSampler(test_dataset.dataset.targets, args.episodes, args.way, args.shot + 15)
     test_loader = torch.utils.data.DataLoader(test_dataset, batch_sampler=episode_sampler, num_workers=8)
 
-   # 加载clip模型
-    if args.nlp_model == 'clip':
-        teacher, _ = clip.load("ViT-B/32", device='cuda:' + str(args.gpu))
-        text_dim = 512
-        # set the max text length
-        # 设置最大文本长度
-        if args.text_length != -1:
-            teacher.context_length = args.text_length
-            teacher.positional_embedding.data = teacher.positional_embedding.data[:args.text_length]
-            for layer in teacher.transformer.resblocks:
-                layer.attn_mask.data = layer.attn_mask.data[:args.text_length, :args.text_length]
-    # 加载mpnet模型
-    elif args.nlp_model == 'mpnet':
-        teacher = SentenceTransformer('all-mpnet-base-v2', device=f'cuda:{args.gpu}')
-        text_dim = 768
-    # 加载glove模型
-    elif args.nlp_model == 'glove':
-        teacher = SentenceTransformer('average_word_embeddings_glove.6B.300d', device=f'cuda:{args.gpu}')
-        text_dim = 300
-    # 加载其他模型
-    else:
-        raise ValueError(f'unknown nlp_model: {args.nlp_model}')
+    teacher = LazyTeacher(args.nlp_model, args.text_length, 'cuda:' + str(args.gpu))
+    text_dim = TEXT_DIM[args.nlp_model]
+    text_cache = TextFeatureCache(args.text_cache)
     # 获取训练集文本特征
-    train_text = get_text_feature(teacher, train_dataset, args)
+    train_text = text_cache(get_text_feature, teacher, train_dataset, args)
 
-    test_text = get_text_feature(teacher, test_dataset, args)
+    test_text = text_cache(get_text_feature, teacher, test_dataset, args)
     
     # 如果使用eqnorm，则对文本特征进行归一化
     if args.eqnorm:
@@ -140,9 +122,13 @@ def main(args):
 
     # 根据模型类型加载模型
     if args.model == 'visformer-t':
-        student = visformer_vis.visformer_tiny(num_classes=num_classes)
+        student = visformer_vis.visformer_tiny(num_classes=num_classes, prompt_stage=args.stage,
+                                               prompt_mode=args.prompt_mode, prompt_avg=args.avg,
+                                               grad_ckpt=args.grad_ckpt)
     elif args.model == 'visformer-t-84':
-        student = visformer_vis.visformer_tiny_84(num_classes=num_classes)
+        student = visformer_vis.visformer_tiny_84(num_classes=num_classes, prompt_stage=args.stage,
+                                                  prompt_mode=args.prompt_mode, prompt_avg=args.avg,
+                                                  grad_ckpt=args.grad_ckpt)
     else:
         raise ValueError(f'unknown model: {args.model}')
 
@@ -269,6 +255,7 @@ def get_text_feature(teacher, dataset, args):
     # 判断使用哪个模型
     if args.nlp_model == 'clip':
         # 若使用clip模型，则对文本进行tokenize，并转换为cuda设备
+        import clip
         text_token = clip.tokenize(text).cuda(args.gpu)
         # 判断文本长度是否为-1
         if args.text_length != -1:
@@ -287,59 +274,20 @@ def get_text_feature(teacher, dataset, args):
     # 返回文本特征
     return text_feature
 
-def get_aug_text_feature(teacher, dataset, args):
-    # 获取类别索引
-    class_idx = dataset.dataset.classes
-    # 获取索引到文本的映射
+def get_aug_text_feature(teacher, dataset, args, text_cache=None):
+    # 每个类别 x 5个视角的文本, 整个网格批量编码, 返回 [classes, views, dim] 和 类别->行 的映射
     idx2text = dataset.idx2text
-    # 初始化文本列表
-    text_list = []
-    
-    # 遍历每个类别和视角
-    for idx in class_idx:
-        for view in ['front', 'back', 'side', 'bottom', 'top']:  
-            # 生成文本
-            text = f'A photo of a {idx2text[idx]} from the {view} view'
-            text_list.append(text)
-    
-    
-    # 设置模型为评估模式
-    teacher.eval()
-    # 初始化文本特征列表
-    aug_text_features = []
-    
-    # 遍历文本列表并提取特征
-    for text in text_list:
-        if args.nlp_model == 'clip':
-            # 若使用clip模型，则对文本进行tokenize，并转换为cuda设备
-            text_token = clip.tokenize([text]).cuda(args.gpu)
-            # 判断文本长度是否为-1
-            if args.text_length != -1:
-                # 若不为-1，则截取文本长度
-                text_token = text_token[:, :args.text_length]
-            # 对文本进行编码，并转换为float类型
-            with torch.no_grad():
-                text_feature = teacher.encode_text(text_token)
-                text_feature = text_feature.float()
-        else:
-            # 若使用其他模型，则对文本进行编码，并转换为cuda设备
-            with torch.no_grad():
-                text_feature = teacher.encode([text])
-                text_feature = torch.tensor(text_feature).cuda(args.gpu)
-        # 添加到文本特征列表
-        aug_text_features.append(text_feature)
-    
-    # 将文本特征列表转换为张量
-    aug_text_features = torch.stack(aug_text_features)
-    
-
-    # 返回文本特征
-    return aug_text_features,text_list
+    names = [idx2text[idx] for idx in dataset.dataset.classes]
+    templates = ['A photo of a {} from the ' + view + ' view' for view in ['front', 'back', 'side', 'bottom', 'top']]
+    aug_text_features, name2index = encode_prompt_grid(teacher, names, templates, args, text_cache)
+    class_to_index = {idx: name2index[idx2text[idx]] for idx in dataset.dataset.classes}
+    return aug_text_features, class_to_index
 
 
 # 定义训练函数，用于训练模型
 # def train(aug_text, text, student, train_loader, aug_train_loader, optim, epoch,view_text_to_index, args):
 def train(text, student, train_loader, aug_train_loader, optim, epoch, args):
+    import wandb
     
     student.train()
     # 初始化损失和准确率
@@ -384,24 +332,25 @@ def train(text, student, train_loader, aug_train_loader, optim, epoch, args):
 
 
         # 根据提示模式获取特征
-        if args.prompt_mode == 'spatial':
-            sup_text_features = student.t2i(text_features)
-            _, sup_im_features = student.forward_with_semantic_prompt(sup, text_features, args)
-        else:
-            _, sup_im_features = student.forward_with_semantic_prompt_channel(sup, text_features, args)
+        with amp_autocast(args.amp, image.device):
+            if args.prompt_mode == 'spatial':
+                sup_text_features = student.project_spatial_prompt(text_features)
+                _, sup_im_features = student.forward_with_semantic_prompt(sup, text_features, args)
+            else:
+                _, sup_im_features = student.forward_with_semantic_prompt_channel(sup, text_features, args)
 
-        # 将监督特征转换为shot的格式
-        sup_im_features = sup_im_features.view(args.train_way, args.shot, -1).mean(dim=1)
+            # 将监督特征转换为shot的格式
+            sup_im_features = sup_im_features.view(args.train_way, args.shot, -1).mean(dim=1)
 
-        # 获取查询图像的特征
-        _, que_im_features = student(que)
+            # 获取查询图像的特征
+            _, que_im_features = student(que)
 
 
 
-        # 计算相似度
-        sim = F.normalize(que_im_features, dim=-1) @ F.normalize(sup_im_features, dim=-1).t()
-        # 计算损失
-        loss = F.cross_entropy(sim / args.t, labels)
+            # 计算相似度
+            sim = F.normalize(que_im_features, dim=-1) @ F.normalize(sup_im_features, dim=-1).t()
+            # 计算损失
+            loss = F.cross_entropy(sim / args.t, labels)
         # 累加损失
         losses += loss.item()
         # 获取最大概率的标签
@@ -412,9 +361,10 @@ def train(text, student, train_loader, aug_train_loader, optim, epoch, args):
         # 梯度归零
         optim.zero_grad()
         # 反向传播
-        loss.backward()
+        args.scaler.scale(loss).backward()
         # 更新参数
-        optim.step()
+        args.scaler.step(optim)
+        args.scaler.update()
 
         # 打印训练信息
         
@@ -464,22 +414,23 @@ def train(text, student, train_loader, aug_train_loader, optim, epoch, args):
  
 
 
-        if args.prompt_mode == 'spatial':
-            text_features = student.t2i(text_features)
+        with amp_autocast(args.amp, image.device):
+            if args.prompt_mode == 'spatial':
+                text_features = student.project_spatial_prompt(text_features)
             
-            _, sup_im_features = student.forward_with_semantic_prompt(sup, text_features, args)
-        else:
-            _, sup_im_features = student.forward_with_semantic_prompt_channel(sup, text_features, args)
-
-        # 将监督特征转换为shot的格式
-        sup_im_features = sup_im_features.view(args.train_way, args.shot, -1).mean(dim=1)#数据增强了1张图片，算sup特征时要求平均
-
-        # 获取查询图像的特征
-        _, que_im_features = student(que)
-        sim = F.normalize(que_im_features, dim=-1) @ F.normalize(sup_im_features, dim=-1).t()
-        # 计算损失
-    #   用到这里
-        loss = F.cross_entropy(sim / args.t, labels)
+                _, sup_im_features = student.forward_with_semantic_prompt(sup, text_features, args)
+            else:
+                _, sup_im_features = student.forward_with_semantic_prompt_channel(sup, text_features, args)
+
+            # 将监督特征转换为shot的格式
+            sup_im_features = sup_im_features.view(args.train_way, args.shot, -1).mean(dim=1)#数据增强了1张图片，算sup特征时要求平均
+
+            # 获取查询图像的特征
+            _, que_im_features = student(que)
+            sim = F.normalize(que_im_features, dim=-1) @ F.normalize(sup_im_features, dim=-1).t()
+            # 计算损失
+        #   用到这里
+            loss = F.cross_entropy(sim / args.t, labels)
         # 累加损失
         losses += loss.item()
         # 获取最大概率的标签
@@ -490,9 +441,10 @@ def train(text, student, train_loader, aug_train_loader, optim, epoch, args):
         # 梯度归零
         optim.zero_grad()
         # 反向传播
-        loss.backward()
+        args.scaler.scale(loss).backward()
         # 更新参数
-        optim.step()
+        args.scaler.step(optim)
+        args.scaler.update()
 
         # 打印训练信息
         if idx % args.print_step == 0 or idx == len(aug_train_loader) - 1:
@@ -509,10 +461,12 @@ def train(text, student, train_loader, aug_train_loader, optim, epoch, args):
 
 
 def test(text, student, test_loader, epoch,args):
+    import wandb
     student.eval()
     accs = []
+    fc_episodes = []
     # 使用torch.no_grad()函数，不计算梯度
-    with torch.no_grad():
+    with torch.no_grad(), amp_autocast(args.amp, f'cuda:{args.gpu}'):
         for episode in test_loader:
             if args.aug_support == 1:
                 image = episode[0].cuda(args.gpu) 
@@ -525,33 +479,23 @@ def test(text, student, test_loader, epoch,args):
                 glabels = glabels.contiguous().view(-1)
                 text_features = text[glabels]
                 if args.prompt_mode == 'spatial':
-                    text_features = student.t2i(text_features)
-                    _, sup_im_features = student.forward_with_semantic_prompt(sup, text_features, args)
+                    text_features = student.project_spatial_prompt(text_features)
+                    _, sup_im_features = args.micro_batch(student.forward_with_semantic_prompt, sup, text_features, args)
                 else:
-                    _, sup_im_features = student.forward_with_semantic_prompt_channel(sup, text_features, args) #5,20,384
-                _, que_im_features = student(que)
+                    _, sup_im_features = args.micro_batch(student.forward_with_semantic_prompt_channel, sup, text_features, args) #5,20,384
+                _, que_im_features = args.micro_batch(student, que)
                 if args.test_classifier == 'prototype':
                     sup_im_features = sup_im_features.view(args.way, args.shot, -1).mean(dim=1)
                     # 计算测试图像特征和训练图像特征的余弦相似度
                     sim = F.normalize(que_im_features, dim=-1) @ F.normalize(sup_im_features, dim=-1).t()
                     _, pred = sim.max(-1)
                 elif args.test_classifier == 'fc':
-                    x_train = F.normalize(sup_im_features, dim=-1).cpu().numpy()
-                    y_train = torch.arange(args.way).unsqueeze(-1).repeat(1, args.shot).view(-1).numpy()
-                    # x_test = F.normalize(que_im_features, dim=-1).cpu().numpy()
-                    x_test = que_im_features.cpu().numpy()
-                    # 使用sklearn的LogisticRegression模型进行分类
-                    from sklearn.linear_model import LogisticRegression
-                    clf = LogisticRegression(penalty='l2',
-                                             random_state=0,
-                                             C=1,
-                                             solver='lbfgs',
-                                             max_iter=1000,
-                                             multi_class='multinomial')
-                    clf.fit(x_train, y_train)
-                    # 预测测试图像特征的类别
-                    pred = clf.predict(x_test)
-                    pred = torch.tensor(pred).cuda(args.gpu)
+                    x_train = F.normalize(sup_im_features, dim=-1)
+                    y_train = torch.arange(args.way).unsqueeze(-1).repeat(1, args.shot).view(-1).cuda(args.gpu)
+                    x_test = que_im_features
+                    # the logistic regression is fitted for all episodes at once after the loop
+                    fc_episodes.append((x_train, y_train, x_test, labels))
+                    continue
 
             elif args.aug_support > 1:
                 image = torch.cat(episode[0]).cuda(args.gpu) 
@@ -567,12 +511,12 @@ def test(text, student, test_loader, epoch,args):
                 # text_features = student.t2i(text_features)
                 # _, sup_im_features = student.forward_with_semantic_prompt(sup, text_features, args)
                 if args.prompt_mode == 'spatial':
-                    text_features = student.t2i(text_features)
-                    _, sup_im_features = student.forward_with_semantic_prompt(sup, text_features, args)
+                    text_features = student.project_spatial_prompt(text_features)
+                    _, sup_im_features = args.micro_batch(student.forward_with_semantic_prompt, sup, text_features, args)
                 else:
-                    _, sup_im_features = student.forward_with_semantic_prompt_channel(sup, text_features, args)
+                    _, sup_im_features = args.micro_batch(student.forward_with_semantic_prompt_channel, sup, text_features, args)
 
-                _, que_im_features = student(que)
+                _, que_im_features = args.micro_batch(student, que)
 
                 if args.test_classifier == 'prototype':
                     sup_im_features = sup_im_features.view(args.aug_support, args.way, args.shot, -1).mean(dim=0).mean(dim=1)
@@ -580,30 +524,20 @@ def test(text, student, test_loader, epoch,args):
                     _, pred = sim.max(-1)
                 elif args.test_classifier == 'fc':
                     # 计算支持集图像特征的归一化
-                    x_train = F.normalize(sup_im_features, dim=-1).cpu().numpy()
-                    # 计算支持集图像特征的标签
-                    y_train = torch.arange(args.way).unsqueeze(0).unsqueeze(-1).repeat(args.aug_support, 1, args.shot).view(-1).numpy()
-                    # 计算Query图像特征的归一化
-                    x_test = F.normalize(que_im_features, dim=-1).cpu().numpy()
-                    # 使用逻辑回归模型进行分类
-                    from sklearn.linear_model import LogisticRegression
-                    clf = LogisticRegression(penalty='l2',
-                                             random_state=0,
-                                             C=1.0,
-                                             solver='lbfgs',
-                                             max_iter=1000,
-                                             multi_class='multinomial')
-                    clf.fit(x_train, y_train)
-                    # 预测Query图像特征的标签
-                    pred = clf.predict(x_test)
-                    # 将预测结果转换为tensor
-                    pred = torch.tensor(pred).cuda(args.gpu)
+                    x_train = F.normalize(sup_im_features, dim=-1)
+                    y_train = torch.arange(args.way).unsqueeze(0).unsqueeze(-1).repeat(args.aug_support, 1, args.shot).view(-1).cuda(args.gpu)
+                    x_test = F.normalize(que_im_features, dim=-1)
+                    # the logistic regression is fitted for all episodes at once after the loop
+                    fc_episodes.append((x_train, y_train, x_test, labels))
+                    continue
 
             # 计算准确率
             acc = labels.eq(pred).sum().float().item() / labels.shape[0]
             # 将准确率添加到accs列表中
             accs.append(acc)
 
+    if len(fc_episodes) > 0:
+        accs += LR_accuracy(fc_episodes)
     # 计算准确率的均值和置信区间
     m, h = mean_confidence_interval(accs)
     # 打印测试结果
@@ -641,6 +575,9 @@ if __name__ == '__main__':
     parser.add_argument('--init', type=str, default='checkpoint/miniImageNet/visformer-t/pre-train/checkpoint_epoch_800.pth')
     parser.add_argument('--resume', type=str, default='')
     parser.add_argument('--text_length', type=int, default=20)
+    parser.add_argument('--text_cache', type=str, default='text_cache', help='class text feature cache dir, empty to disable')
+    parser.add_argument('--templates', type=str, nargs='+', default=None,
+                        help="class text templates with {} for the name, averaged per class ('ensemble' for the built-in set), overrides --no_template")
     parser.add_argument('--train_way', type=int, default=-1)
     parser.add_argument('--way', type=int, default=5)
     parser.add_argument('--shot', type=int, default=1)
@@ -648,6 +585,11 @@ if __name__ == '__main__':
     parser.add_argument('--train_episodes', type=int, default=-1)
     parser.add_argument('--episodes', type=int, default=200)
     parser.add_argument('--test_classifier', type=str, default='prototype', choices=['prototype', 'fc'])
+    parser.add_argument('--amp', type=str, default='off', choices=['off', 'bf16', 'fp16'])
+    parser.add_argument('--grad_ckpt', type=str, default='000',
+                        help='activation checkpointing per stage, e.g. 011 recomputes stage 2 and 3 in backward')
+    parser.add_argument('--chunk_size', type=int, default=0, help='micro-batch size of eval forwards, 0 to probe it on cuda')
+    parser.add_argument('--memory_budget', type=float, default=0, help='GB for the probed micro-batch, 0 for 80%% of free memory')
     parser.add_argument('--print_step', type=int, default=100)
     parser.add_argument('--test', action='store_true')
     parser.add_argument('--test_freq', type=int, default=1)
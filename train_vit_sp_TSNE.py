@@ -6,20 +6,15 @@ import torch
 import torch.utils.data
 import torch.nn.functional as F
 from torchvision import transforms
-from torch.utils.tensorboard import SummaryWriter
 
-import clip
-from sentence_transformers import SentenceTransformer
 os.environ['TOKENIZERS_PARALLELISM'] = 'true'
 import visformer_vis
 from data.dataloader import TESTEpisodeSampler, MultiTrans
 from data.dataset import DatasetWithTextLabel
+from text_cache import LazyTeacher, TextFeatureCache, TEXT_DIM
 from data.randaugment import RandAugmentMC
 from utils import mean_confidence_interval
 import numpy as np
-import matplotlib.pyplot as plt
-from sklearn.manifold import TSNE
-import seaborn as sns
 import os
 
 def main(args):
@@ -28,6 +23,7 @@ def main(args):
     args.checkpoint_dir = 'checkpoint/' + args.dataset + '/' + args.model + '/' + args.exp + '/'
     os.makedirs(args.tensorboard_dir, exist_ok=True)
     os.makedirs(args.checkpoint_dir, exist_ok=True)
+    from torch.utils.tensorboard import SummaryWriter
     args.logger = SummaryWriter(args.tensorboard_dir)
 
     # prepare training and testing dataloader
@@ -77,25 +73,11 @@ def main(args):
     episode_sampler = TESTEpisodeSampler(test_dataset.dataset.targets, args.episodes, args.way, args.shot + 15)
     test_loader = torch.utils.data.DataLoader(test_dataset, batch_sampler=episode_sampler, num_workers=6)
 
-    if args.nlp_model == 'clip':
-        teacher, _ = clip.load("ViT-B/32", device='cuda:' + str(args.gpu))
-        text_dim = 512
-        # set the max text length
-        if args.text_length != -1:
-            teacher.context_length = args.text_length
-            teacher.positional_embedding.data = teacher.positional_embedding.data[:args.text_length]
-            for layer in teacher.transformer.resblocks:
-                layer.attn_mask.data = layer.attn_mask.data[:args.text_length, :args.text_length]
-    elif args.nlp_model == 'mpnet':
-        teacher = SentenceTransformer('all-mpnet-base-v2', device=f'cuda:{args.gpu}')
-        text_dim = 768
-    elif args.nlp_model == 'glove':
-        teacher = SentenceTransformer('average_word_embeddings_glove.6B.300d', device=f'cuda:{args.gpu}')
-        text_dim = 300
-    else:
-        raise ValueError(f'unknown nlp_model: {args.nlp_model}')
-    train_text = get_text_feature(teacher, train_dataset, args)
-    test_text = get_text_feature(teacher, test_dataset, args)
+    teacher = LazyTeacher(args.nlp_model, args.text_length, 'cuda:' + str(args.gpu))
+    text_dim = TEXT_DIM[args.nlp_model]
+    text_cache = TextFeatureCache(args.text_cache)
+    train_text = text_cache(get_text_feature, teacher, train_dataset, args)
+    test_text = text_cache(get_text_feature, teacher, test_dataset, args)
     if args.eqnorm:
         if args.nlp_model in ['mpnet', 'glove']:
             # the bert features have been normalized to unit length. use the avg norm of clip text features
@@ -106,9 +88,11 @@ def main(args):
         test_text = F.normalize(test_text, dim=-1) * avg_length
 
     if args.model == 'visformer-t':
-        student = visformer_vis.visformer_tiny(num_classes=num_classes)
+        student = visformer_vis.visformer_tiny(num_classes=num_classes, prompt_stage=args.stage,
+                                               prompt_mode=args.prompt_mode, prompt_avg=args.avg)
     elif args.model == 'visformer-t-84':
-        student = visformer_vis.visformer_tiny_84(num_classes=num_classes)
+        student = visformer_vis.visformer_tiny_84(num_classes=num_classes, prompt_stage=args.stage,
+                                                  prompt_mode=args.prompt_mode, prompt_avg=args.avg)
     else:
         raise ValueError(f'unknown model: {args.model}')
 
@@ -202,6 +186,7 @@ def get_text_feature(teacher, dataset, args):
 
     teacher.eval()
     if args.nlp_model == 'clip':
+        import clip
         text_token = clip.tokenize(text).cuda(args.gpu)
         if args.text_length != -1:
             text_token = text_token[:, :args.text_length]
@@ -285,6 +270,9 @@ def test(text, student, test_loader, epoch, args):
                     _, sup_im_features = student.forward_with_semantic_prompt_channel(sup, text_features, args)
 
                 # t-SNE降维和可视化
+                import matplotlib.pyplot as plt
+                import seaborn as sns
+                from sklearn.manifold import TSNE
                 sup_im_features = sup_im_features.cpu().numpy()  # 转换为numpy数组
                 data = sup_im_features.reshape(-1, sup_im_features.shape[-1])  # 展平为 (100, 384)
                 labels = np.repeat(np.arange(args.way), args.shot + 15)  # 生成对应的标签
@@ -406,6 +394,9 @@ if __name__ == '__main__':
     parser.add_argument('--init', type=str, default='checkpoint/miniImageNet/visformer-t/pre-train/checkpoint_epoch_800.pth')
     parser.add_argument('--resume', type=str, default='')
     parser.add_argument('--text_length', type=int, default=20)
+    parser.add_argument('--text_cache', type=str, default='text_cache', help='class text feature cache dir, empty to disable')
+    parser.add_argument('--templates', type=str, nargs='+', default=None,
+                        help="class text templates with {} for the name, averaged per class ('ensemble' for the built-in set), overrides --no_template")
     parser.add_argument('--train_way', type=int, default=-1)
     parser.add_argument('--way', type=int, default=5)
     parser.add_argument('--shot', type=int, default=1)
@@ -1,8 +1,8 @@
 import numpy as np
-import scipy.stats
 
 # 定义函数mean_confidence_interval，用于计算数据的置信区间
 def mean_confidence_interval(data, confidence=0.95):
+    import scipy.stats
     # 将数据转换为数组
     a = 1.0 * np.array(data)
     # 计算数组的长度
@@ -23,8 +23,6 @@ import warnings
 import time
 import numpy as np
 import torch
-from sklearn.cluster import KMeans
-from sklearn.linear_model import LogisticRegression
 import torch.nn.functional as F
 from torchvision import transforms
 
@@ -61,19 +59,101 @@ def Cosine_classifier(support, query, temperature=1):
     return logits, predict
 
 
+def LR_batched(support, support_y, query, C=1.0, max_iter=50, tol=1e-6, num_classes=None):
+    """Multinomial L2 logistic regression fitted for a batch of episodes at once.
+
+    Same objective as sklearn's LogisticRegression(penalty='l2', C=C, multi_class='multinomial'):
+    C * sum_i CE(x_i W + b, y_i) + 0.5 * ||W||^2 with an unpenalized intercept. The support set is much smaller
+    than the feature dim, so W is solved in the span of the support features (W = X^T A) and every Newton step is
+    a batched (N+1)*K system per episode instead of D*K.
+
+    support: [E, N, D], support_y: [E, N] in 0..K-1, query: [E, M, D]. Returns the predicted labels [E, M].
+    K is num_classes (the episode way), support_y.max() + 1 when it is not given. Memory grows as E * (N * K)^2,
+    so large episodes should be passed in chunks (LR_accuracy does).
+    """
+    dtype = torch.float64
+    X = support.detach().to(dtype)
+    Q = query.detach().to(X.device, dtype)
+    E, N, _ = X.shape
+    K = num_classes if num_classes is not None else int(support_y.max().item()) + 1
+    if int(support_y.max().item()) >= K:
+        raise ValueError(f'support labels must be in 0..{K - 1}')
+    P = N + 1
+    Y = F.one_hot(support_y.long().to(X.device), K).to(dtype)  # [E, N, K]
+    gram = X @ X.transpose(1, 2)  # [E, N, N]
+    phi = torch.cat([gram, gram.new_ones(E, N, 1)], dim=-1)  # [E, N, P]
+    R = gram.new_zeros(E, P, P)
+    R[:, :N, :N] = gram  # penalty 0.5 * ||W||^2 = 0.5 * tr(A^T K A), the intercept row is not penalized
+    eye_k = torch.eye(K, dtype=dtype, device=X.device)
+    # softmax and the intercept are shift invariant, a tiny ridge keeps the Newton system non singular
+    ridge = 1e-8 * torch.eye(P * K, dtype=dtype, device=X.device)
+    theta = gram.new_zeros(E, P, K)  # [A; b^T]
+
+    def objective(theta):
+        logits = phi @ theta
+        ce = torch.logsumexp(logits, dim=-1) - (logits * Y).sum(-1)
+        return C * ce.sum(-1) + 0.5 * (theta * (R @ theta)).sum((1, 2))
+
+    loss = objective(theta)
+    for _ in range(max_iter):
+        prob = (phi @ theta).softmax(-1)
+        grad = C * phi.transpose(1, 2) @ (prob - Y) + R @ theta  # [E, P, K]
+        if grad.abs().max() < tol:
+            break
+        # hessian: C * sum_i phi_i phi_i^T (x) (diag(p_i) - p_i p_i^T) + R (x) I
+        S = torch.diag_embed(prob) - prob.unsqueeze(-1) * prob.unsqueeze(-2)  # [E, N, K, K]
+        B = phi.view(E, N, P, 1, 1) * S.unsqueeze(2)  # [E, N, P, K, K]
+        H = (phi.transpose(1, 2) @ B.view(E, N, -1)).view(E, P, P, K, K)
+        H = C * H.permute(0, 1, 3, 2, 4) + R.view(E, P, 1, P, 1) * eye_k.view(1, 1, K, 1, K)
+        step = torch.linalg.solve(H.reshape(E, P * K, P * K) + ridge, grad.reshape(E, P * K, 1)).view(E, P, K)
+        # backtracking line search, every episode keeps its own step size
+        t = gram.new_ones(E, 1, 1)
+        for _ in range(30):
+            new_loss = objective(theta - t * step)
+            accept = new_loss <= loss
+            if accept.all():
+                break
+            t = torch.where(accept.view(E, 1, 1), t, t / 2)
+        accept = (new_loss <= loss).view(E, 1, 1)
+        theta = torch.where(accept, theta - t * step, theta)
+        loss = torch.where(accept.view(E), new_loss, loss)
+
+    logits = torch.cat([Q @ X.transpose(1, 2), Q.new_ones(E, Q.size(1), 1)], dim=-1) @ theta
+    return logits.argmax(-1)
+
+
 def LR(support, support_y, query):
-    support = support.detach().cpu().numpy()
-    support_y = support_y.detach().cpu().numpy()
-    query = query.detach().cpu().numpy()
-    clf = LogisticRegression(penalty='l2',
-                             random_state=0,
-                             C=1.0,
-                             solver='lbfgs',
-                             max_iter=1000,
-                             multi_class='multinomial')
-    clf.fit(support, support_y)
-    predict = clf.predict(query)
-    return torch.tensor(predict)
+    predict = LR_batched(support.unsqueeze(0), support_y.unsqueeze(0), query.unsqueeze(0))
+    return predict[0].cpu()
+
+
+def LR_accuracy(episodes, C=1.0, chunk_size=64):
+    """Per-episode accuracies of LR_batched over a list of (support, support_y, query, query_y) episodes.
+
+    The episodes are fitted chunk_size at a time, the newton system of a chunk is [chunk, (N+1)K, (N+1)K] in float64.
+    """
+    # every episode of a test run has the same way
+    way = int(torch.unique(episodes[0][1]).numel())
+    accs = []
+    for start in range(0, len(episodes), chunk_size):
+        support, support_y, query, query_y = [torch.stack(x) for x in zip(*episodes[start:start + chunk_size])]
+        predict = LR_batched(support, support_y, query, C=C, num_classes=way)
+        accs += predict.eq(query_y.to(predict.device)).double().mean(-1).tolist()
+    return accs
+
+
+def amp_autocast(amp, device):
+    """Autocast region of the --amp execution mode ('off', 'bf16' or 'fp16') on `device` (cuda or cpu)."""
+    device_type = torch.device(device).type
+    if amp == 'off':
+        return torch.autocast(device_type=device_type, enabled=False)
+    dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}[amp]
+    return torch.autocast(device_type=device_type, dtype=dtype)
+
+
+def amp_grad_scaler(amp):
+    # only fp16 needs loss scaling, bf16 has the fp32 exponent range
+    return torch.cuda.amp.GradScaler(enabled=(amp == 'fp16' and torch.cuda.is_available()))
 
 
 def normalize(x, epsilon=EPS):
@@ -133,6 +213,7 @@ def cluster(data, n_clusters=64, num=600):
     data = 0
     y = np.arange(len(label)).repeat(len(v))
     x = np.array(x)
+    from sklearn.cluster import KMeans
     kmeans = KMeans(n_clusters=n_clusters)
     kmeans.fit(x, y)
     k_center = kmeans.cluster_centers_
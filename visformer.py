@@ -1,16 +1,23 @@
 # https://github.com/danczs/Visformer/blob/main/models.py
 
-import numpy as np
+from contextlib import nullcontext
 import torch
 import torch.nn as nn
-from einops import rearrange
 from weight_init import to_2tuple, trunc_normal_
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 __all__=[
     'visformer_small', 'visformer_tiny', 'net1', 'net2', 'net3', 'net4', 'net5', 'net6', 'net7'
 ]
 
+
+def fp32_region(x):
+    # t2i, t2i2 and se_block keep fp32 weights and also run in fp32 inside an --amp autocast region
+    return torch.autocast(device_type=x.device.type, enabled=False)
+
+
 def drop_path(x, drop_prob:float = 0., training: bool = False):
     if drop_prob == 0. or not training:
         return x
@@ -50,6 +57,93 @@ class BatchNorm(nn.Module):
         return self.bn(x)
 
 
+class FrozenBatchNormStats(object):
+    # recompute context for activation checkpointing: the first forward already updated the BatchNorm running
+    # stats, momentum 0 keeps the recompute from updating them a second time. num_batches_tracked still counts
+    # the recompute, so it is restored as well (it sets the averaging factor of momentum=None BatchNorms)
+    def __init__(self, module):
+        self.bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+
+    def __enter__(self):
+        self.momentum = [bn.momentum for bn in self.bns]
+        self.tracked = [bn.num_batches_tracked.clone() if bn.num_batches_tracked is not None else None
+                        for bn in self.bns]
+        for bn in self.bns:
+            bn.momentum = 0.
+
+    def __exit__(self, *exc):
+        for bn, momentum, tracked in zip(self.bns, self.momentum, self.tracked):
+            bn.momentum = momentum
+            if tracked is not None:
+                bn.num_batches_tracked.copy_(tracked)
+
+
+def is_channels_last(x):
+    # a tensor with H == W == 1 is both, treat it as contiguous
+    return x.is_contiguous(memory_format=torch.channels_last) and not x.is_contiguous()
+
+
+def append_prompt_row(x, prompt):
+    # the semantic prompt becomes an extra row of W tokens under the feature map. the row is laid out in the
+    # memory format of x so that the concatenated map keeps it (channels_last stays channels_last)
+    B, C, H, W = x.shape
+    prompt = prompt.to(x.dtype).view(B, C, 1, 1).expand(B, C, 1, W)
+    memory_format = torch.channels_last if is_channels_last(x) else torch.contiguous_format
+    return torch.cat([x, prompt.contiguous(memory_format=memory_format)], dim=2)
+
+
+def merge_tokens(x, metric, size, source, r, protected=0):
+    """Bipartite soft matching (ToMe) on a token map x [B, C, N, 1].
+
+    Tokens alternate into sets a and b, and the r a-tokens most similar to their best b-token (cosine of metric
+    [B, N, d]) are averaged into it, weighted by size [B, N] (original tokens per token). The last `protected`
+    tokens are never merged. source [B, N0] maps every original token to its current one and is updated.
+    """
+    B, C, N, _ = x.shape
+    n = N - protected
+    r = min(r, n // 2)
+    if r <= 0:
+        return x, size, source
+    metric = F.normalize(metric[:, :n].float(), dim=-1)
+    a, b = metric[:, 0::2], metric[:, 1::2]
+    na, nb = a.shape[1], b.shape[1]
+    node_max, node_idx = (a @ b.transpose(1, 2)).max(dim=-1)
+    edge_idx = node_max.argsort(dim=-1, descending=True)
+    unm_idx, src_idx = edge_idx[:, r:], edge_idx[:, :r]
+    dst_idx = node_idx.gather(1, src_idx)
+
+    # new order: unmerged a tokens, b tokens, protected tokens
+    arange = torch.arange(N, device=x.device).expand(B, -1)
+    a_index = torch.empty_like(node_idx)
+    a_index.scatter_(1, unm_idx, arange[:, :na - r])
+    a_index.scatter_(1, src_idx, na - r + dst_idx)
+    new_index = torch.empty_like(arange)
+    new_index[:, 0:n:2] = a_index
+    new_index[:, 1:n:2] = na - r + arange[:, :nb]
+    new_index[:, n:] = na - r + nb + arange[:, :protected]
+
+    M = N - r
+    tokens = x.flatten(2).transpose(1, 2).float() * size.unsqueeze(-1)
+    merged = tokens.new_zeros(B, M, C).scatter_add_(1, new_index.unsqueeze(-1).expand(-1, -1, C), tokens)
+    size = size.new_zeros(B, M).scatter_add_(1, new_index, size)
+    merged = merged / size.unsqueeze(-1)
+    x = merged.to(x.dtype).transpose(1, 2).unsqueeze(-1)
+    return x, size, new_index.gather(1, source)
+
+
+def fuse_bn_into_next_conv(bn, conv):
+    # conv(a * x + b) = (W * a) x + W b, exact only for an ungrouped 1x1 conv without padding
+    assert conv.kernel_size == (1, 1) and conv.padding == (0, 0) and conv.groups == 1
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, 1, stride=conv.stride, bias=True).to(conv.weight)
+    fused.weight.data = conv.weight * scale.view(1, -1, 1, 1)
+    fused.bias.data = conv.weight.flatten(1) @ shift
+    if conv.bias is not None:
+        fused.bias.data += conv.bias
+    return fused
+
+
 class Mlp(nn.Module):
     def __init__(self, in_features, hidden_features=None, out_features=None,
                  act_layer=nn.GELU, drop=0., group=8, spatial_conv=False):
@@ -110,7 +204,13 @@ class Attention(nn.Module):
     def forward(self, x):
         B, C, H, W = x.shape
         x = self.qkv(x)
-        qkv = rearrange(x, 'b (x y z) h w -> x b y (h w) z', x=3, y=self.num_heads, z=self.head_dim)
+        # 'b (x y z) h w -> x b y (h w) z', written as views that match the memory format of x so that
+        # neither channels_last nor contiguous inputs get an extra copy
+        channels_last = is_channels_last(x)
+        if channels_last:
+            qkv = x.permute(0, 2, 3, 1).reshape(B, H * W, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
+        else:
+            qkv = x.reshape(B, 3, self.num_heads, self.head_dim, H * W).permute(1, 0, 2, 4, 3)
         # changed by wentao to add a semantic prompt
         if H != W:
             qkv = qkv[:, :, :, :(H-1)*W+1]
@@ -124,12 +224,31 @@ class Attention(nn.Module):
             semantic_token = semantic_token.repeat(1, 1, W-1, 1)
             x = torch.cat([x, semantic_token], dim=2)
 
-        x = rearrange(x, 'b y (h w) z -> b (y z) h w', h=H, w=W)
+        # 'b y (h w) z -> b (y z) h w', returned in the memory format it came in
+        if channels_last:
+            x = x.transpose(1, 2).reshape(B, H, W, -1).permute(0, 3, 1, 2)
+        else:
+            x = x.transpose(2, 3).reshape(B, -1, H, W)
         x = self.proj(x)
         x = self.proj_drop(x)
 
         return x
 
+    def forward_tokens(self, x, size):
+        # x [B, C, N, 1] merged tokens. proportional attention: log(size) on the logits lets a merged token
+        # count as the tokens it stands for. the mean key over heads is returned as the merging metric
+        B, C, N, _ = x.shape
+        qkv = self.qkv(x).reshape(B, 3, self.num_heads, self.head_dim, N).permute(1, 0, 2, 4, 3)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        attn = ( (q * self.scale) @ (k.transpose(-2,-1) * self.scale) )
+        attn = attn + size.log().to(attn.dtype)[:, None, None, :]
+        attn = attn.softmax(dim=-1)
+        attn = self.attn_drop(attn)
+        x = (attn @ v).transpose(2, 3).reshape(B, -1, N, 1)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x, k.mean(1)
+
 
 class Block(nn.Module):
     def __init__(self, dim, num_heads, head_dim_ratio=1., mlp_ratio=4., qkv_bias=False, qk_scale=None,
@@ -155,6 +274,14 @@ class Block(nn.Module):
         x = x + self.drop_path(self.mlp(self.norm2(x)))
         return x
 
+    def forward_tokens(self, x, size, source, r, protected=0):
+        # token merging variant of forward, r tokens are merged after attention (see merge_tokens)
+        x_attn, metric = self.attn.forward_tokens(self.norm1(x), size)
+        x = x + self.drop_path(x_attn)
+        x, size, source = merge_tokens(x, metric, size, source, r, protected)
+        x = x + self.drop_path(self.mlp(self.norm2(x)))
+        return x, size, source
+
 
 class PatchEmbed(nn.Module):
     def __init__(self, img_size=224, patch_size=16, in_chans=3, embed_dim=768, norm_layer=None):
@@ -173,19 +300,33 @@ class PatchEmbed(nn.Module):
 
     def forward(self, x):
         B, C, H, W = x.shape
-        assert H == self.img_size[0] and W == self.img_size[1], \
-            f"Input image size ({H}*{W}) does not match model ({self.img_size[1]}*{self.img_size[1]})."
+        # any square size works, the position embeddings are resized to it. non square inputs are not
+        # supported because Attention tells a prompted feature map (one extra row) by H != W
+        assert H == W, f"Input image size ({H}*{W}) is not square."
         x = self.proj(x)
         if self.norm_pe:
             x = self.norm(x)
         return x
 
 
+class ExitHead(nn.Module):
+    # pooled embedding from an intermediate feature map, trained to match the final query embedding
+    def __init__(self, in_dim, out_dim, norm_layer=BatchNorm):
+        super().__init__()
+        self.norm = norm_layer(in_dim)
+        self.fc = nn.Linear(in_dim, out_dim)
+
+    def forward(self, x):
+        return self.fc(self.norm(x).mean((2, 3)))
+
+
 class Visformer(nn.Module):
     def __init__(self, img_size=224, patch_size=16, init_channels=32, num_classes=1000, embed_dim=384, depth=12,
                  num_heads=6, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop_rate=0., attn_drop_rate=0.,
                  drop_path_rate=0., norm_layer=LayerNorm, attn_stage='111', pos_embed=True, spatial_conv='111',
-                 vit_embedding=False, group=8, pool=True, conv_init=False, embedding_norm=None, small_stem=False):
+                 vit_embedding=False, group=8, pool=True, conv_init=False, embedding_norm=None, small_stem=False,
+                 prompt_stage=3.2, prompt_mode='spatial+channel', prompt_avg='all', grad_ckpt='000',
+                 merge_ratio=(0., 0., 0.)):
         super().__init__()
         self.num_classes = num_classes
         self.num_features = self.embed_dim = embed_dim
@@ -201,6 +342,22 @@ class Visformer(nn.Module):
             self.stage_num1 = self.stage_num3 = depth // 3
             self.stage_num2 = depth - self.stage_num1 - self.stage_num3
         self.pos_embed = pos_embed
+
+        # semantic prompt config (--stage, --prompt_mode, --avg), resolved once here so that the prompted
+        # forwards only branch on python constants and can be compiled end to end.
+        # stage 3.2 means the prompt enters before block 2 of stage 3.
+        if prompt_avg not in ('all', 'patch', 'head'):
+            raise ValueError(f'unknown prompt_avg: {prompt_avg}')
+        self.prompt_stage = int(prompt_stage)
+        self.prompt_block = int(round((prompt_stage - self.prompt_stage) * 10))
+        self.prompt_spatial = 'spatial' in prompt_mode
+        self.prompt_channel = 'channel' in prompt_mode
+        self.prompt_avg = prompt_avg
+        self.set_grad_checkpointing(grad_ckpt)
+        self.pos_embed_cache = {}
+        self.attn_stage = attn_stage
+        self.spatial_conv = spatial_conv
+        self.set_token_merging(merge_ratio)
         dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]
 
         # stage 1
@@ -325,208 +482,336 @@ class Visformer(nn.Module):
                 nn.init.constant_(m.bias, 0.)
 
     def forward(self, x):
-        if self.using_stem:
-            x = self.stem(x)
-
-        # stage 1
-        x = self.patch_embed1(x)
-        if self.pos_embed:
-            x = x + self.pos_embed1
-            x = self.pos_drop(x)
-        for b in self.stage1:
-            x = b(x)
-
-        # stage 2
-        if not self.vit_embedding:
-            x = self.patch_embed2(x)
-            if self.pos_embed:
-                x = x + self.pos_embed2
-                x = self.pos_drop(x)
-        for b in self.stage2:
-            x = b(x)
-
-        # stage3
-        if not self.vit_embedding:
-            x = self.patch_embed3(x)
-            if self.pos_embed:
-                x = x + self.pos_embed3
-                x = self.pos_drop(x)
-        for b in self.stage3:
-            x = b(x)
-
-        # head
-        x = self.norm(x)
-        if self.pool:
-            x = self.global_pooling(x)
-        else:
-            x = x[:, :, 0, 0]
-
-        logit = self.head( x.view(x.size(0), -1) )
-        return logit, x.squeeze()
+        # the query path is the prompted path without prompts, so both run the same code
+        return self.prompted_head(self.suffix_features(self.prefix_features(x)), spatial=False)
 
     # added by wentao for semantic_prompt
-    def forward_with_semantic_prompt(self, x, semantic_prompt, args):
-        if self.using_stem:
-            x = self.stem(x)
-
-        # stage 1
-        x = self.patch_embed1(x)
+    # the prompt config comes from the constructor, args is only kept for the existing call sites
+    def forward_with_semantic_prompt(self, x, semantic_prompt, args=None):
+        x = self.suffix_features(self.prefix_features(x), semantic_prompt)
+        return self.prompted_head(x, spatial=True)
+
+    def forward_with_semantic_prompt_channel(self, x, semantic_prompt, args=None):
+        prompt1, prompt2 = self.project_semantic_prompt(semantic_prompt)
+        return self.forward_with_projected_prompt(x, prompt1, prompt2)
+
+    def project_semantic_prompt(self, semantic_prompt, args=None):
+        # the projections only depend on the class text, so the whole class text table
+        # can be projected once and indexed per support sample.
+        prompt1, prompt2 = None, None
+        if self.prompt_spatial:
+            prompt1 = self.project_spatial_prompt(semantic_prompt)
+        if self.prompt_channel:
+            with fp32_region(semantic_prompt):
+                prompt2 = self.t2i2(semantic_prompt.float())
+        return prompt1, prompt2
+
+    def project_spatial_prompt(self, semantic_prompt):
+        with fp32_region(semantic_prompt):
+            return self.t2i(semantic_prompt.float())
+
+    def channel_prompt(self, x, prompt2):
+        B, C = x.shape[:2]
+        with fp32_region(x):
+            context = x.float().mean((2, 3))
+            context = torch.cat([context, prompt2.float()], dim=-1)
+            context = self.se_block(context)
+            context = context - context.mean(dim=-1, keepdim=True)
+        return x + context.to(x.dtype).view(B, C, 1, 1)
+
+    def forward_with_projected_prompt(self, x, prompt1, prompt2, args=None):
+        x = self.prompted_feature_map(x, prompt1, prompt2)
+        return self.prompted_head(x)
+
+    def prompted_feature_map(self, x, prompt1, prompt2, args=None):
+        return self.suffix_features(self.prefix_features(x), prompt1, prompt2)
+
+    def embed_stage(self, x, stage):
+        # patch embedding and positional embedding at the start of a stage, the stem runs before stage 1
+        if stage == 1:
+            if self.using_stem:
+                x = self.stem(x)
+        elif self.vit_embedding:
+            return x
+        x = getattr(self, f'patch_embed{stage}')(x)
         if self.pos_embed:
-            x = x + self.pos_embed1
+            x = x + self.resized_pos_embed(f'pos_embed{stage}', x)
             x = self.pos_drop(x)
-        for b in self.stage1:
-            x = b(x)
-
-        # stage 2
-        if not self.vit_embedding:
-            x = self.patch_embed2(x)
-            if self.pos_embed:
-                x = x + self.pos_embed2
-                x = self.pos_drop(x)
-        stage = 2.0
-        for b in self.stage2:
-            if np.absolute(stage - args.stage) < 1e-6:
-                B, C, H, W = x.shape
-                semantic_prompt = semantic_prompt.view(B, C, 1, 1).repeat(1, 1, 1, W)
-                x = torch.cat([x, semantic_prompt], dim=2)
-            x = b(x)
-            stage += 0.1
-        if 2 <= args.stage < 3:
-            x = x[:, :, :H]
-
-        # stage3
-        if not self.vit_embedding:
-            x = self.patch_embed3(x)
-            if self.pos_embed:
-                x = x + self.pos_embed3
-                x = self.pos_drop(x)
-        stage = 3.0
-        for b in self.stage3:
-            if np.absolute(stage - args.stage) < 1e-6:
-                B, C, H, W = x.shape
-                semantic_prompt = semantic_prompt.view(B, C, 1, 1).repeat(1, 1, 1, W)
-                x = torch.cat([x, semantic_prompt], dim=2)
-            x = b(x)
-            stage += 0.1
+        return x
 
-        # head
-        x = self.norm(x)
-        if self.pool:
-            # x = self.global_pooling(x)
-            if args.stage >= 3:
-                B, C, H, W = x.shape
-                if args.avg == 'all':
-                    x = x.view(B, C, -1)[:, :, :(H-1)*W+1].mean(-1)
-                elif args.avg == 'patch':
-                    x = x.view(B, C, -1)[:, :, :(H-1)*W].mean(-1)
-                elif args.avg == 'head':
-                    x = x.view(B, C, -1) [:, :, -1]
-            else:
-                x = self.global_pooling(x)
-        else:
-            x = x[:, :, 0, 0]
+    def features_to(self, x, stage, block):
+        # stem up to (not including) `block` of `stage`, the shared start of the query, prompted and exit paths
+        for s in range(1, stage + 1):
+            x = self.embed_stage(x, s)
+            blocks = getattr(self, f'stage{s}')
+            x = self.run_blocks(blocks if s < stage else blocks[:block], x, s)
+        return x
 
-        logit = self.head( x.view(x.size(0), -1) )
-        return logit, x.squeeze()
+    def prefix_features(self, x):
+        # everything below the prompt insertion point: stem, stage1 and the blocks before prompt_block.
+        # it does not see the prompt, so with a frozen prefix it can be computed once per image
+        return self.features_to(x, self.prompt_stage, self.prompt_block)
 
-    def forward_with_semantic_prompt_channel(self, x, semantic_prompt, args):
-        if 'spatial' in args.prompt_mode:
-            prompt1 = self.t2i(semantic_prompt)
-        if 'channel' in args.prompt_mode:
-            prompt2 = self.t2i2(semantic_prompt)
+    def suffix_features(self, x, prompt1=None, prompt2=None):
+        # continues prefix_features(x) from the prompt insertion point. without prompts it is the query path,
+        # prompted_head(suffix_features(prefix_features(x)), spatial=False) equals forward(x)
+        B, C, H, W = x.shape
+        if prompt2 is not None:
+            x = self.channel_prompt(x, prompt2)
+        if prompt1 is not None:
+            x = append_prompt_row(x, prompt1)
 
-        if self.using_stem:
-            x = self.stem(x)
+        if self.prompt_stage == 2:
+            x = self.run_blocks(self.stage2[self.prompt_block:], x, 2)
+            if prompt1 is not None:
+                x = x[:, :, :H]
 
-        # stage 1
-        x = self.patch_embed1(x)
-        if self.pos_embed:
-            x = x + self.pos_embed1
-            x = self.pos_drop(x)
-        for b in self.stage1:
-            x = b(x)
+            x = self.run_blocks(self.stage3, self.embed_stage(x, 3), 3)
+        else:
+            x = self.run_blocks(self.stage3[self.prompt_block:], x, 3)
 
-        # stage 2
-        if not self.vit_embedding:
-            x = self.patch_embed2(x)
-            if self.pos_embed:
-                x = x + self.pos_embed2
-                x = self.pos_drop(x)
-        stage = 2.0
-        for b in self.stage2:
-            if np.absolute(stage - args.stage) < 1e-6:
-                B, C, H, W = x.shape
-                if 'channel' in args.prompt_mode:
-                    context = x.view(B, C, -1).mean(-1)
-                    context = torch.cat([context, prompt2], dim=-1)
-                    context = self.se_block(context)
-                    context = context - context.mean(dim=-1, keepdim=True)
-                    x = x + context.view(B, C, 1, 1)
-                if 'spatial' in args.prompt_mode:
-                    prompt1 = prompt1.view(B, C, 1, 1).repeat(1, 1, 1, W)
-                    x = torch.cat([x, prompt1], dim=2)
-            x = b(x)
-            stage += 0.1
-        if 'spatial' in args.prompt_mode and 2 <= args.stage < 3:
-            x = x[:, :, :H]
-
-        # stage3
-        if not self.vit_embedding:
-            x = self.patch_embed3(x)
-            if self.pos_embed:
-                x = x + self.pos_embed3
-                x = self.pos_drop(x)
-        stage = 3.0
-        for b in self.stage3:
-            if np.absolute(stage - args.stage) < 1e-6:
-                B, C, H, W = x.shape
-                if 'channel' in args.prompt_mode:
-                    context = x.view(B, C, -1).mean(-1)
-                    context = torch.cat([context, prompt2], dim=-1)
-                    context = self.se_block(context)
-                    context = context - context.mean(dim=-1, keepdim=True)
-                    x = x + context.view(B, C, 1, 1)
-                if 'spatial' in args.prompt_mode:
-                    prompt1 = prompt1.view(B, C, 1, 1).repeat(1, 1, 1, W)
-                    x = torch.cat([x, prompt1], dim=2)
-            x = b(x)
-            stage += 0.1
+        return self.norm(x)
 
-        # head
-        x = self.norm(x)
+    def prefix_state_dict(self):
+        # parameters and buffers read by prefix_features, kept as tensors with requires_grad (keep_vars)
+        names = ['stem', 'patch_embed1', 'pos_embed1', 'stage1', 'patch_embed2', 'pos_embed2']
+        if self.prompt_stage == 2:
+            names += [f'stage2.{i}' for i in range(self.prompt_block)]
+        else:
+            names += ['stage2', 'patch_embed3', 'pos_embed3'] + [f'stage3.{i}' for i in range(self.prompt_block)]
+        return {k: v for k, v in self.state_dict(keep_vars=True).items()
+                if any(k == name or k.startswith(name + '.') for name in names)}
+
+    def freeze_prefix(self):
+        # only the blocks from the prompt insertion point and the prompt heads are trained
+        for tensor in self.prefix_state_dict().values():
+            tensor.requires_grad_(False)
+        return self
+
+    def prompted_head(self, x, args=None, spatial=None):
+        if spatial is None:
+            spatial = self.prompt_spatial
         if self.pool:
-            if 'spatial' not in args.prompt_mode or args.stage < 3:
+            if not spatial or self.prompt_stage < 3:
                 x = self.global_pooling(x)
             else:
                 B, C, H, W = x.shape
-                if args.avg == 'all':
-                    x = x.view(B, C, -1)[:, :, :(H - 1) * W + 1].mean(-1)
-                elif args.avg == 'patch':
-                    x = x.view(B, C, -1)[:, :, :(H - 1) * W].mean(-1)
-                elif args.avg == 'head':
-                    x = x.view(B, C, -1)[:, :, -1]
+                if self.prompt_avg == 'all':
+                    x = x.flatten(2)[:, :, :(H - 1) * W + 1].mean(-1)
+                elif self.prompt_avg == 'patch':
+                    x = x.flatten(2)[:, :, :(H - 1) * W].mean(-1)
+                else:
+                    x = x[:, :, -1, -1]
         else:
             x = x[:, :, 0, 0]
 
-        logit = self.head( x.view(x.size(0), -1) )
+        logit = self.head( x.flatten(1) )
         return logit, x.squeeze()
 
+    def resized_pos_embed(self, name, x):
+        # pos_embed1/2/3 are trained at img_size; other resolutions get a bicubic resize, cached per size
+        # for inference and recomputed when the weights, device or dtype change
+        pos_embed = getattr(self, name)
+        H, W = x.shape[2:]
+        if pos_embed.shape[2:] == (H, W):
+            return pos_embed
+        if self.training or torch.is_grad_enabled():
+            return F.interpolate(pos_embed, size=(H, W), mode='bicubic', align_corners=False)
+        key = (name, H, W, pos_embed.device, pos_embed.dtype)
+        version = (pos_embed.data_ptr(), pos_embed._version)
+        cached_version, resized = self.pos_embed_cache.get(key, (None, None))
+        if cached_version != version:
+            resized = F.interpolate(pos_embed, size=(H, W), mode='bicubic', align_corners=False)
+            self.pos_embed_cache[key] = (version, resized)
+        return resized
+
+    def set_grad_checkpointing(self, stages='111'):
+        # one flag per stage like attn_stage, e.g. '011' recomputes the stage2 and stage3 activations in backward
+        self.grad_ckpt = [flag == '1' for flag in stages]
+
+    def exit_segments(self):
+        # (blocks, run, embed) of the query path cut at the exits: after stage2, after half of stage3, the end
+        half = len(self.stage3) // 2
+
+        def to_stage2(x):
+            return self.features_to(x, 2, len(self.stage2))
+
+        def to_stage3_half(x):
+            return self.run_blocks(self.stage3[:half], self.embed_stage(x, 3), 3)
+
+        def to_end(x):
+            return self.run_blocks(self.stage3[half:], x, 3)
+
+        def final_embed(x):
+            return self.prompted_head(self.norm(x), spatial=False)[1].reshape(x.shape[0], -1)
+
+        return [(len(self.stage1) + len(self.stage2), to_stage2, self.exit_heads[0]),
+                (half, to_stage3_half, self.exit_heads[1]),
+                (len(self.stage3) - half, to_end, final_embed)]
+
+    def forward_exits(self, x):
+        # query embeddings at every exit, the last one equals forward(x)[1]
+        embeddings = []
+        for _, run, embed in self.exit_segments():
+            x = run(x)
+            embeddings.append(embed(x))
+        return embeddings
+
+    def forward_early_exit(self, x, prototypes, threshold):
+        """Query embeddings that stop at the first exit whose prototype margin reaches threshold.
+
+        prototypes [way, D] come from the full model. At every exit the queries still running are scored against
+        them, a query leaves when the gap between its two highest cosine similarities is >= threshold, and only the
+        others go on to the next blocks. Returns the embeddings [B, D] and the blocks each query ran [B].
+        """
+        B = x.shape[0]
+        prototypes = F.normalize(prototypes.float(), dim=-1)
+        embeddings = prototypes.new_zeros(B, prototypes.shape[1])
+        blocks = torch.zeros(B, dtype=torch.long, device=x.device)
+        active = torch.arange(B, device=x.device)
+        segments = self.exit_segments()
+        for i, (n_blocks, run, embed) in enumerate(segments):
+            x = run(x)
+            blocks[active] += n_blocks
+            if i == len(segments) - 1:
+                embeddings[active] = embed(x).float()
+                break
+            if prototypes.shape[0] < 2:
+                # no margin without a second prototype, every query runs the full model
+                continue
+            embedding = embed(x).float()
+            top2 = (F.normalize(embedding, dim=-1) @ prototypes.t()).topk(2, dim=-1).values
+            done = top2[:, 0] - top2[:, 1] >= threshold
+            embeddings[active[done]] = embedding[done]
+            active, x = active[~done], x[~done]
+            if len(active) == 0:
+                break
+        return embeddings, blocks
+
+    def set_token_merging(self, ratios=(0., 0., 0.)):
+        # per stage fraction of the tokens merged after the attention of every block, 0 disables it.
+        # merged tokens have no grid, so only stages with attention and 1x1 mlps can merge.
+        # merging is scoped to one run_blocks call: the tokens are unmerged back to the grid at its end, and a stage
+        # split at the prompt block (prefix/suffix_features) or at an exit restarts from the full grid. forward and
+        # the prompted forwards split at the same prompt block, so query and support features merge alike; the last
+        # exit of forward_exits also splits at half of stage3 and drifts from forward (bench_token_merging.py)
+        ratios = [float(r) for r in ratios]
+        for i, r in enumerate(ratios):
+            if r > 0 and (self.attn_stage[i] == '0' or self.spatial_conv[i] == '1'):
+                raise ValueError(f'stage{i + 1} has no attention or a spatial conv, it cannot merge tokens')
+        self.merge_ratio = ratios
+
+    def run_blocks(self, blocks, x, stage):
+        ratio = self.merge_ratio[stage - 1]
+        if ratio == 0 or len(blocks) == 0:
+            for b in blocks:
+                x = self.run_block(b, x, stage)
+            return x
+
+        # the grid becomes a token map [B, C, N, 1]. a prompted map (H != W) contributes a single prompt token,
+        # as in Attention, which stays last and is never merged
+        B, C, H, W = x.shape
+        channels_last = is_channels_last(x)
+        prompted = int(H != W)
+        n = (H - prompted) * W
+        tokens = x.flatten(2)[:, :, :n + prompted].unsqueeze(-1).contiguous()
+        size = torch.ones(B, n + prompted, device=x.device)
+        source = torch.arange(n + prompted, device=x.device).expand(B, -1)
+        for b in blocks:
+            r = int(ratio * (tokens.shape[2] - prompted))
+            tokens, size, source = self.run_block_tokens(b, tokens, size, source, r, prompted, stage)
+
+        # unmerge: every position takes the token it was merged into, the prompt row repeats the prompt token
+        x = tokens.squeeze(-1).gather(2, source.unsqueeze(1).expand(-1, C, -1))
+        if prompted:
+            x = torch.cat([x[:, :, :n], x[:, :, n:].expand(-1, -1, W)], dim=2)
+        x = x.reshape(B, C, H, W)
+        return x.contiguous(memory_format=torch.channels_last) if channels_last else x
+
+    def run_block(self, b, x, stage):
+        if self.grad_ckpt[stage - 1] and self.training and torch.is_grad_enabled():
+            return checkpoint(b, x, use_reentrant=False, context_fn=lambda: (nullcontext(), FrozenBatchNormStats(b)))
+        return b(x)
+
+    def run_block_tokens(self, b, tokens, size, source, r, prompted, stage):
+        # the merged-token counterpart of run_block, --grad_ckpt applies to merging stages as well
+        if self.grad_ckpt[stage - 1] and self.training and torch.is_grad_enabled():
+            return checkpoint(b.forward_tokens, tokens, size, source, r, prompted, use_reentrant=False,
+                              context_fn=lambda: (nullcontext(), FrozenBatchNormStats(b)))
+        return b.forward_tokens(tokens, size, source, r, prompted)
+
+    @torch.no_grad()
+    def fuse_for_inference(self):
+        """Fold every BatchNorm into an adjacent conv, in place. Only valid in eval mode.
+
+        The stem and PatchEmbed norms follow a conv and are folded into it. Block norm1/norm2 precede the 1x1
+        qkv / mlp.conv1 and are folded into those. The folded norms become nn.Identity, LayerNorm is left as is.
+        """
+        if self.training:
+            raise RuntimeError('fuse_for_inference needs eval mode, BatchNorm uses batch statistics in training')
+        # a conv subclass (lora.LoRAConv2d) computes more than its weight, folding would silently drop the rest
+        if any(isinstance(m, nn.Conv2d) and type(m) is not nn.Conv2d for m in self.modules()):
+            raise RuntimeError('fuse_for_inference only folds into plain nn.Conv2d, call lora.merge_lora first')
+        if self.using_stem:
+            layers = list(self.stem)
+            for i in range(len(layers) - 1):
+                if isinstance(layers[i], nn.Conv2d) and isinstance(layers[i + 1], BatchNorm):
+                    layers[i] = fuse_conv_bn_eval(layers[i], layers[i + 1].bn)
+                    layers[i + 1] = nn.Identity()
+            self.stem = nn.Sequential(*layers)
+        for embed in [self.patch_embed1, getattr(self, 'patch_embed2', None), getattr(self, 'patch_embed3', None)]:
+            if embed is not None and embed.norm_pe and isinstance(embed.norm, BatchNorm):
+                embed.proj = fuse_conv_bn_eval(embed.proj, embed.norm.bn)
+                embed.norm = nn.Identity()
+        for b in list(self.stage1) + list(self.stage2) + list(self.stage3):
+            if not b.attn_disabled and isinstance(b.norm1, BatchNorm):
+                b.attn.qkv = fuse_bn_into_next_conv(b.norm1.bn, b.attn.qkv)
+                b.norm1 = nn.Identity()
+            if isinstance(b.norm2, BatchNorm):
+                b.mlp.conv1 = fuse_bn_into_next_conv(b.norm2.bn, b.mlp.conv1)
+                b.norm2 = nn.Identity()
+        return self
+
+    def compile_forwards(self, **kwargs):
+        # the prompt config is static, so every forward variant is captured by torch.compile without graph breaks
+        for name in ['forward', 'forward_with_semantic_prompt', 'forward_with_projected_prompt']:
+            setattr(self, name, torch.compile(getattr(self, name), **kwargs))
+        return self
+
+
+def add_semantic_heads(model, text_dim, projector='linear'):
+    # t2i (and t2i2 / se_block for channel prompts), the same heads the training scripts attach
+    feature_dim = model.embed_dim if model.prompt_stage == 2 else model.embed_dim * 2
+    if projector == 'linear':
+        model.t2i = nn.Linear(text_dim, feature_dim, bias=False)
+    elif projector == 'mlp':
+        model.t2i = nn.Sequential(nn.Linear(text_dim, text_dim),
+                                  nn.ReLU(),
+                                  nn.Linear(text_dim, feature_dim, bias=False))
+    elif projector == 'mlp3':
+        model.t2i = nn.Sequential(nn.Linear(text_dim, text_dim),
+                                  nn.ReLU(),
+                                  nn.Linear(text_dim, text_dim),
+                                  nn.ReLU(),
+                                  nn.Linear(text_dim, feature_dim, bias=False))
+    else:
+        raise ValueError(f'unknown projector: {projector}')
+    if model.prompt_channel:
+        model.t2i2 = nn.Linear(text_dim, feature_dim, bias=False)
+        model.se_block = nn.Sequential(nn.Linear(feature_dim * 2, feature_dim, bias=True),
+                                       nn.Sigmoid(),
+                                       nn.Linear(feature_dim, feature_dim),
+                                       nn.Sigmoid(),)
+    return model
 
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+def add_exit_heads(model):
+    # early exits after stage2 and after half of stage3, both mapped to the final embedding dim
+    feature_dim = model.embed_dim * 2
+    norm_layer = type(model.norm)
+    model.exit_heads = nn.ModuleList([ExitHead(model.embed_dim, feature_dim, norm_layer),
+                                      ExitHead(feature_dim, feature_dim, norm_layer)])
+    return model
 
 
 def visformer_tiny(**kwargs):
@@ -622,5 +907,27 @@ if __name__ == '__main__':
 
     parameters = sum(p.numel() for p in net.parameters() if p.requires_grad)
     print('number of parameters:{}'.format(parameters))
-    x = net(inputs)
-    print(x.shape)
+    logit, x = net(inputs)
+    print(logit.shape, x.shape)
+
+    # fuse_for_inference must not change the outputs
+    import copy
+    net.t2i = nn.Linear(512, 384, bias=False)
+    net.t2i2 = nn.Linear(512, 384, bias=False)
+    net.se_block = nn.Sequential(nn.Linear(768, 384), nn.Sigmoid(), nn.Linear(384, 384), nn.Sigmoid())
+    for m in net.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.running_mean.normal_(0, 0.5)
+            m.running_var.uniform_(0.5, 2.)
+            m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.normal_(0, 0.1)
+    net.eval()
+    fused = copy.deepcopy(net).fuse_for_inference()
+    text = torch.randn(2, 512)
+    with torch.no_grad():
+        for name, a, b in [('forward', net(inputs), fused(inputs)),
+                           ('prompted', net.forward_with_semantic_prompt_channel(inputs, text),
+                            fused.forward_with_semantic_prompt_channel(inputs, text))]:
+            err = ((a[1] - b[1]).abs().max() / a[1].abs().max()).item()
+            print(f'fuse_for_inference {name}: max relative error {err:.2e}')
+            assert err < 1e-3